@@ -6,7 +6,11 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 from ._insertion import (sepp, classify_paths, classify_otus_experimental,
-                         filter_features)
+                         filter_features, prepare_reference_database,
+                         merge_placements, graft_placements,
+                         classify_paths_from_placements,
+                         classify_otus_from_placements)
+from ._placements import PlacementsIterator
 from ._version import get_versions
 
 
@@ -14,4 +18,7 @@ __version__ = get_versions()['version']
 del get_versions
 
 __all__ = ['sepp', 'classify_paths', 'classify_otus_experimental',
-           'filter_features']
+           'filter_features', 'prepare_reference_database',
+           'merge_placements', 'graft_placements',
+           'classify_paths_from_placements', 'classify_otus_from_placements',
+           'PlacementsIterator']
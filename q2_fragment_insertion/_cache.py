@@ -0,0 +1,377 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+
+from q2_fragment_insertion._placements import _tree_signature, _pquery_names
+from q2_fragment_insertion._tree import (_read_newick, _save_tree,
+                                         _load_saved_tree)
+
+
+# Bump whenever the layout or content of cache entries changes.
+_CACHE_VERSION = '1'
+# Bump whenever validation becomes stricter, to revalidate cached files.
+_VALIDATION_VERSION = '1'
+# Set to any non-empty value to validate files every time
+_VALIDATION_CACHE_ENV = 'Q2_FRAGMENT_INSERTION_NO_VALIDATION_CACHE'
+# Bump whenever the parsing or storage of trees changes.
+_TREE_VERSION = '1'
+# Upper bound of the memory taken by parsed trees kept in memory
+_TREE_CACHE_BYTES = 1024 ** 3
+# Directory in which parsed trees are stored for other processes, if set
+_TREE_CACHE_ENV = 'Q2_FRAGMENT_INSERTION_TREE_CACHE'
+# Number of file identities remembered by the tree cache, as every artifact
+# is extracted to a new path
+_TREE_DIGEST_ENTRIES = 1024
+# Number of per-edge tables kept in memory
+_EDGE_TABLE_ENTRIES = 8
+
+_MISSING = object()
+
+
+def _file_digest(fp, hasher):
+    with open(fp, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+            hasher.update(chunk)
+
+
+def _reference_digest(reference_database):
+    hasher = hashlib.sha256()
+    for fp in (reference_database.alignment.path_maker(),
+               reference_database.phylogeny.path_maker(),
+               reference_database.raxml_info.path_maker()):
+        hasher.update(fp.name.encode('utf-8'))
+        _file_digest(str(fp), hasher)
+    return hasher.hexdigest()
+
+
+def _sequence_digest(sequence):
+    return hashlib.sha256(str(sequence).encode('ascii')).hexdigest()
+
+
+def _atomic_write(fp, data):
+    # Several jobs may share one cache directory, so never expose partially
+    # written files.
+    dirname = os.path.dirname(fp)
+    os.makedirs(dirname, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=dirname, delete=False) as fh:
+        json.dump(data, fh)
+    os.replace(fh.name, fp)
+
+
+class PlacementCache:
+    """Persistent store of SEPP placements, one file per sequence.
+
+    Placements only depend on the sequence itself, the reference database and
+    the subset sizes SEPP was run with, so entries are grouped by a digest of
+    the latter and named by a digest of the former. Sequences SEPP was unable
+    to place are cached too, so they are not resent on every run.
+    """
+
+    def __init__(self, directory, reference_digest, alignment_subset_size,
+                 placement_subset_size):
+        key = hashlib.sha256(
+            ('%s:%s:%i:%i' % (_CACHE_VERSION, reference_digest,
+                              alignment_subset_size,
+                              placement_subset_size)).encode('ascii'))
+        self.path = os.path.join(str(directory), key.hexdigest())
+        self._header_fp = os.path.join(self.path, 'header.json')
+
+        self.header = None
+        if os.path.exists(self._header_fp):
+            with open(self._header_fp) as fh:
+                self.header = json.load(fh)
+
+    def _entry_fp(self, digest):
+        return os.path.join(self.path, 'placements', digest[:2],
+                            '%s.json' % digest)
+
+    def get(self, digest):
+        """Return cached placements of a sequence, None if SEPP could not
+        place it and _MISSING if it has never been seen.
+        """
+        if self.header is None:
+            return _MISSING
+        try:
+            with open(self._entry_fp(digest)) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return _MISSING
+
+    def update(self, placements, digests):
+        """Store the results of a SEPP run.
+
+        ``digests`` maps the IDs of all sequences SEPP was run on to their
+        sequence digest.
+        """
+        header = {k: v for k, v in placements.items() if k != 'placements'}
+        if self.header is None:
+            _atomic_write(self._header_fp, header)
+            self.header = header
+        elif (_tree_signature(header['tree']) !=
+              _tree_signature(self.header['tree'])):
+            raise ValueError('SEPP produced a reference tree that differs '
+                             'from the one in the placement cache at %s. '
+                             'Please remove this directory and try again.'
+                             % self.path)
+
+        unplaced = dict(digests)
+        for pquery in placements['placements']:
+            for name in _pquery_names(pquery):
+                digest = unplaced.pop(name, None)
+                if digest is not None:
+                    _atomic_write(self._entry_fp(digest), pquery['p'])
+        for digest in unplaced.values():
+            _atomic_write(self._entry_fp(digest), None)
+
+
+def _user_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'q2-fragment-insertion')
+
+
+class ValidationCache:
+    """Remember files which passed validation.
+
+    Files are identified by a digest of their content, so that a reference
+    database is recognised no matter where its artifact has been extracted
+    to. As computing this digest still means reading the files, their path,
+    inode, size and modification time are remembered too, and checked first.
+    Only successful validations are recorded, as markers in the user's cache
+    directory. Failing to write them just means validating again next time.
+    Setting $Q2_FRAGMENT_INSERTION_NO_VALIDATION_CACHE turns the cache off.
+    """
+
+    def __init__(self, kind, fps, directory=None):
+        self.kind = kind
+        self.fps = [str(fp) for fp in fps]
+        self.path = os.path.join(directory or _user_cache_dir(),
+                                 'validation')
+        self._digest = None
+
+    def _key(self, level, identity):
+        return hashlib.sha256(('%s:%s:%s:%s' % (
+            _VALIDATION_VERSION, self.kind, level, identity)).encode(
+                'utf-8')).hexdigest()
+
+    def _stat_key(self, level):
+        stats = []
+        for fp in self.fps:
+            st = os.stat(fp)
+            stats.append('%s:%i:%i:%i' % (os.path.realpath(fp), st.st_ino,
+                                          st.st_size, st.st_mtime_ns))
+        return self._key(level, 'stat:' + '|'.join(stats))
+
+    def _content_key(self, level):
+        if self._digest is None:
+            hasher = hashlib.sha256()
+            for fp in self.fps:
+                hasher.update(os.path.basename(fp).encode('utf-8'))
+                _file_digest(fp, hasher)
+            self._digest = hasher.hexdigest()
+        return self._key(level, 'content:' + self._digest)
+
+    def _exists(self, key):
+        return os.path.exists(os.path.join(self.path, key))
+
+    def is_valid(self, level):
+        """Whether the files passed validation at this level (or at 'max')
+        before.
+        """
+        levels = {level, 'max'}
+        if any(self._exists(self._stat_key(lvl)) for lvl in levels):
+            return True
+        if any(self._exists(self._content_key(lvl)) for lvl in levels):
+            # Skip hashing next time
+            self._mark(self._stat_key(level))
+            return True
+        return False
+
+    def _mark(self, key):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, key), 'w'):
+                pass
+        except OSError:
+            pass
+
+    def add(self, level):
+        """Record that the files passed validation at this level."""
+        self._mark(self._content_key(level))
+        self._mark(self._stat_key(level))
+
+
+def _cached_validation(kind, fps, level, validate):
+    """Call validate(level) unless the files passed validation before."""
+    if os.environ.get(_VALIDATION_CACHE_ENV):
+        validate(level)
+        return
+    cache = ValidationCache(kind, fps)
+    if cache.is_valid(level):
+        return
+    validate(level)
+    cache.add(level)
+
+
+def _tree_store(directory, kind):
+    directory = directory or os.environ.get(_TREE_CACHE_ENV)
+    if not directory:
+        return None
+    return os.path.join(str(directory), kind)
+
+
+class TreeCache:
+    """Parsed Newick trees, keyed by a digest of the file content.
+
+    Actions are often run back to back on the same insertion tree, e.g.
+    filter_features and classify_otus_experimental on the output of sepp.
+    Trees are kept in memory until they take up more than ``max_bytes``,
+    dropping the least recently used ones first. Trees can also be stored in
+    ``directory``, or the directory named by $Q2_FRAGMENT_INSERTION_TREE_CACHE,
+    from where later processes load them without parsing. Like for
+    validation, files are recognised by path, inode, size and modification
+    time before hashing them. These are forgotten along with their tree, and
+    only the ``max_digests`` most recent ones are kept.
+
+    Cached trees are shared and must not be modified.
+    """
+
+    def __init__(self, max_bytes=_TREE_CACHE_BYTES, directory=None,
+                 max_digests=_TREE_DIGEST_ENTRIES):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_digests = max_digests
+        self._trees = collections.OrderedDict()
+        self._bytes = 0
+        self._digests = collections.OrderedDict()
+
+    def _digest(self, fp):
+        st = os.stat(fp)
+        key = (os.path.realpath(fp), st.st_ino, st.st_size, st.st_mtime_ns)
+        if key in self._digests:
+            self._digests.move_to_end(key)
+        else:
+            hasher = hashlib.sha256(_TREE_VERSION.encode('ascii'))
+            _file_digest(fp, hasher)
+            self._digests[key] = hasher.hexdigest()
+            while len(self._digests) > self.max_digests:
+                self._digests.popitem(last=False)
+        return self._digests[key]
+
+    def _read(self, fp):
+        try:
+            with open(fp, 'rb') as fh:
+                return _load_saved_tree(fh)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            # Missing or damaged, so parse the tree again
+            return None
+
+    def _write(self, fp, tree):
+        try:
+            os.makedirs(os.path.dirname(fp), exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                    'wb', dir=os.path.dirname(fp), delete=False) as fh:
+                _save_tree(tree, fh)
+            os.replace(fh.name, fp)
+        except OSError:
+            pass
+
+    def load(self, fp):
+        """Return the tree stored in a Newick file."""
+        fp = str(fp)
+        digest = self._digest(fp)
+        if digest in self._trees:
+            self._trees.move_to_end(digest)
+            return self._trees[digest][0]
+
+        store, tree = _tree_store(self.directory, 'trees'), None
+        if store is not None:
+            tree_fp = os.path.join(store, digest[:2], '%s.npz' % digest)
+            tree = self._read(tree_fp)
+        if tree is None:
+            with open(fp) as fh:
+                tree = _read_newick(fh)
+            if store is not None:
+                self._write(tree_fp, tree)
+
+        size = tree.nbytes
+        self._trees[digest] = tree, size
+        self._bytes += size
+        while self._bytes > self.max_bytes and len(self._trees) > 1:
+            evicted, (_, evicted_size) = self._trees.popitem(last=False)
+            self._bytes -= evicted_size
+            for key in [key for key, digest in self._digests.items()
+                        if digest == evicted]:
+                del self._digests[key]
+        return tree
+
+
+_TREES = TreeCache()
+
+
+def _load_tree(fp):
+    """Read an insertion tree, reusing the result of earlier reads."""
+    return _TREES.load(fp)
+
+
+class EdgeTableCache:
+    """Tables mapping the edge numbers of jplace reference trees to values.
+
+    Placement-based classification looks placements up in such tables, which
+    only depend on the reference, so they are computed once and shared by
+    all studies using it. Tables are identified by a key describing all
+    their inputs. The most recently used ones are kept in memory, and like
+    trees they are stored in ``directory`` or the directory named by
+    $Q2_FRAGMENT_INSERTION_TREE_CACHE if set.
+    """
+
+    def __init__(self, max_entries=_EDGE_TABLE_ENTRIES, directory=None):
+        self.max_entries = max_entries
+        self.directory = directory
+        self._tables = collections.OrderedDict()
+
+    def get(self, key, compute):
+        """Return the table stored under key, calling compute() to create
+        it if needed.
+        """
+        digest = hashlib.sha256(
+            ('%s:%s' % (_TREE_VERSION, key)).encode('utf-8')).hexdigest()
+        if digest in self._tables:
+            self._tables.move_to_end(digest)
+            return self._tables[digest]
+
+        store, table = _tree_store(self.directory, 'edges'), None
+        if store is not None:
+            table_fp = os.path.join(store, digest[:2], '%s.json' % digest)
+            try:
+                with open(table_fp) as fh:
+                    table = {int(k): v for k, v in json.load(fh).items()}
+            except (OSError, ValueError, AttributeError):
+                # Missing or damaged, so compute the table again
+                table = None
+        if table is None:
+            table = compute()
+            if store is not None:
+                try:
+                    _atomic_write(table_fp, table)
+                except OSError:
+                    pass
+
+        self._tables[digest] = table
+        while len(self._tables) > self.max_entries:
+            self._tables.popitem(last=False)
+        return table
+
+
+_EDGE_TABLES = EdgeTableCache()
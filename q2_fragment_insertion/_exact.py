@@ -0,0 +1,122 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import numpy as np
+
+
+# Every k-mer starting at a multiple of the stride is indexed. Any substring
+# of at least k + stride - 1 nucleotides therefore fully contains at least one
+# indexed k-mer, which is enough to find all of its occurrences.
+_K = 32
+_STRIDE = 16
+
+_ENCODING = np.full(256, 4, dtype=np.uint8)
+for _i, _c in enumerate(b'ACGT'):
+    _ENCODING[_c] = _i
+
+# Batch size used to verify candidate matches without large temporaries.
+_BATCH = 4096
+
+
+def _read_ungapped(fp):
+    """Yield (id, sequence) from a (possibly aligned) FASTA file, with gap
+    characters removed and sequences converted to upper case.
+    """
+    id_, chunks = None, []
+    with open(fp) as fh:
+        for line in fh:
+            if line.startswith('>'):
+                if id_ is not None:
+                    yield id_, ''.join(chunks)
+                id_ = line[1:].split(None, 1)[0]
+                chunks = []
+            else:
+                chunks.append(line.strip().replace('-', '').replace('.', '')
+                              .upper())
+    if id_ is not None:
+        yield id_, ''.join(chunks)
+
+
+def _kmer_codes(encoded, positions, k):
+    """2-bit encode the k-mers starting at the given positions.
+
+    Returns the codes and a mask of k-mers which consist of A, C, G and T
+    only.
+    """
+    codes = np.zeros(len(positions), dtype=np.uint64)
+    valid = np.ones(len(positions), dtype=bool)
+    for i in range(k):
+        window = encoded[positions + i]
+        valid &= window < 4
+        codes = (codes << np.uint64(2)) | (window & 3).astype(np.uint64)
+    return codes, valid
+
+
+class ExactMatchIndex:
+    """Sampled k-mer index over ungapped reference sequences."""
+
+    def __init__(self, references, k=_K, stride=_STRIDE):
+        self.k = k
+        self.stride = stride
+
+        self.ids = []
+        starts, chunks, offset = [], [], 0
+        for id_, seq in references:
+            self.ids.append(id_)
+            starts.append(offset)
+            chunks.append(seq.encode('ascii'))
+            offset += len(seq) + 1
+        self._starts = np.asarray(starts, dtype=np.int64)
+
+        # All references are concatenated, separated by a character that is
+        # never part of a k-mer or a fragment.
+        self._sequences = np.frombuffer(b'|'.join(chunks) + b'|',
+                                        dtype=np.uint8)
+
+        encoded = _ENCODING[self._sequences]
+        positions = np.arange(0, max(len(encoded) - k + 1, 0), stride,
+                              dtype=np.int64)
+        codes, valid = _kmer_codes(encoded, positions, k)
+        codes, positions = codes[valid], positions[valid]
+        order = np.argsort(codes, kind='stable')
+        self._codes = codes[order]
+        self._positions = positions[order]
+
+    def find(self, fragment):
+        """Return the IDs of all references that contain the fragment."""
+        length = len(fragment)
+        if length < self.k + self.stride - 1:
+            return []
+        query = np.frombuffer(fragment.encode('ascii'), dtype=np.uint8)
+        encoded = _ENCODING[query]
+        if (encoded > 3).any():
+            return []
+
+        offsets = np.arange(self.stride, dtype=np.int64)
+        codes, _ = _kmer_codes(encoded, offsets, self.k)
+        lo = np.searchsorted(self._codes, codes, side='left')
+        hi = np.searchsorted(self._codes, codes, side='right')
+        candidates = np.unique(np.concatenate(
+            [self._positions[a:b] - o for o, a, b in zip(offsets, lo, hi)]))
+        candidates = candidates[(candidates >= 0) &
+                                (candidates + length <= len(self._sequences))]
+
+        matches = []
+        span = np.arange(length, dtype=np.int64)
+        for i in range(0, len(candidates), _BATCH):
+            batch = candidates[i:i + _BATCH]
+            equal = (self._sequences[batch[:, None] + span] == query).all(
+                axis=1)
+            matches.append(batch[equal])
+        if len(matches) == 0:
+            return []
+
+        refs = np.unique(
+            np.searchsorted(self._starts, np.concatenate(matches),
+                            side='right') - 1)
+        return [self.ids[i] for i in refs]
@@ -0,0 +1,59 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import re
+
+
+# IUPAC nucleotide codes and gap characters, as accepted for DNA alignments.
+_INVALID_ALIGNED = re.compile(r'[^ACGTRYKMSWBDHVNacgtrykmswbdhvn.\-]')
+
+
+def _fasta_ids(fh):
+    """Yield the IDs of all records of a FASTA file without keeping their
+    sequences.
+
+    Like scikit-bio, the ID is the part of the header line up to the first
+    whitespace.
+    """
+    for line in fh:
+        if line.startswith('>'):
+            yield (line[1:].split(None, 1) or [''])[0]
+
+
+def _check_alignment(fh):
+    """Check that all records of a FASTA file are aligned DNA sequences.
+
+    Sequences are processed line by line, so memory use does not depend on
+    the length of the alignment. Raises ValueError for sequences that differ
+    in length from the first one or contain invalid characters.
+    """
+    id_, length, expected = None, 0, None
+
+    def _finish():
+        nonlocal expected
+        if id_ is None:
+            return
+        if expected is None:
+            expected = length
+        elif length != expected:
+            raise ValueError('Sequence %r has length %i, but the alignment '
+                             'has length %i.' % (id_, length, expected))
+
+    for line in fh:
+        if line.startswith('>'):
+            _finish()
+            id_ = (line[1:].split(None, 1) or [''])[0]
+            length = 0
+        else:
+            line = line.rstrip()
+            match = _INVALID_ALIGNED.search(line)
+            if match is not None:
+                raise ValueError('Sequence %r contains invalid character %r.'
+                                 % (id_, match.group()))
+            length += len(line)
+    _finish()
@@ -6,44 +6,40 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import gzip
+import json
 import re
 
-import ijson
-import skbio
+import numpy as np
 
 import qiime2.plugin.model as model
 from qiime2.plugin import ValidationError
 
-from q2_types.feature_data import AlignedDNAFASTAFormat
+from q2_types.feature_data import AlignedDNAFASTAFormat, DNAFASTAFormat
 from q2_types.tree import NewickFormat
 
+from q2_fragment_insertion._cache import (_cached_validation,
+                                          _reference_digest)
+from q2_fragment_insertion._fasta import _fasta_ids, _check_alignment
+from q2_fragment_insertion._jplace import _read_header
+from q2_fragment_insertion._newick import _tip_names
+
 
 class PlacementsFormat(model.TextFileFormat):
     fields = {'tree', 'placements', 'metadata', 'version', 'fields'}
 
     def _validate_(self, level):
         # doi.org/10.1371/journal.pone.0031009
-        keys_found = set()
-
+        # Restricted to only checking root-level keys. Their values are
+        # skipped without being parsed, as placements and tree can be
+        # prohibitively large.
         # Can't self.open(mode='rb'), so we defer to the backing pathlib object
         with self.path.open(mode='rb') as fh:
-            root_element = None
-            for prefix, event, value in ijson.parse(fh):
-                if root_element is None:
-                    if event != 'start_map':
-                        raise ValidationError('Root element of file must be a '
-                                              'JSON object')
-                    else:
-                        root_element = True
-
-                # Skip parsing attributes that could be prohibitively large
-                if prefix.startswith('placements') \
-                        or prefix.startswith('tree'):
-                    continue
-
-                # Restricted to only checking root-level keys
-                if event == 'map_key' and prefix == '':
-                    keys_found.add(value)
+            try:
+                keys, _ = _read_header(fh)
+            except ValueError as e:
+                raise ValidationError(str(e))
+        keys_found = set(keys)
 
         if keys_found != self.fields:
             raise ValidationError('Expected the following fields: %s, found '
@@ -55,8 +51,134 @@ PlacementsDirFmt = model.SingleFileDirectoryFormat(
     'PlacementsDirFmt', 'placements.json', PlacementsFormat)
 
 
+class PlacementsGzFormat(model.BinaryFileFormat):
+    """A gzip compressed jplace document."""
+    fields = PlacementsFormat.fields
+
+    def _validate_(self, level):
+        with self.open() as fh:
+            if fh.read(2) != b'\x1f\x8b':
+                raise ValidationError('Not a gzip compressed file.')
+
+        # Decompressed as a stream, see PlacementsFormat
+        with gzip.open(str(self), 'rb') as fh:
+            try:
+                keys, _ = _read_header(fh)
+            except (ValueError, OSError, EOFError) as e:
+                raise ValidationError(str(e))
+        keys_found = set(keys)
+
+        if keys_found != self.fields:
+            raise ValidationError('Expected the following fields: %s, found '
+                                  '%s.' % (sorted(self.fields),
+                                           sorted(keys_found)))
+
+
+PlacementsGzDirFmt = model.SingleFileDirectoryFormat(
+    'PlacementsGzDirFmt', 'placements.json.gz', PlacementsGzFormat)
+
+
+class PlacementsHeaderFormat(model.TextFileFormat):
+    fields = {'tree', 'metadata', 'version', 'fields'}
+
+    def _validate_(self, level):
+        with self.open() as fh:
+            try:
+                header = json.load(fh)
+            except json.JSONDecodeError as e:
+                raise ValidationError('Placements header is not a valid JSON '
+                                      'document: %s' % e)
+
+        if not isinstance(header, dict) or set(header) != self.fields:
+            raise ValidationError('Expected the following fields: %s.'
+                                  % sorted(self.fields))
+        if 'edge_num' not in header['fields']:
+            raise ValidationError('Placements must have an edge_num field.')
+
+
+class PlacementNamesFormat(model.TextFileFormat):
+    def _validate_(self, level):
+        with self.open() as fh:
+            for i, line in enumerate(fh):
+                if not line.rstrip('\n'):
+                    raise ValidationError('Empty fragment name on line %i.'
+                                          % (i + 1))
+
+
+class NumPyArrayFormat(model.BinaryFileFormat):
+    def _validate_(self, level):
+        with self.open() as fh:
+            try:
+                version = np.lib.format.read_magic(fh)
+                if version == (1, 0):
+                    np.lib.format.read_array_header_1_0(fh)
+                else:
+                    np.lib.format.read_array_header_2_0(fh)
+            except ValueError as e:
+                raise ValidationError('Not a NumPy array file: %s' % e)
+
+
+class PlacementsBinaryDirFmt(model.DirectoryFormat):
+    """Column-wise placements, equivalent to a jplace document.
+
+    Placements are stored as one row per placement in ``edge-nums.npy`` and
+    ``values.npy`` (all other fields, in order, with NaN for null), and
+    fragments as one line per name in ``names.txt`` with their
+    multiplicities (NaN if the document had none). The offsets arrays
+    delimit the rows and names of every pquery.
+    """
+    header = model.File(r'header.json', format=PlacementsHeaderFormat)
+    names = model.File(r'names.txt', format=PlacementNamesFormat)
+    multiplicities = model.File(r'multiplicities.npy', format=NumPyArrayFormat)
+    name_offsets = model.File(r'name-offsets.npy', format=NumPyArrayFormat)
+    placement_offsets = model.File(r'placement-offsets.npy',
+                                   format=NumPyArrayFormat)
+    edge_nums = model.File(r'edge-nums.npy', format=NumPyArrayFormat)
+    values = model.File(r'values.npy', format=NumPyArrayFormat)
+
+    def _load(self, name):
+        return np.load(getattr(self, name).path_maker(), mmap_mode='r')
+
+    def _validate_(self, level):
+        with self.header.path_maker().open() as fh:
+            fields = json.load(fh)['fields']
+        with self.names.path_maker().open() as fh:
+            n_names = sum(1 for _ in fh)
+
+        name_offsets = self._load('name_offsets')
+        placement_offsets = self._load('placement_offsets')
+        n_rows = len(self._load('edge_nums'))
+        values = self._load('values')
+
+        if (len(name_offsets) == 0 or
+                len(name_offsets) != len(placement_offsets) or
+                name_offsets[0] != 0 or placement_offsets[0] != 0 or
+                (np.diff(name_offsets) < 0).any() or
+                (np.diff(placement_offsets) < 0).any()):
+            raise ValidationError('Offsets must be non-decreasing, start at 0 '
+                                  'and have one entry per pquery plus one.')
+        if name_offsets[-1] != n_names or \
+                len(self._load('multiplicities')) != n_names:
+            raise ValidationError('Found %i names but %i multiplicities and '
+                                  'name offsets up to %i.'
+                                  % (n_names,
+                                     len(self._load('multiplicities')),
+                                     name_offsets[-1]))
+        if placement_offsets[-1] != n_rows or \
+                values.shape != (n_rows, len(fields) - 1):
+            raise ValidationError('Expected %i placements with %i values, '
+                                  'found edge numbers of shape %s and values '
+                                  'of shape %s.'
+                                  % (placement_offsets[-1], len(fields) - 1,
+                                     (n_rows,), values.shape))
+
+
 class RAxMLinfoFormat(model.TextFileFormat):
     def _validate_(self, level):
+        _cached_validation('RAxMLinfoFormat', [self.path], level,
+                           self._validate_content)
+
+    def _validate_content(self, level):
         sigs = ['This is RAxML version', 'Base frequencies',
                 'Final GAMMA likelihood']
 
@@ -69,19 +191,48 @@ class RAxMLinfoFormat(model.TextFileFormat):
                                       % sig)
 
 
+class SeppReferenceIndexFormat(model.TextFileFormat):
+    fields = {'digest', 'tips', 'labels'}
+
+    def _validate_(self, level):
+        with self.open() as fh:
+            try:
+                index = json.load(fh)
+            except json.JSONDecodeError as e:
+                raise ValidationError('Reference index is not a valid JSON '
+                                      'document: %s' % e)
+
+        if not isinstance(index, dict) or set(index) != self.fields:
+            raise ValidationError('Expected the following fields: %s.'
+                                  % sorted(self.fields))
+
+
 class SeppReferenceDirFmt(model.DirectoryFormat):
     alignment = model.File(r'aligned-dna-sequences.fasta',
                            format=AlignedDNAFASTAFormat)
     phylogeny = model.File(r'tree.nwk', format=NewickFormat)
     raxml_info = model.File(r'raxml-info.txt', format=RAxMLinfoFormat)
+    # Only present in databases built by prepare_reference_database
+    index = model.File(r'reference-index.json',
+                       format=SeppReferenceIndexFormat, optional=True)
+    ungapped = model.File(r'ungapped-dna-sequences.fasta',
+                          format=DNAFASTAFormat, optional=True)
 
     def _validate_(self, level):
-        seqs = self.alignment.view(skbio.TabularMSA)
-        tree = self.phylogeny.view(skbio.TreeNode)
+        fps = [self.alignment.path_maker(), self.phylogeny.path_maker()]
+        if self.index.path_maker().exists():
+            # The digest in the index covers the RAxML info file as well
+            fps += [self.raxml_info.path_maker(), self.index.path_maker()]
+        _cached_validation('SeppReferenceDirFmt', fps, level,
+                           self._validate_content)
 
-        seqs.reassign_index(minter='id')
-        alignment_ids = set(seqs.index)
-        phylogeny_ids = {t.name for t in tree.tips()}
+    def _validate_content(self, level):
+        # Only IDs are compared, without loading sequences or the tree into
+        # memory.
+        with self.alignment.path_maker().open() as fh:
+            alignment_ids = set(_fasta_ids(fh))
+        with self.phylogeny.path_maker().open() as fh:
+            phylogeny_ids = set(_tip_names(fh))
 
         if alignment_ids != phylogeny_ids:
             raise ValidationError('IDs found in the alignment file that are '
@@ -91,6 +242,24 @@ class SeppReferenceDirFmt(model.DirectoryFormat):
                                   % (sorted(alignment_ids - phylogeny_ids),
                                      sorted(phylogeny_ids - alignment_ids)))
 
+        if level == 'max':
+            with self.alignment.path_maker().open() as fh:
+                try:
+                    _check_alignment(fh)
+                except ValueError as e:
+                    raise ValidationError(str(e))
+
+        # The index is trusted by sepp, e.g. its digest keys the placement
+        # cache, so it has to describe these very files at any level.
+        if self.index.path_maker().exists():
+            with self.index.path_maker().open() as fh:
+                digest = json.load(fh).get('digest')
+            if digest != _reference_digest(self):
+                raise ValidationError('The reference index does not match '
+                                      'the alignment, phylogeny and RAxML '
+                                      'info files, please prepare the '
+                                      'reference database again.')
+
         # NOTE: not worrying about validating raxml info file at present. In
         # the future we will have a method that will _run_ raxml as part of the
         # database construction process, which will guarantee that the tree
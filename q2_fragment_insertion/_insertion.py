@@ -6,12 +6,16 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import math
 import os
 import shutil
 import tempfile
 import subprocess
 
-import skbio
 import biom
 import pandas as pd
 import numpy as np
@@ -22,17 +26,31 @@ from q2_types.tree import NewickFormat
 from qiime2.plugin import get_available_cores
 
 from q2_fragment_insertion._format import PlacementsFormat, SeppReferenceDirFmt
+from q2_fragment_insertion._cache import (PlacementCache, _MISSING,
+                                          _reference_digest, _sequence_digest,
+                                          _file_digest, _load_tree,
+                                          _EDGE_TABLES)
+from q2_fragment_insertion._exact import ExactMatchIndex, _read_ungapped
+from q2_fragment_insertion._fasta import _fasta_ids
+from q2_fragment_insertion._jplace import _dump_placements, _write_jplace
+from q2_fragment_insertion._newick import _fill_missing_lengths
+from q2_fragment_insertion._placements import (
+    _best_placement, _graft, _iter_pqueries, _pquery_names,
+    _reference_labels, _relabel, _tree_signature)
+from q2_fragment_insertion._tree import _read_jplace_tree, _read_newick
 
 
 # Beta-diversity computation often requires every branch to have a length,
 # which is not necessarily true for SEPP produced insertion trees. We add zero
 # branch length information for branches without an explicit length.
 def _add_missing_branch_length(tree_fp):
-    tree = skbio.TreeNode.read(tree_fp, format="newick")
-    for node in tree.preorder():
-        if node.length is None:
-            node.length = 0
-    tree.write(tree_fp)
+    # Insertion trees can be huge, so rewrite the file as a stream instead of
+    # parsing it into memory.
+    dirname = os.path.dirname(os.path.abspath(tree_fp))
+    with open(tree_fp) as in_fh, tempfile.NamedTemporaryFile(
+            'w', dir=dirname, delete=False) as out_fh:
+        _fill_missing_lengths(in_fh, out_fh)
+    os.replace(out_fh.name, tree_fp)
 
 
 def _run(seqs_fp, threads, cwd, alignment_subset_size, placement_subset_size,
@@ -54,59 +72,514 @@ def _run(seqs_fp, threads, cwd, alignment_subset_size, placement_subset_size,
     subprocess.run(cmd, check=True, cwd=cwd)
 
 
+def _place(seqs_fp, threads, cwd, alignment_subset_size,
+           placement_subset_size, reference_database, debug):
+    _run(seqs_fp, str(threads), cwd,
+         str(alignment_subset_size), str(placement_subset_size),
+         str(reference_database.alignment.path_maker()),
+         str(reference_database.phylogeny.path_maker()),
+         str(reference_database.raxml_info.path_maker()),
+         debug)
+
+    placements = 'q2-fragment-insertion_placement.json'
+    tree = 'q2-fragment-insertion_placement.tog.relabelled.tre'
+    return os.path.join(cwd, tree), os.path.join(cwd, placements)
+
+
+def _split_fasta(seqs_fp, n, cwd):
+    """Split a FASTA file into at most n files of consecutive records.
+
+    Anything before the first record, e.g. blank lines, is skipped.
+    """
+    with open(seqs_fp) as fh:
+        count = sum(1 for line in fh if line.startswith('>'))
+    size = max(1, -(-count // n))
+
+    chunks = []
+    with open(seqs_fp) as fh, contextlib.ExitStack() as stack:
+        out, seen = None, 0
+        for line in fh:
+            if line.startswith('>'):
+                if seen % size == 0:
+                    # Closes the previous shard
+                    stack.close()
+                    chunks.append(os.path.join(cwd, 'shard-%i.fasta'
+                                               % len(chunks)))
+                    out = stack.enter_context(open(chunks[-1], 'w'))
+                seen += 1
+            if out is not None:
+                out.write(line)
+
+    return chunks
+
+
+def _place_sharded(seqs_fp, shards, threads, cwd, alignment_subset_size,
+                   placement_subset_size, reference_database, debug):
+    chunks = _split_fasta(seqs_fp, shards, cwd)
+    if len(chunks) == 0:
+        chunks = [seqs_fp]
+    threads = max(1, threads // len(chunks))
+
+    run_dirs = []
+    for i in range(len(chunks)):
+        run_dirs.append(os.path.join(cwd, 'shard-%i' % i))
+        os.mkdir(run_dirs[-1])
+
+    # Every shard is placed by its own run-sepp.sh process, threads are only
+    # needed to wait on them concurrently.
+    with concurrent.futures.ThreadPoolExecutor(len(chunks)) as pool:
+        futures = [pool.submit(_place, chunk, threads, run_dir,
+                               alignment_subset_size, placement_subset_size,
+                               reference_database, debug)
+                   for chunk, run_dir in zip(chunks, run_dirs)]
+        results = [future.result() for future in futures]
+
+    merged = None
+    for _, placements_fp in results:
+        with open(placements_fp) as fh:
+            placements = json.load(fh)
+        if merged is None:
+            merged = placements
+        elif (_tree_signature(placements['tree']) !=
+              _tree_signature(merged['tree'])):
+            raise ValueError('SEPP produced different reference trees for '
+                             'different shards of the input sequences.')
+        else:
+            merged['placements'].extend(placements['placements'])
+
+    return merged
+
+
+def _partition_cached(fragments, cache):
+    """Split (id, sequence) pairs into those with cached placements and novel
+    ones.
+
+    Returns the novel fragments, a dict mapping their IDs to their digests
+    and a list of pqueries for the cached ones.
+    """
+    novel, digests, cached = [], {}, []
+    for id_, seq in fragments:
+        digest = _sequence_digest(seq)
+        record = cache.get(digest)
+        if record is _MISSING:
+            novel.append((id_, seq))
+            digests[id_] = digest
+        elif record is not None:
+            cached.append({'p': record, 'nm': [[id_, 1]]})
+
+    return novel, digests, cached
+
+
+def _write_fasta(fragments, fp):
+    with open(fp, 'w') as fh:
+        for id_, seq in fragments:
+            fh.write('>%s\n%s\n' % (id_, seq))
+
+
+def _find_exact_matches(fragments, reference_database):
+    """Map IDs of fragments that are a substring of at least one reference
+    sequence to the IDs of all such references.
+    """
+    fp = reference_database.ungapped.path_maker()
+    if not fp.exists():
+        fp = reference_database.alignment.path_maker()
+    index = ExactMatchIndex(_read_ungapped(str(fp)))
+
+    matches = {}
+    for id_, seq in fragments:
+        references = index.find(seq)
+        if len(references) > 0:
+            matches[id_] = references
+    return matches
+
+
+def _exact_placements(matches, placements):
+    """Place fragments as sisters of the reference tip they are identical to.
+
+    Fragments that are found in several references are placed as sisters of
+    the most recent common ancestor of those, i.e. as an unresolved member of
+    the clade. The pendant length is zero either way.
+
+    Readers like guppy expect a number for every field, but there is no
+    likelihood of an exact match. Exact matches thus always report a
+    likelihood of 0.0, the log likelihood of a certain placement, and a like
+    weight ratio of 1.0, no matter which other fragments were placed.
+    """
+    tree, edges = _read_jplace_tree(placements['tree'])
+    edge_nums = {node: edge_num for edge_num, node in edges.items()}
+    tips = {tree.names[tip]: tip for tip in tree.tips().tolist()}
+    fields = placements['fields']
+
+    pqueries = []
+    for id_, references in matches.items():
+        nodes = [tips[r] for r in references if r in tips]
+        if len(nodes) == 0:
+            continue
+        elif len(nodes) == 1:
+            node = nodes[0]
+        else:
+            node = tree.lowest_common_ancestor(nodes)
+
+        distal = 0.0
+        if node not in edge_nums:
+            # The root has no edge, so attach to the top of its first child
+            node = int(tree.first_child[node])
+            distal = float(np.nan_to_num(tree.length[node]))
+
+        values = dict(edge_num=edge_nums[node], likelihood=0.0,
+                      like_weight_ratio=1.0, distal_length=distal,
+                      pendant_length=0.0)
+        pqueries.append({'p': [[values.get(field) for field in fields]],
+                         'nm': [[id_, 1]]})
+    return pqueries
+
+
+def _load_reference_index(reference_database):
+    fp = reference_database.index.path_maker()
+    if not fp.exists():
+        return None
+    with fp.open() as fh:
+        index = json.load(fh)
+    index['labels'] = {int(k): v for k, v in index['labels'].items()}
+    return index
+
+
+def _load_reference_labels(reference_database, index=None):
+    """Internal node labels of the reference phylogeny, as used by _graft.
+
+    They are taken from the index of prepared reference databases and
+    collected from the phylogeny otherwise.
+    """
+    if index is None:
+        index = _load_reference_index(reference_database)
+    if index is not None:
+        return index['tips'], index['labels']
+    with reference_database.phylogeny.path_maker().open() as fh:
+        return _reference_labels(_read_newick(fh, convert_underscores=False))
+
+
+def prepare_reference_database(
+        reference_database: SeppReferenceDirFmt) -> SeppReferenceDirFmt:
+    result = SeppReferenceDirFmt()
+    shutil.copyfile(str(reference_database.alignment.path_maker()),
+                    str(result.alignment.path_maker()))
+    shutil.copyfile(str(reference_database.phylogeny.path_maker()),
+                    str(result.phylogeny.path_maker()))
+    shutil.copyfile(str(reference_database.raxml_info.path_maker()),
+                    str(result.raxml_info.path_maker()))
+
+    # Everything sepp derives from the reference besides what SEPP reads
+    # itself: the digest keying the placement cache, the internal node
+    # labels used when grafting insertion trees and the ungapped reference
+    # sequences searched for exact matches.
+    with result.phylogeny.path_maker().open() as fh:
+        tips, labels = _reference_labels(
+            _read_newick(fh, convert_underscores=False))
+    index = {'digest': _reference_digest(result),
+             'tips': tips,
+             'labels': {str(k): v for k, v in labels.items()}}
+    with result.index.path_maker().open('w') as fh:
+        json.dump(index, fh)
+
+    _write_fasta(_read_ungapped(str(result.alignment.path_maker())),
+                 str(result.ungapped.path_maker()))
+
+    return result
+
+
 def sepp(representative_sequences: DNASequencesDirectoryFormat,
          reference_database: SeppReferenceDirFmt,
          alignment_subset_size: int = 1000,
          placement_subset_size: int = 5000,
          threads: int = 1,
          debug: bool = False,
+         placement_cache: str = None,
+         shards: int = 1,
+         exact_match: bool = False,
          ) -> (NewickFormat, PlacementsFormat):
 
     if threads == 0:
         threads = get_available_cores()
 
-    placements = 'q2-fragment-insertion_placement.json'
-    tree = 'q2-fragment-insertion_placement.tog.relabelled.tre'
-
     placements_result = PlacementsFormat()
     tree_result = NewickFormat()
 
     with tempfile.TemporaryDirectory() as tmp:
-        _run(str(representative_sequences.file.view(DNAFASTAFormat)),
-             str(threads), tmp,
-             str(alignment_subset_size), str(placement_subset_size),
-             str(reference_database.alignment.path_maker()),
-             str(reference_database.phylogeny.path_maker()),
-             str(reference_database.raxml_info.path_maker()),
-             debug)
-        outtree = os.path.join(tmp, tree)
-        outplacements = os.path.join(tmp, placements)
+        seqs_fp = str(representative_sequences.file.view(DNAFASTAFormat))
+        index = _load_reference_index(reference_database)
+
+        cache, header = None, None
+        if placement_cache is not None:
+            if index is not None:
+                reference_digest = index['digest']
+            else:
+                reference_digest = _reference_digest(reference_database)
+            cache = PlacementCache(placement_cache, reference_digest,
+                                   alignment_subset_size,
+                                   placement_subset_size)
+            header = cache.header
+
+        # Fragments that can be placed without SEPP are split off first
+        novel, digests, cached, exact = None, {}, [], {}
+        if cache is not None or exact_match:
+            novel = [(fragment.metadata['id'], str(fragment)) for fragment
+                     in representative_sequences.file.view(DNAIterator)]
+            if exact_match:
+                exact = _find_exact_matches(novel, reference_database)
+                unmatched = [f for f in novel if f[0] not in exact]
+                # Exact matches are placed on SEPP's version of the reference
+                # tree, so SEPP needs to run at least once.
+                if len(unmatched) > 0 or header is not None:
+                    novel = unmatched
+                else:
+                    exact = {}
+            if cache is not None:
+                novel, digests, cached = _partition_cached(novel, cache)
+
+            seqs_fp = os.path.join(tmp, 'novel-sequences.fasta')
+            _write_fasta(novel, seqs_fp)
+
+        placements = {'placements': []}
+        if novel is None or len(novel) > 0 or header is None:
+            if shards > 1:
+                placements = _place_sharded(
+                    seqs_fp, shards, threads, tmp, alignment_subset_size,
+                    placement_subset_size, reference_database, debug)
+            else:
+                outtree, outplacements = _place(
+                    seqs_fp, threads, tmp, alignment_subset_size,
+                    placement_subset_size, reference_database, debug)
+                if cache is not None or len(exact) > 0:
+                    with open(outplacements) as fh:
+                        placements = json.load(fh)
+
+                if len(cached) == 0 and len(exact) == 0:
+                    # Nothing to merge, SEPP's own results are complete.
+                    if cache is not None:
+                        cache.update(placements, digests)
+
+                    _add_missing_branch_length(outtree)
+
+                    shutil.copyfile(outtree, str(tree_result))
+                    shutil.copyfile(outplacements, str(placements_result))
+
+                    return tree_result, placements_result
+
+            if cache is not None:
+                cache.update(placements, digests)
+            header = placements
+
+            if len(cached) == 0 and len(exact) == 0:
+                # Only the shards of SEPP's run are merged, so the
+                # placements stay as SEPP made them, like without shards.
+                _dump_placements(placements, str(placements_result))
+                _graft(placements, _load_reference_labels(
+                    reference_database, index)).write(str(tree_result))
+                return tree_result, placements_result
+
+        exact_pqueries = _exact_placements(exact, header)
+
+        merged = {k: v for k, v in header.items() if k != 'placements'}
+        merged['metadata'] = dict(merged.get('metadata', {}))
+        merged['metadata']['placement_paths'] = {
+            'sepp': [name for pquery in placements['placements']
+                     for name in _pquery_names(pquery)],
+            'placement-cache': [pquery['nm'][0][0] for pquery in cached],
+            'exact-match': [pquery['nm'][0][0] for pquery in exact_pqueries],
+        }
+        merged['placements'] = (placements['placements'] + cached +
+                                exact_pqueries)
+
+        _dump_placements(merged, str(placements_result))
+
+        _graft(merged, _load_reference_labels(
+            reference_database, index)).write(str(tree_result))
+
+    return tree_result, placements_result
+
+
+def _unique_pqueries(pqueries, seen):
+    """Drop fragments from pqueries that have been placed before.
 
-        _add_missing_branch_length(outtree)
+    ``seen`` is the set of names of all fragments placed so far and is
+    updated in place. Pqueries without any new fragment are skipped.
+    """
+    for pquery in pqueries:
+        key = 'nm' if 'nm' in pquery else 'n'
+        kept = []
+        for entry in pquery[key]:
+            name = entry[0] if key == 'nm' else entry
+            if name not in seen:
+                seen.add(name)
+                kept.append(entry)
+        if len(kept) == 0:
+            continue
+        if len(kept) < len(pquery[key]):
+            pquery = dict(pquery)
+            pquery[key] = kept
+        yield pquery
+
+
+def merge_placements(
+        placements: PlacementsFormat,
+        reference_database: SeppReferenceDirFmt = None,
+        ) -> (NewickFormat, PlacementsFormat):
+    tree_result = NewickFormat()
+    placements_result = PlacementsFormat()
+
+    merged, signature, metadata = None, None, []
+    for placements_fmt in placements:
+        header, _ = _iter_pqueries(str(placements_fmt))
+        if merged is None:
+            merged = {k: v for k, v in header.items() if k != 'metadata'}
+            signature = _tree_signature(header['tree'])
+        elif _tree_signature(header['tree']) != signature:
+            raise ValueError('The placements were not all made against the '
+                             'same reference tree, please make sure they '
+                             'come from \'sepp\' runs with the same reference '
+                             'database.')
+        elif header['fields'] != merged['fields']:
+            raise ValueError('The placements have different fields: %r and '
+                             '%r.' % (merged['fields'], header['fields']))
+        # Trees can be large, so only the metadata of later inputs is kept
+        metadata.append(header.get('metadata', {}))
+
+    lwr_idx = merged['fields'].index('like_weight_ratio')
+    # Only the placement a fragment is grafted at is kept in memory
+    grafted = []
+    names, paths = [], None
+
+    def _pqueries():
+        nonlocal paths
+        seen = set()
+        for placements_fmt, input_metadata in zip(placements, metadata):
+            # Keep track of how fragments were placed, if any of the inputs
+            # records it. Fragments of inputs without a record were placed by
+            # SEPP.
+            input_paths = input_metadata.get('placement_paths')
+            if input_paths is not None and paths is None:
+                paths = {'sepp': names}
+            path_of = {name: path
+                       for path, path_names in (input_paths or {}).items()
+                       for name in path_names}
+
+            _, pqueries = _iter_pqueries(str(placements_fmt))
+            for pquery in _unique_pqueries(pqueries, seen):
+                pquery_names = _pquery_names(pquery)
+                if paths is None:
+                    names.extend(pquery_names)
+                else:
+                    for name in pquery_names:
+                        paths.setdefault(path_of.get(name, 'sepp'),
+                                         []).append(name)
+                if pquery['p']:
+                    grafted.append({
+                        'p': [_best_placement(pquery['p'], lwr_idx)],
+                        'n': pquery_names})
+                yield pquery
+
+    def _metadata():
+        # Written after the placements, once their paths are known
+        merged_metadata = dict(metadata[0])
+        if paths is not None:
+            merged_metadata['placement_paths'] = paths
+        return {'metadata': merged_metadata}
+
+    with open(str(placements_result), 'w') as fh:
+        _write_jplace(fh, merged, _pqueries(), _metadata)
 
-        shutil.copyfile(outtree, str(tree_result))
-        shutil.copyfile(outplacements, str(placements_result))
+    reference_labels = None
+    if reference_database is not None:
+        reference_labels = _load_reference_labels(reference_database)
+    _graft(dict(merged, placements=grafted),
+           reference_labels).write(str(tree_result))
 
     return tree_result, placements_result
 
 
+def graft_placements(placements: PlacementsFormat,
+                     reference_database: SeppReferenceDirFmt = None,
+                     ) -> NewickFormat:
+    tree_result = NewickFormat()
+
+    header, pqueries = _iter_pqueries(str(placements))
+    reference_labels = None
+    if reference_database is not None:
+        reference_labels = _load_reference_labels(reference_database)
+    _graft(dict(header, placements=pqueries),
+           reference_labels).write(str(tree_result))
+
+    return tree_result
+
+
+def _node_lineages(tree):
+    """Return the taxonomic lineage of every node of an _ArrayTree.
+
+    The lineage of a node consists of the names of the node and all its
+    ancestors which contain '__', ordered from the root downwards. It is
+    propagated from parent to children in a single preorder pass, so that
+    nodes without a taxonomic label share the lineage string of their
+    parent.
+    """
+    names, parent = tree.names, tree.parent.tolist()
+    lineages = [''] * len(tree)
+    for node in tree.preorder().tolist():
+        lineage = lineages[parent[node]] if node != tree.root else ''
+        name = names[node]
+        if name is not None and '__' in name:
+            lineage = '%s; %s' % (lineage, name) if lineage else name
+        lineages[node] = lineage
+    return lineages
+
+
+def _node_index(tree):
+    """Map node names to nodes.
+
+    Like TreeNode.find, tips take precedence over internal nodes. Of
+    internal nodes sharing a name, the first one in preorder is used.
+    """
+    is_tip = (tree.first_child == -1).tolist()
+    tips, internal = {}, {}
+    for node in tree.preorder().tolist():
+        name = tree.names[node]
+        if name is None:
+            continue
+        if is_tip[node]:
+            tips[name] = node
+        else:
+            internal.setdefault(name, node)
+    internal.update(tips)
+    return internal
+
+
+def _ancestral_lineages(tree):
+    """Map node names to the taxonomic lineage of their ancestors."""
+    parent = tree.parent.tolist()
+    lineages = _node_lineages(tree)
+    return {name: lineages[parent[node]] if node != tree.root else ''
+            for name, node in _node_index(tree).items()}
+
+
+def _fragment_ids(representative_sequences):
+    """Read the IDs of the representative sequences, in order.
+
+    Classification only needs the IDs, so the sequences themselves are
+    skipped instead of being parsed.
+    """
+    seqs_fp = str(representative_sequences.file.view(DNAFASTAFormat))
+    with open(seqs_fp) as fh:
+        return list(_fasta_ids(fh))
+
+
 def classify_paths(representative_sequences: DNASequencesDirectoryFormat,
                    tree: NewickFormat) -> pd.DataFrame:
-    # Traverse trees from bottom-up for nodes that are inserted fragments and
-    # collect taxonomic labels upon traversal.
-    tree = skbio.TreeNode.read(str(tree))
+    # Traverse trees from top-down and collect taxonomic labels of the
+    # ancestors of every node, to then look up the inserted fragments.
+    lineages = _ancestral_lineages(_load_tree(str(tree)))
     taxonomy = []
-    for fragment in representative_sequences.file.view(DNAIterator):
-        lineage = []
-        try:
-            for ancestor in tree.find(fragment.metadata['id']).ancestors():
-                if (ancestor.name is not None) and ('__' in ancestor.name):
-                    lineage.append(ancestor.name)
-            lineage_str = '; '.join(reversed(lineage))
-        except skbio.tree.MissingNodeError:
-            lineage_str = np.nan
-        taxonomy.append({'Feature ID': fragment.metadata['id'],
-                         'Taxon': lineage_str})
+    for fragment_id in _fragment_ids(representative_sequences):
+        taxonomy.append({'Feature ID': fragment_id,
+                         'Taxon': lineages.get(fragment_id, np.nan)})
     pd_taxonomy = pd.DataFrame(taxonomy).set_index('Feature ID')
     if pd_taxonomy['Taxon'].dropna().shape[0] == 0:
         raise ValueError(
@@ -116,10 +589,204 @@ def classify_paths(representative_sequences: DNASequencesDirectoryFormat,
     return pd_taxonomy
 
 
+class _NearestOTUs:
+    """Look up the OTUs closest to a node of a tree.
+
+    For a given node, these are all OTUs in the smallest sub-tree that
+    contains both the node and at least one OTU. The root of that sub-tree,
+    the node's anchor, is precomputed for all nodes by one bottom-up and one
+    top-down pass. The OTUs below every anchor are collected on first use
+    and cached, as many fragments tend to share the same anchor.
+    """
+
+    def __init__(self, tree, otus):
+        self._tree = tree
+        self._is_otu = np.fromiter((name in otus for name in tree.names),
+                                   dtype=bool, count=len(tree))
+
+        parent = tree.parent.tolist()
+        has_otus = self._is_otu.tolist()
+        for node in tree.preorder()[::-1].tolist():
+            if has_otus[node] and node != tree.root:
+                has_otus[parent[node]] = True
+
+        anchors = [-1] * len(tree)
+        for node in tree.preorder().tolist():
+            if has_otus[node]:
+                anchors[node] = node
+            elif node != tree.root:
+                anchors[node] = anchors[parent[node]]
+        self._anchors = {name: anchors[node]
+                         for name, node in _node_index(tree).items()}
+
+        self._cache = {}
+
+    def __contains__(self, name):
+        return name in self._anchors
+
+    def __getitem__(self, name):
+        anchor = self._anchors[name]
+        if anchor == -1:
+            return []
+        if anchor not in self._cache:
+            nodes = self._tree.subtree(anchor)
+            self._cache[anchor] = [self._tree.names[node] for node
+                                   in nodes[self._is_otu[nodes]].tolist()]
+        return self._cache[anchor]
+
+
+class _PatristicOTUs:
+    """Look up the lineage of the OTUs closest to a node of a tree by
+    branch length.
+
+    Distances to the nearest OTUs are computed for all nodes at once, with
+    every OTU as a source: a bottom-up pass finds the nearest OTUs within
+    the subtree of every node, and a top-down pass those reached via its
+    parent. Rather than the OTUs themselves, the consensus of their
+    lineages (the longest common prefix) is propagated, so that OTUs at the
+    same distance do not need to be collected. Missing branch lengths count
+    as zero. Nodes without an OTU within ``max_distance`` have no lineage.
+    """
+
+    def __init__(self, tree, lineages, max_distance=None):
+        ranks = _RankMatrix(lineages)
+        parent = tree.parent.tolist()
+        length = np.nan_to_num(tree.length, nan=0.0).tolist()
+        preorder = tree.preorder().tolist()
+
+        distance = [math.inf] * len(tree)
+        consensus = [None] * len(tree)
+        for node, name in enumerate(tree.names):
+            if name in ranks:
+                distance[node], consensus[node] = 0.0, ranks.lineage(name)
+
+        def _offer(node, source, branch):
+            # Reach node from its neighbour source
+            d = distance[source] + branch
+            if d < distance[node]:
+                distance[node], consensus[node] = d, consensus[source]
+            elif d == distance[node] and d != math.inf:
+                consensus[node] = ranks.common_prefix(consensus[node],
+                                                      consensus[source])
+
+        for node in reversed(preorder):
+            if node != tree.root:
+                _offer(parent[node], node, length[node])
+        # OTUs reached via the parent can only be closer if they are
+        # outside of the subtree of a node, as the path to those inside
+        # would pass the branch to the parent twice.
+        for node in preorder:
+            if node != tree.root:
+                _offer(node, parent[node], length[node])
+
+        self._distance, self._consensus = distance, consensus
+        self._max_distance = max_distance
+        self._ranks = ranks
+        self._nodes = _node_index(tree)
+
+    def __contains__(self, name):
+        return name in self._nodes
+
+    def __getitem__(self, name):
+        node = self._nodes[name]
+        if self._consensus[node] is None or (
+                self._max_distance is not None and
+                self._distance[node] > self._max_distance):
+            return np.nan
+        return self._ranks.join(self._consensus[node])
+
+
+class _RankMatrix:
+    """Lineages of a reference taxonomy, split into ranks.
+
+    Every lineage string is split into its ranks once. Taxa are interned as
+    integer codes and stored in a matrix with one row per OTU and one column
+    per rank, padded with -1, so that the longest common prefix of many
+    lineages becomes a vectorised comparison. Prefixes can also be combined
+    one at a time, as tuples of taxon codes.
+    """
+
+    def __init__(self, lineages):
+        codes = {}
+        unique = {}
+        rows = []
+        self._rows = {}
+        for otu, lineage in zip(lineages.index.tolist(), lineages.tolist()):
+            if lineage not in unique:
+                unique[lineage] = len(rows)
+                # necessary to split lineage apart to ensure that the longest
+                # common prefix operates on atomic ranks instead of characters
+                rows.append(tuple(codes.setdefault(taxon, len(codes)) for taxon
+                                  in map(str.strip, lineage.split(';'))))
+            # OTUs with the same lineage share a row
+            self._rows[otu] = unique[lineage]
+        self._taxa = np.empty(len(codes), dtype=object)
+        self._taxa[list(codes.values())] = list(codes.keys())
+
+        width = max(map(len, rows), default=0)
+        self._matrix = np.array([row + (-1,) * (width - len(row))
+                                 for row in rows],
+                                dtype=np.int64).reshape(len(rows), width)
+        # Comparing and joining a few ranks is faster on tuples than on
+        # matrix rows
+        self._codes = rows
+        self._taxa_list = self._taxa.tolist()
+
+    def __contains__(self, otu):
+        return otu in self._rows
+
+    def consensus(self, otus):
+        """Longest common prefix of the lineages of the given OTUs, joined
+        by '; '.
+        """
+        rows = self._matrix[[self._rows[otu] for otu in otus]]
+        agree = (rows == rows[0]).all(axis=0) & (rows[0] != -1)
+        length = len(agree) if agree.all() else int(np.argmin(agree))
+        return '; '.join(self._taxa[rows[0, :length]])
+
+    def lineage(self, otu):
+        """The lineage of an OTU, as a prefix."""
+        return self._codes[self._rows[otu]]
+
+    def common_prefix(self, a, b):
+        """Longest common prefix of two prefixes.
+
+        None stands for no lineage at all.
+        """
+        if a is None or a is b:
+            return b
+        if b is None:
+            return a
+        for i, (x, y) in enumerate(zip(a, b)):
+            if x != y:
+                return a[:i]
+        return a if len(a) <= len(b) else b
+
+    def join(self, prefix):
+        """A prefix, joined by '; '."""
+        taxa = self._taxa_list
+        return '; '.join([taxa[code] for code in prefix])
+
+
+def _check_reference_taxonomy(otus, reference_taxonomy, tree_description):
+    missing_features = set(otus) - set(reference_taxonomy.index)
+    if len(missing_features) > 0:
+        raise ValueError("Not all OTUs in the provided %s have "
+                         "mappings in the provided reference taxonomy. "
+                         "Taxonomy missing for the following %i feature(s):"
+                         "\n%s" % (tree_description, len(missing_features),
+                                   "\n".join(missing_features)))
+
+
 def classify_otus_experimental(
         representative_sequences: DNASequencesDirectoryFormat,
         tree: NewickFormat,
-        reference_taxonomy: pd.DataFrame) -> pd.DataFrame:
+        reference_taxonomy: pd.DataFrame,
+        method: str = 'subtree',
+        max_distance: float = None) -> pd.DataFrame:
+    if max_distance is not None and method != 'distance':
+        raise ValueError("A maximum distance can only be used with method "
+                         "'distance'.")
 
     # convert type of feature IDs to str (depending on pandas type inference
     # they might come as integers), to make sure they are of the same type as
@@ -127,91 +794,55 @@ def classify_otus_experimental(
     reference_taxonomy.index = map(str, reference_taxonomy.index)
 
     # load the insertion tree
-    tree = skbio.TreeNode.read(str(tree))
+    tree = _load_tree(str(tree))
 
     # ensure that all reference tips in the tree (those without the inserted
     # fragments) have a mapping in the user provided taxonomy table
-    names_tips = {node.name for node in tree.tips()}
-    names_fragments = {fragment.metadata['id']
-                       for fragment
-                       in representative_sequences.file.view(DNAIterator)}
-    missing_features = (names_tips - names_fragments) -\
-        set(reference_taxonomy.index)
-    if len(missing_features) > 0:
-        raise ValueError("Not all OTUs in the provided insertion tree have "
-                         "mappings in the provided reference taxonomy. "
-                         "Taxonomy missing for the following %i feature(s):"
-                         "\n%s" % (len(missing_features),
-                                   "\n".join(missing_features)))
+    names_tips = {tree.names[tip] for tip in tree.tips().tolist()}
+    fragment_ids = _fragment_ids(representative_sequences)
+    names_fragments = set(fragment_ids)
+    _check_reference_taxonomy(names_tips - names_fragments,
+                              reference_taxonomy, 'insertion tree')
 
+    if method == 'distance':
+        nearest_otus = _PatristicOTUs(tree, reference_taxonomy['Taxon'],
+                                      max_distance)
+    else:
+        nearest_otus = _NearestOTUs(tree, set(reference_taxonomy.index))
+        ranks = _RankMatrix(reference_taxonomy['Taxon'])
     taxonomy = []
-    for fragment in representative_sequences.file.view(DNAIterator):
+    for fragment_id in fragment_ids:
         # for every inserted fragment we now try to find the closest OTU tip
         # in the tree and available mapping from the OTU-ID to a lineage
         # string:
         lineage_str = np.nan
         # first, let us check if the fragment has been inserted at all ...
-        try:
-            curr_node = tree.find(fragment.metadata['id'])
-        except skbio.tree.MissingNodeError:
+        if fragment_id not in nearest_otus:
             continue
-        # if yes, we start from the inserted node and traverse the tree as less
-        # as possible towards the root and check at every level if one or
-        # several OTU-tips are within the sub-tree.
-        if curr_node is not None:
-            foundOTUs = []
-            # Traversal is stopped at a certain level, if one or more OTU-tips
-            # have been found in the sub-tree OR ... (see break below)
-            while len(foundOTUs) == 0:
-                # SEPP insertion - especially for multiple very similar
-                # sequences - can result in a rather complex topology change
-                # if all those sequences are inserted into the same branch
-                # leading to one OTU-tip. Thus, we cannot simply visit only
-                # all siblings or decendents and rather need to traverse the
-                # whole sub-tree. Average case should be well behaved,
-                # thus I think it is ok.
-                for node in curr_node.postorder():
-                    if (node.name is not None) and \
-                       (node.name in reference_taxonomy.index):
-                        # if a suitable OTU-tip node is found AND this OTU-ID
-                        # has a mapping in the user provided reference_taxonomy
-                        # we store the OTU-ID in the growing result list
-                        foundOTUs.append(node.name)
-                # ... if the whole tree has been traversed without success,
-                # e.g. if user provided reference_taxonomy did not contain any
-                # matching OTU-IDs.
-                if curr_node.is_root():
-                    break
-                # prepare next while iteration, by changing to the parent node
-                curr_node = curr_node.parent
-
-            if len(foundOTUs) > 0:
-                # If the above method has identified exactly one OTU-tip,
-                # resulting lineage string would simple be the one provided by
-                # the user reference_taxonomy. However, if the inserted
-                # fragment cannot unambiguously places into the reference tree,
-                # the above method will find multiple OTU-IDs, which might have
-                # lineage strings in the user provided reference_taxonomy that
-                # are similar up to a certain rank and differ e.g. for genus
-                # and species.
-                # Thus, we here find the longest common prefix of all lineage
-                # strings. We don't operate per character, but per taxonomic
-                # rank. Therefore, we first "convert" every lineage sting into
-                # a list of taxa, one per rank.
-                split_lineages = []
-                for otu in foundOTUs:
-                    # find lineage string for OTU
-                    lineage = reference_taxonomy.loc[otu, 'Taxon']
-                    # necessary to split lineage apart to ensure that
-                    # the longest common prefix operates on atomic ranks
-                    # instead of characters
-                    split_lineages.append(list(
-                        map(str.strip, lineage.split(';'))))
-                # find the longest common prefix rank-wise and concatenate to
-                # one lineage string, separated by ;
-                lineage_str = "; ".join(os.path.commonprefix(split_lineages))
-            taxonomy.append({'Feature ID': fragment.metadata['id'],
-                             'Taxon': lineage_str})
+        if method == 'distance':
+            # the consensus lineage of the OTU-tips at the shortest
+            # distance has been found for all nodes at once
+            taxonomy.append({'Feature ID': fragment_id,
+                             'Taxon': nearest_otus[fragment_id]})
+            continue
+        # if yes, we look up the OTU-tips of the smallest sub-tree
+        # containing the fragment that holds one or several of them.
+        foundOTUs = nearest_otus[fragment_id]
+        if len(foundOTUs) > 0:
+            # If the above method has identified exactly one OTU-tip,
+            # resulting lineage string would simple be the one provided by
+            # the user reference_taxonomy. However, if the inserted
+            # fragment cannot unambiguously places into the reference tree,
+            # the above method will find multiple OTU-IDs, which might have
+            # lineage strings in the user provided reference_taxonomy that
+            # are similar up to a certain rank and differ e.g. for genus
+            # and species.
+            # Thus, we here find the longest common prefix of all lineage
+            # strings. We don't operate per character, but per taxonomic
+            # rank, see _RankMatrix.
+            lineage_str = ranks.consensus(foundOTUs)
+        taxonomy.append({'Feature ID': fragment_id,
+                         'Taxon': lineage_str})
     pd_taxonomy = pd.DataFrame(taxonomy)
     # test if dataframe is completely empty, or if no lineages could be found
     if (len(taxonomy) == 0) or \
@@ -224,28 +855,218 @@ def classify_otus_experimental(
     return pd_taxonomy.set_index('Feature ID')
 
 
+def _weighted_lineage(lineages, weights, confidence):
+    """Find the deepest lineage supported by placements with a combined like
+    weight ratio of at least ``confidence``.
+
+    Starting at the highest rank, the taxon with the largest combined weight
+    is chosen among the placements agreeing with the lineage so far, until
+    it falls below ``confidence``. Placements without a lineage (None) only
+    count towards the support of the empty lineage. Returns the lineage and
+    its support.
+    """
+    ranks = [[taxon.strip() for taxon in lineage.split(';')] if lineage
+             else [] for lineage in lineages]
+    candidates = list(range(len(ranks)))
+    prefix, support = [], sum(weights)
+    while True:
+        depth, votes = len(prefix), {}
+        for i in candidates:
+            if len(ranks[i]) > depth:
+                taxon = ranks[i][depth]
+                votes[taxon] = votes.get(taxon, 0.0) + weights[i]
+        if not votes:
+            break
+        taxon = max(votes, key=votes.get)
+        if votes[taxon] < confidence:
+            break
+        prefix.append(taxon)
+        support = votes[taxon]
+        candidates = [i for i in candidates
+                      if len(ranks[i]) > depth and ranks[i][depth] == taxon]
+    return '; '.join(prefix), support
+
+
+def _classify_placements(header, pqueries, edge_lineages, confidence):
+    """Look up the lineages of all placed fragments in a per-edge table.
+
+    Without a ``confidence``, fragments get the lineage of the edge of their
+    placement with the highest like weight ratio, which is where _graft
+    inserts them. Otherwise, all placements of a fragment are combined by
+    _weighted_lineage, and their support is reported as Confidence.
+    """
+    fields = header['fields']
+    edge_idx = fields.index('edge_num')
+    lwr_idx = fields.index('like_weight_ratio')
+
+    taxonomy = []
+    for pquery in pqueries:
+        if not pquery['p']:
+            continue
+        if confidence is None:
+            best = _best_placement(pquery['p'], lwr_idx)
+            lineage = edge_lineages.get(best[edge_idx])
+            row = {'Taxon': np.nan if lineage is None else lineage}
+        else:
+            lineages = [edge_lineages.get(p[edge_idx]) for p in pquery['p']]
+            if all(lineage is None for lineage in lineages):
+                row = {'Taxon': np.nan, 'Confidence': np.nan}
+            else:
+                lineage, support = _weighted_lineage(
+                    lineages, [p[lwr_idx] or 0.0 for p in pquery['p']],
+                    confidence)
+                row = {'Taxon': lineage, 'Confidence': support}
+        for name in _pquery_names(pquery):
+            taxonomy.append(dict(row, **{'Feature ID': name}))
+
+    pd_taxonomy = pd.DataFrame(
+        taxonomy, columns=['Feature ID', 'Taxon'] +
+        ([] if confidence is None else ['Confidence']))
+    if pd_taxonomy['Taxon'].dropna().shape[0] == 0:
+        raise ValueError(
+            'None of the placed fragments could be classified. Please double '
+            'check that the placements were made against the reference '
+            'used for classification.')
+    return pd_taxonomy.set_index('Feature ID')
+
+
+def _edge_paths(tree_str, reference_labels):
+    """Map edge numbers of a jplace tree to the lineage a fragment inserted
+    on that edge gets from classify_paths.
+    """
+    tree, edges = _read_jplace_tree(tree_str)
+    _relabel(tree, reference_labels, strict=True)
+    lineages = _node_lineages(tree)
+    parent = tree.parent.tolist()
+    # Fragments hang off a new node on the edge, below the edge's parent
+    return {edge: lineages[parent[node]] if parent[node] != -1 else ''
+            for edge, node in edges.items()}
+
+
+def classify_paths_from_placements(
+        placements: PlacementsFormat,
+        reference_database: SeppReferenceDirFmt,
+        confidence: float = None) -> pd.DataFrame:
+    header, pqueries = _iter_pqueries(str(placements))
+
+    phylogeny_digest = hashlib.sha256()
+    _file_digest(str(reference_database.phylogeny.path_maker()),
+                 phylogeny_digest)
+    edge_lineages = _EDGE_TABLES.get(
+        'paths:%s:%s' % (_tree_signature(header['tree']),
+                         phylogeny_digest.hexdigest()),
+        lambda: _edge_paths(header['tree'],
+                            _load_reference_labels(reference_database)))
+
+    return _classify_placements(header, pqueries, edge_lineages, confidence)
+
+
+def _edge_otus(tree_str, reference_taxonomy):
+    """Map edge numbers of a jplace tree to the lineage a fragment inserted
+    on that edge gets from classify_otus_experimental.
+
+    The subtree of the node inserted on an edge holds the fragment, possibly
+    other fragments, and the subtree below the edge. Its nearest OTUs are
+    thus those of the node below the edge, as found by _NearestOTUs. Since
+    the longest common prefix of lineages can be combined piecewise, the
+    consensus below every node is computed in a single bottom-up pass
+    instead of once per edge.
+    """
+    tree, edges = _read_jplace_tree(tree_str)
+    _check_reference_taxonomy(
+        (tree.names[tip] for tip in tree.tips().tolist()),
+        reference_taxonomy, 'reference tree of the placements')
+
+    ranks = _RankMatrix(reference_taxonomy['Taxon'])
+    parent = tree.parent.tolist()
+    below = [None] * len(tree)
+    for node in tree.preorder()[::-1].tolist():
+        name = tree.names[node]
+        if name in ranks:
+            below[node] = ranks.common_prefix(below[node],
+                                              ranks.lineage(name))
+        if below[node] is not None and node != tree.root:
+            below[parent[node]] = ranks.common_prefix(below[parent[node]],
+                                                      below[node])
+
+    # Nodes without OTUs below them share the OTUs of their parent
+    for node in tree.preorder().tolist():
+        if below[node] is None and node != tree.root:
+            below[node] = below[parent[node]]
+
+    joined = {}
+    table = {}
+    for edge, node in edges.items():
+        consensus = below[node]
+        if consensus is not None and consensus not in joined:
+            joined[consensus] = ranks.join(consensus)
+        table[edge] = joined.get(consensus)
+    return table
+
+
+def classify_otus_from_placements(
+        placements: PlacementsFormat,
+        reference_taxonomy: pd.DataFrame,
+        confidence: float = None) -> pd.DataFrame:
+    # like classify_otus_experimental, make sure that feature IDs are str
+    reference_taxonomy.index = map(str, reference_taxonomy.index)
+    header, pqueries = _iter_pqueries(str(placements))
+
+    taxonomy_digest = hashlib.sha256()
+    for otu, lineage in reference_taxonomy['Taxon'].items():
+        taxonomy_digest.update(('%s\t%s\n' % (otu, lineage)).encode('utf-8'))
+    edge_lineages = _EDGE_TABLES.get(
+        'otus:%s:%s' % (_tree_signature(header['tree']),
+                        taxonomy_digest.hexdigest()),
+        lambda: _edge_otus(header['tree'], reference_taxonomy))
+
+    return _classify_placements(header, pqueries, edge_lineages, confidence)
+
+
+def _subset_observations(table, matrix, mask):
+    """Copy the observations selected by a boolean mask into a new table.
+
+    ``matrix`` is the data of the table in CSR format.
+    """
+    obs_md = table.metadata(axis='observation')
+    if obs_md is not None:
+        obs_md = [md for md, m in zip(obs_md, mask) if m]
+    return biom.Table(
+        matrix[mask],
+        table.ids(axis='observation')[mask],
+        table.ids(axis='sample'),
+        observation_metadata=obs_md,
+        sample_metadata=table.metadata(axis='sample'),
+        table_id=table.table_id,
+        type=table.type,
+        create_date=table.create_date,
+        generated_by=table.generated_by,
+        observation_group_metadata=table.group_metadata(
+            axis='observation'),
+        sample_group_metadata=table.group_metadata(axis='sample'))
+
+
 def filter_features(table: biom.Table,
                     tree: NewickFormat) -> (biom.Table, biom.Table):
 
-    # load the insertion tree
-    tree = skbio.TreeNode.read(str(tree))
     # collect all tips=inserted fragments+reference taxa names
-    fragments_tree = {
-        str(tip.name)
-        for tip in tree.tips()
-        if tip.name is not None}
+    tree = _load_tree(str(tree))
+    fragments_tree = {tree.names[tip] for tip in tree.tips().tolist()}
 
     # collect all fragments/features from table
-    fragments_table = set(map(str, table.ids(axis='observation')))
+    fragments_table = table.ids(axis='observation')
+    keep = np.fromiter((str(f) in fragments_tree for f in fragments_table),
+                       dtype=bool, count=len(fragments_table))
 
-    if len(fragments_table & fragments_tree) <= 0:
+    if not keep.any():
         raise ValueError(('Not a single fragment of your table is part of your'
                           ' tree. The resulting table would be empty.'))
 
-    tbl_positive = table.filter(fragments_table & fragments_tree,
-                                axis='observation', inplace=False)
-    tbl_negative = table.filter(fragments_table - fragments_tree,
-                                axis='observation', inplace=False)
+    # Split the rows of the sparse matrix once into both tables, instead of
+    # filtering a full copy of the table for each of them.
+    matrix = table.matrix_data.tocsr()
+    tbl_positive = _subset_observations(table, matrix, keep)
+    tbl_negative = _subset_observations(table, matrix, ~keep)
 
     # print some information for quality control,
     # which user can request via --verbose
@@ -0,0 +1,278 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import gzip
+import json
+import re
+
+import numpy as np
+
+
+_CHUNK_SIZE = 1024 * 1024
+# Number of pqueries encoded before writing them out
+_WRITE_BATCH = 1024
+_WHITESPACE = b' \t\r\n'
+_SCALAR_END = re.compile(rb'[\s,}\]]')
+_ESCAPED_QUOTES = re.compile(rb'(\\+)"')
+
+# Characters that matter for finding the end of an array or object
+_OTHER, _OPEN, _CLOSE, _QUOTE = range(4)
+_KIND = np.zeros(256, dtype=np.uint8)
+_KIND[list(b'[{')] = _OPEN
+_KIND[list(b']}')] = _CLOSE
+_KIND[ord('"')] = _QUOTE
+_IRRELEVANT = bytes(c for c in range(256) if not _KIND[c])
+
+
+def _walk(kinds, quotes, depth, quoted):
+    """Track depth along a sequence of structural characters.
+
+    Returns the index of the character closing the container (or None) and
+    the state after the last character.
+    """
+    in_string = (np.cumsum(quotes) + quoted) % 2 == 1
+    steps = (kinds == _OPEN).astype(np.int64) - (kinds == _CLOSE)
+    steps[in_string] = 0
+    depths = np.cumsum(steps) + depth
+    closed = np.flatnonzero(depths == 0)
+    if len(closed) > 0:
+        return int(closed[0]), 0, False
+    if len(kinds) == 0:
+        return None, depth, quoted
+    return None, int(depths[-1]), bool(in_string[-1])
+
+
+def _container_end(data, depth, quoted):
+    """Find the end of a JSON array or object in a chunk of bytes.
+
+    ``depth`` is the nesting depth and ``quoted`` whether we are inside a
+    string at the start of ``data``. Brackets are counted with vectorised
+    operations, so no Python code runs per character.
+
+    Returns the index after the closing bracket, or None and the state at the
+    end of ``data`` if the container does not end within it.
+    """
+    if b'\\' not in data:
+        # Most chunks do not contain the end of the container, which we can
+        # tell from their structural characters alone.
+        kinds = _KIND[np.frombuffer(data.translate(None, _IRRELEVANT),
+                                    dtype=np.uint8)]
+        end, new_depth, new_quoted = _walk(kinds, kinds == _QUOTE, depth,
+                                           quoted)
+        if end is None:
+            return None, new_depth, new_quoted
+
+    kinds = _KIND[np.frombuffer(data, dtype=np.uint8)]
+    positions = np.flatnonzero(kinds)
+    kinds = kinds[positions]
+    quotes = kinds == _QUOTE
+    for match in _ESCAPED_QUOTES.finditer(data):
+        if len(match.group(1)) % 2 == 1:
+            quotes[np.searchsorted(positions, match.end() - 1)] = False
+
+    end, depth, quoted = _walk(kinds, quotes, depth, quoted)
+    if end is not None:
+        end = int(positions[end]) + 1
+    return end, depth, quoted
+
+
+class _RootScanner:
+    """Walk the keys of the root object of a JSON document.
+
+    Values are only decoded if requested, all others are skipped at the byte
+    level without being parsed, so the cost of a scan is dominated by I/O
+    rather than by the size and complexity of the skipped values. ``fh`` is
+    any binary file object, e.g. an open file or a gzip stream.
+
+    Raises ValueError if the document is not a JSON object or malformed
+    between its root keys. Skipped values are not validated.
+    """
+
+    def __init__(self, fh):
+        self._fh = fh
+        self._buf = b''
+        self._pos = 0
+
+    def _fill(self):
+        chunk = self._fh.read(_CHUNK_SIZE)
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return len(chunk) > 0
+
+    def _peek(self):
+        while True:
+            while (self._pos < len(self._buf) and
+                   self._buf[self._pos] in _WHITESPACE):
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos:self._pos + 1]
+            if not self._fill():
+                return b''
+
+    def _expect(self, char):
+        found = self._peek()
+        if found != char:
+            raise ValueError('Expected %r but found %r.'
+                             % (char.decode(), found.decode() or 'EOF'))
+        self._pos += 1
+
+    def _string(self):
+        start = self._pos
+        search = start + 1
+        while True:
+            end = self._buf.find(b'"', search)
+            if end == -1:
+                search = len(self._buf)
+                start -= self._pos
+                search -= self._pos
+                if not self._fill():
+                    raise ValueError('Unterminated string.')
+                continue
+            backslashes = len(self._buf[start:end]) - len(
+                self._buf[start:end].rstrip(b'\\'))
+            if backslashes % 2 == 0:
+                self._pos = end + 1
+                return self._buf[start:end + 1]
+            search = end + 1
+
+    def _container(self, keep):
+        start = self._pos
+        offset, depth, quoted = start, 0, False
+        while True:
+            # Leave trailing backslashes to the next chunk, as they could
+            # escape a quote at its start.
+            stop = len(self._buf)
+            while stop > offset and self._buf[stop - 1] == ord('\\'):
+                stop -= 1
+            if stop > offset:
+                end, depth, quoted = _container_end(
+                    self._buf[offset:stop], depth, quoted)
+                if end is not None:
+                    self._pos = offset + end
+                    return self._buf[start:self._pos] if keep else None
+                offset = stop
+            if not keep:
+                # Drop what has been scanned, so that memory use does not
+                # depend on the size of the value
+                start = self._pos = offset
+            offset -= self._pos
+            start -= self._pos
+            if not self._fill():
+                raise ValueError('Unterminated array or object.')
+
+    def _scalar(self):
+        while True:
+            match = _SCALAR_END.search(self._buf, self._pos)
+            if match is not None:
+                break
+            if not self._fill():
+                match = None
+                break
+        end = len(self._buf) if match is None else match.start()
+        value, self._pos = self._buf[self._pos:end], end
+        if not value:
+            raise ValueError('Expected a value.')
+        return value
+
+    def _value(self, decode):
+        char = self._peek()
+        if char == b'"':
+            raw = self._string()
+        elif char in (b'[', b'{'):
+            raw = self._container(keep=decode)
+        else:
+            raw = self._scalar()
+        if decode:
+            return json.loads(raw)
+        return None
+
+    def scan(self, decode=()):
+        """Yield (key, value) for every key of the root object.
+
+        Values are None unless their key is listed in ``decode``.
+        """
+        if self._peek() != b'{':
+            raise ValueError('Root element of file must be a JSON object')
+        self._pos += 1
+
+        if self._peek() == b'}':
+            self._pos += 1
+        else:
+            while True:
+                if self._peek() != b'"':
+                    raise ValueError('Expected a key.')
+                key = json.loads(self._string())
+                self._expect(b':')
+                yield key, self._value(key in decode)
+                if self._peek() == b',':
+                    self._pos += 1
+                    continue
+                self._expect(b'}')
+                break
+
+        if self._peek() != b'':
+            raise ValueError('Unexpected data after the root object.')
+
+
+def _read_header(fh, decode=()):
+    """Return the root keys of a jplace document and the decoded values of
+    the keys listed in ``decode``.
+    """
+    keys, header = [], {}
+    for key, value in _RootScanner(fh).scan(decode):
+        keys.append(key)
+        if key in decode:
+            header[key] = value
+    return keys, header
+
+
+def _write_jplace(fh, header, placements=None, trailer=None):
+    """Write a jplace document a few pqueries at a time.
+
+    ``header`` holds all root keys but placements, which are taken from the
+    ``placements`` iterable, if given. ``trailer`` is called once they have
+    all been written, and returns further root keys to write after them,
+    e.g. ones that depend on the placements.
+    """
+    fh.write('{')
+    items = ['%s: %s' % (json.dumps(key), json.dumps(value))
+             for key, value in header.items()]
+    fh.write(', '.join(items))
+    if placements is not None:
+        fh.write('%s"placements": [' % (', ' if items else ''))
+        # Encoding batches of pqueries with one call each keeps the overhead
+        # of calling the encoder low.
+        batch, separator = [], ''
+        for pquery in placements:
+            batch.append(pquery)
+            if len(batch) == _WRITE_BATCH:
+                fh.write(separator + json.dumps(batch)[1:-1])
+                batch, separator = [], ', '
+        if batch:
+            fh.write(separator + json.dumps(batch)[1:-1])
+        fh.write(']')
+        items.append('placements')
+    if trailer is not None:
+        for key, value in trailer().items():
+            fh.write('%s%s: %s' % (', ' if items else '', json.dumps(key),
+                                   json.dumps(value)))
+            items.append(key)
+    fh.write('}')
+
+
+def _dump_placements(data, fp, compress=False):
+    """Write a jplace dict to a file, optionally gzip compressed.
+
+    Unlike json.dumps, this never holds more than a small batch of pqueries
+    as a string.
+    """
+    header = {key: value for key, value in data.items()
+              if key != 'placements'}
+    opener = gzip.open if compress else open
+    with opener(fp, 'wt') as fh:
+        _write_jplace(fh, header, data.get('placements'))
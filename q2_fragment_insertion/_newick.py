@@ -0,0 +1,139 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import re
+
+
+_CHUNK_SIZE = 1024 * 1024
+_SPECIAL = re.compile(r"[()\[\],:;']")
+_STRUCTURE = frozenset('(),:;')
+_QUOTE_OR_COMMENT = re.compile(r"[\[\]']")
+
+
+def _tokenize(fh):
+    """Split a Newick stream into structure characters and the text between.
+
+    Yields each of ( ) , : ; as a single character token and everything in
+    between (labels, branch lengths, whitespace and comments) unmodified, so
+    that joining all tokens reproduces the input. Quoted labels and comments
+    may contain structure characters and are never split. The file is read
+    in chunks, so memory use does not depend on the size of the tree.
+    """
+    pending = []
+    quoted = False
+    comment_depth = 0
+    for chunk in iter(lambda: fh.read(_CHUNK_SIZE), ''):
+        start = 0
+        for match in _SPECIAL.finditer(chunk):
+            char = match.group()
+            if quoted:
+                # '' within a quoted label toggles twice, leaving us quoted
+                if char == "'":
+                    quoted = False
+            elif comment_depth > 0:
+                if char == '[':
+                    comment_depth += 1
+                elif char == ']':
+                    comment_depth -= 1
+            elif char == "'":
+                quoted = True
+            elif char == '[':
+                comment_depth = 1
+            elif char in _STRUCTURE:
+                pending.append(chunk[start:match.start()])
+                text = ''.join(pending)
+                if text:
+                    yield text
+                yield char
+                pending = []
+                start = match.end()
+        pending.append(chunk[start:])
+
+    text = ''.join(pending)
+    if text:
+        yield text
+
+
+def _fill_missing_lengths(in_fh, out_fh):
+    """Copy a Newick stream, adding a zero length to every branch without
+    one, including the root.
+    """
+    has_length = False
+    for token in _tokenize(in_fh):
+        if token == ':':
+            has_length = True
+        elif token in (',', ')', ';'):
+            # These end the description of a node
+            if not has_length:
+                out_fh.write(':0')
+            has_length = False
+        elif token == '(':
+            has_length = False
+        out_fh.write(token)
+
+
+def _strip_comments(text):
+    if '[' not in text:
+        return text
+    kept = []
+    quoted = False
+    comment_depth = 0
+    start = 0
+    for match in _QUOTE_OR_COMMENT.finditer(text):
+        char = match.group()
+        if quoted:
+            if char == "'":
+                quoted = False
+        elif char == '[':
+            if comment_depth == 0:
+                kept.append(text[start:match.start()])
+            comment_depth += 1
+        elif comment_depth > 0:
+            if char == ']':
+                comment_depth -= 1
+                start = match.end()
+        elif char == "'":
+            quoted = True
+    if comment_depth == 0:
+        kept.append(text[start:])
+    return ''.join(kept)
+
+
+def _label(text, convert_underscores=True):
+    """Decode the raw text of a node label the way scikit-bio does.
+
+    Returns None for nodes without a label.
+    """
+    text = _strip_comments(text).strip()
+    if not text:
+        return None
+    if len(text) > 1 and text[0] == "'" and text[-1] == "'":
+        return text[1:-1].replace("''", "'")
+    if convert_underscores:
+        text = text.replace('_', ' ')
+    return text
+
+
+def _tip_names(fh, convert_underscores=True):
+    """Yield the names of all labelled tips of a Newick tree.
+
+    A node is a tip if its description does not start with a parenthesis.
+    """
+    node_start = True
+    for token in _tokenize(fh):
+        if token in ('(', ','):
+            node_start = True
+        elif token == ';':
+            break
+        elif token in (')', ':'):
+            node_start = False
+        elif node_start:
+            name = _label(token, convert_underscores)
+            if name is not None:
+                yield name
+                node_start = False
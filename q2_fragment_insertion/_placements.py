@@ -0,0 +1,446 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import array
+import collections
+import collections.abc
+import hashlib
+import json
+import math
+import re
+
+import ijson
+import numpy as np
+import pandas as pd
+
+from q2_fragment_insertion._jplace import _read_header
+from q2_fragment_insertion._tree import _ArrayTree, _read_jplace_tree
+
+
+# Label following a closing parenthesis, i.e. the name of an internal node.
+_INTERNAL_LABEL = re.compile(r"\)(?:'(?:[^']|'')*'|[^:,;()\[\]{}]*)")
+
+
+def _tree_signature(tree_str):
+    """Shape of a jplace reference tree, ignoring internal node labels.
+
+    SEPP renames the internal nodes of the reference tree on every run, so
+    two runs against the same reference only agree on topology, tip names,
+    branch lengths and edge numbers.
+    """
+    return hashlib.sha256(
+        _INTERNAL_LABEL.sub(')', tree_str).encode('utf-8')).hexdigest()
+
+
+def _tip_code(name):
+    return int.from_bytes(
+        hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def _tip_codes(tree):
+    """Combine the codes of all tips below each node of an _ArrayTree.
+
+    The code of a node is the XOR of the codes of the tips below it, so it
+    identifies the set of those tips.
+    """
+    names, parent = tree.names, tree.parent.tolist()
+    codes = [0] * len(tree)
+    for node in tree.tips().tolist():
+        codes[node] = _tip_code(str(names[node]))
+    for node in tree.postorder().tolist():
+        if node != tree.root:
+            codes[parent[node]] ^= codes[node]
+    return codes
+
+
+def _bipartitions(tree):
+    """Yield (node, key) for all internal non-root nodes.
+
+    The key identifies the bipartition of tips induced by the edge above the
+    node, independent of where the tree is rooted.
+    """
+    codes = _tip_codes(tree)
+    total = codes[tree.root]
+    for node in np.flatnonzero(tree.first_child != -1).tolist():
+        if node != tree.root:
+            yield node, min(codes[node], codes[node] ^ total)
+
+
+def _reference_labels(reference_tree):
+    """Collect internal node labels of a reference phylogeny.
+
+    Returns a code identifying the set of tips and a dict mapping the
+    bipartition keys of all labelled internal nodes to their label.
+    """
+    total = 0
+    for tip in reference_tree.tips().tolist():
+        total ^= _tip_code(str(reference_tree.names[tip]))
+
+    labels = {key: reference_tree.names[node]
+              for node, key in _bipartitions(reference_tree)
+              if reference_tree.names[node] is not None}
+    return total, labels
+
+
+def _relabel(tree, reference_labels, strict=False):
+    """Restore original internal node labels of a SEPP jplace tree.
+
+    SEPP replaces internal node labels of the reference phylogeny with unique
+    placeholders. We map them back by matching bipartitions, which is robust
+    against SEPP rerooting the tree and resolving polytomies. If the trees
+    have different tips, the placeholders are kept, or a ValueError is raised
+    if ``strict``.
+    """
+    total, labels = reference_labels
+
+    tips = 0
+    for tip in tree.tips().tolist():
+        tips ^= _tip_code(str(tree.names[tip]))
+    if tips != total:
+        if strict:
+            raise ValueError('The placements were not made against the '
+                             'reference phylogeny, as their trees have '
+                             'different tips.')
+        return
+
+    for node, key in list(_bipartitions(tree)):
+        if tree.names[node] is not None and key in labels:
+            tree.names[node] = labels[key]
+
+
+def _best_placement(placements, lwr_idx):
+    """The placement with the highest like weight ratio.
+
+    A null ratio counts as 0, and loses ties, as it is ranked last.
+    """
+    return max(placements, key=lambda p: (p[lwr_idx] or 0.0,
+                                          p[lwr_idx] is not None))
+
+
+def _pquery_names(pquery):
+    if 'nm' in pquery:
+        return [name for name, _ in pquery['nm']]
+    return list(pquery['n'])
+
+
+class PlacementsIterator(collections.abc.Iterable):
+    """Lazily read the placements of a jplace document.
+
+    Every record is a dict holding the ``names`` of the placed fragments and,
+    for each of the document's fields (e.g. ``edge_num`` or
+    ``like_weight_ratio``), the list of values across all placements of
+    these fragments.
+    """
+
+    def __init__(self, generator):
+        self.generator = generator
+
+    def __iter__(self):
+        yield from self.generator
+
+
+def _read_placements(fp, opener=open):
+    with opener(fp, 'rb') as fh:
+        _, header = _read_header(fh, decode=('fields',))
+    fields = header.get('fields', [])
+
+    with opener(fp, 'rb') as fh:
+        for pquery in ijson.items(fh, 'placements.item', use_float=True):
+            record = {'names': _pquery_names(pquery)}
+            columns = list(zip(*pquery['p'])) or [()] * len(fields)
+            for field, column in zip(fields, columns):
+                record[field] = list(column)
+            yield record
+
+
+_COLUMNS = (('edge_num', np.int64), ('likelihood', np.float64),
+            ('like_weight_ratio', np.float64), ('distal_length', np.float64),
+            ('pendant_length', np.float64))
+
+
+def _placements_frame(records, capacity=1024):
+    """Tabulate placement records, one row per fragment and placement.
+
+    Columns are filled in place and grow geometrically, so that no Python
+    object is kept per placement. Besides the jplace fields, ``rank`` orders
+    the placements of each fragment by decreasing like weight ratio,
+    starting at 1, with missing ratios last. Missing values, e.g. null
+    likelihoods, become NaN.
+    """
+    columns = {'fragment': np.empty(capacity, dtype=object),
+               'rank': np.empty(capacity, dtype=np.int64)}
+    for name, dtype in _COLUMNS:
+        columns[name] = np.empty(capacity, dtype=dtype)
+
+    size = 0
+    for record in records:
+        n = len(record['edge_num'])
+        if n == 0:
+            continue
+        lwrs = [math.nan if lwr is None else lwr
+                for lwr in record.get('like_weight_ratio', [None] * n)]
+        ranks = [0] * n
+        # Placements without a like weight ratio are ranked last
+        for rank, i in enumerate(sorted(
+                range(n), key=lambda i: (math.isnan(lwrs[i]), -lwrs[i])), 1):
+            ranks[i] = rank
+
+        for name in record['names']:
+            if size + n > capacity:
+                capacity = max(2 * capacity, size + n)
+                for key, column in columns.items():
+                    columns[key] = np.resize(column, capacity)
+            rows = slice(size, size + n)
+            columns['fragment'][rows] = name
+            columns['rank'][rows] = ranks
+            for field, _ in _COLUMNS:
+                columns[field][rows] = record.get(field, np.nan)
+            size += n
+
+    return pd.DataFrame(
+        {key: columns[key][:size]
+         for key in ['fragment'] + [f for f, _ in _COLUMNS] + ['rank']})
+
+
+_HEADER_FIELDS = ('tree', 'metadata', 'version', 'fields')
+
+
+def _iter_pqueries(fp, opener=open):
+    """Return the header of a jplace file and an iterator of its pqueries."""
+    with opener(fp, 'rb') as fh:
+        _, header = _read_header(fh, decode=_HEADER_FIELDS)
+
+    def pqueries():
+        with opener(fp, 'rb') as fh:
+            yield from ijson.items(fh, 'placements.item', use_float=True)
+
+    return header, pqueries()
+
+
+def _write_binary(header, pqueries, ff):
+    """Store a jplace header and its pqueries column-wise in a
+    PlacementsBinaryDirFmt.
+    """
+    fields = header['fields']
+    edge_idx = fields.index('edge_num')
+    others = [i for i, _ in enumerate(fields) if i != edge_idx]
+
+    multiplicities = array.array('d')
+    name_offsets = array.array('q', [0])
+    placement_offsets = array.array('q', [0])
+    edge_nums = array.array('q')
+    values = array.array('d')
+    with ff.names.path_maker().open('w') as names:
+        for pquery in pqueries:
+            if 'nm' in pquery:
+                for name, multiplicity in pquery['nm']:
+                    names.write('%s\n' % name)
+                    multiplicities.append(multiplicity)
+            else:
+                for name in pquery['n']:
+                    names.write('%s\n' % name)
+                    multiplicities.append(math.nan)
+            name_offsets.append(len(multiplicities))
+
+            for placement in pquery['p']:
+                edge_nums.append(placement[edge_idx])
+                values.extend(math.nan if placement[i] is None
+                              else placement[i] for i in others)
+            placement_offsets.append(len(edge_nums))
+
+    with ff.header.path_maker().open('w') as fh:
+        json.dump({key: header[key] for key in _HEADER_FIELDS}, fh)
+    for name, column, dtype in (
+            ('multiplicities', multiplicities, np.float64),
+            ('name_offsets', name_offsets, np.int64),
+            ('placement_offsets', placement_offsets, np.int64),
+            ('edge_nums', edge_nums, np.int64)):
+        np.save(getattr(ff, name).path_maker(),
+                np.frombuffer(column, dtype=dtype))
+    np.save(ff.values.path_maker(),
+            np.frombuffer(values, dtype=np.float64).reshape(
+                len(edge_nums), len(others)))
+
+
+def _binary_columns(ff):
+    with ff.header.path_maker().open() as fh:
+        header = json.load(fh)
+    with ff.names.path_maker().open() as fh:
+        names = np.array([line.rstrip('\n') for line in fh], dtype=object)
+    columns = {key: np.load(getattr(ff, key).path_maker(), mmap_mode='r')
+               for key in ('multiplicities', 'name_offsets',
+                           'placement_offsets', 'edge_nums', 'values')}
+    return header, names, columns
+
+
+def _read_binary(ff):
+    """Return the header of a PlacementsBinaryDirFmt and an iterator of its
+    pqueries, as they would appear in a jplace document.
+    """
+    header, names, columns = _binary_columns(ff)
+    edge_idx = header['fields'].index('edge_num')
+
+    def _value(value):
+        return None if math.isnan(value) else value
+
+    def pqueries():
+        name_offsets = columns['name_offsets']
+        placement_offsets = columns['placement_offsets']
+        for i in range(len(name_offsets) - 1):
+            placements = []
+            for row in range(placement_offsets[i], placement_offsets[i + 1]):
+                placement = [_value(v)
+                             for v in columns['values'][row].tolist()]
+                placement.insert(edge_idx, int(columns['edge_nums'][row]))
+                placements.append(placement)
+
+            pquery_names = slice(name_offsets[i], name_offsets[i + 1])
+            multiplicities = columns['multiplicities'][pquery_names].tolist()
+            if any(math.isnan(m) for m in multiplicities):
+                pquery = {'p': placements,
+                          'n': names[pquery_names].tolist()}
+            else:
+                pquery = {'p': placements,
+                          'nm': [[name, int(m) if m.is_integer() else m]
+                                 for name, m in zip(names[pquery_names],
+                                                    multiplicities)]}
+            yield pquery
+
+    return header, pqueries()
+
+
+def _binary_frame(ff):
+    """Tabulate a PlacementsBinaryDirFmt like _placements_frame, without
+    reading the placements into Python objects.
+    """
+    header, names, columns = _binary_columns(ff)
+    fields = header['fields']
+    name_offsets = np.asarray(columns['name_offsets'])
+    placement_offsets = np.asarray(columns['placement_offsets'])
+
+    # pquery of every name and placement
+    n_placements = np.diff(placement_offsets)
+    name_pquery = np.repeat(np.arange(len(n_placements)),
+                            np.diff(name_offsets))
+    placement_pquery = np.repeat(np.arange(len(n_placements)), n_placements)
+
+    # One row per name and placement of its pquery, names first
+    per_name = n_placements[name_pquery]
+    starts = np.repeat(placement_offsets[name_pquery], per_name)
+    within = np.arange(per_name.sum()) - np.repeat(
+        np.cumsum(per_name) - per_name, per_name)
+    rows = starts + within
+
+    def _field(field):
+        if field == 'edge_num':
+            return np.asarray(columns['edge_nums'])
+        if field not in fields:
+            return np.full(len(placement_pquery), np.nan)
+        i = fields.index(field)
+        if i > fields.index('edge_num'):
+            i -= 1
+        return np.asarray(columns['values'][:, i])
+
+    lwrs = _field('like_weight_ratio')
+    order = np.lexsort((np.arange(len(lwrs)), -lwrs, placement_pquery))
+    ranks = np.empty(len(lwrs), dtype=np.int64)
+    ranks[order] = (np.arange(len(lwrs)) -
+                    placement_offsets[placement_pquery[order]] + 1)
+
+    frame = {'fragment': np.repeat(names, per_name)}
+    for field, dtype in _COLUMNS:
+        frame[field] = _field(field).astype(dtype)[rows]
+    frame['rank'] = ranks[rows]
+    return pd.DataFrame(frame)
+
+
+def _graft(placements, reference_labels=None):
+    """Build an insertion tree from a jplace document.
+
+    Every fragment is attached to the edge of its placement with the highest
+    like weight ratio, following the same conventions as guppy's ``tog``
+    subcommand: the attachment point is ``distal_length`` away from the node
+    below the edge, and the fragment hangs off it by ``pendant_length``.
+    ``placements['placements']`` can be any iterable of pqueries, it is
+    consumed once.
+
+    Returns an _ArrayTree. Joints and fragments are appended to the arrays
+    of the reference tree and linked in place of the edges they split, so
+    the cost of grafting does not depend on the size of the reference.
+    """
+    tree, edges = _read_jplace_tree(placements['tree'])
+    if reference_labels is not None:
+        _relabel(tree, reference_labels)
+
+    fields = placements['fields']
+    edge_idx = fields.index('edge_num')
+    lwr_idx = fields.index('like_weight_ratio')
+    distal_idx = fields.index('distal_length')
+    pendant_idx = fields.index('pendant_length')
+
+    grafts = collections.defaultdict(list)
+    for pquery in placements['placements']:
+        if not pquery['p']:
+            continue
+        best = _best_placement(pquery['p'], lwr_idx)
+        grafts[best[edge_idx]].append(
+            (best[distal_idx], best[pendant_idx], _pquery_names(pquery)))
+
+    parent = tree.parent.tolist()
+    first_child = tree.first_child.tolist()
+    next_sibling = tree.next_sibling.tolist()
+    lengths = tree.length.tolist()
+    names = tree.names
+    root = tree.root
+
+    def _node(name, length):
+        parent.append(-1)
+        first_child.append(-1)
+        next_sibling.append(-1)
+        lengths.append(length)
+        names.append(name)
+        return len(names) - 1
+
+    for edge_num, attachments in grafts.items():
+        node = edges[edge_num]
+        up, after = parent[node], next_sibling[node]
+        length = lengths[node] if lengths[node] == lengths[node] else 0.0
+
+        # Walk upwards from the node below the edge, inserting one joint per
+        # fragment, ordered by their distance from that node. Sorting on all
+        # attributes keeps the result independent of the input order.
+        below, offset = node, 0.0
+        for distal, pendant, fragments in sorted(attachments):
+            distal = min(max(distal, offset), length)
+            lengths[below] = distal - offset
+            joint = _node(None, math.nan)
+            first_child[joint] = previous = below
+            parent[below] = joint
+            for name in fragments:
+                tip = _node(name, pendant)
+                parent[tip] = joint
+                next_sibling[previous] = previous = tip
+            next_sibling[previous] = -1
+            below, offset = joint, distal
+        lengths[below] = length - offset
+
+        # Put the topmost joint in place of the node
+        parent[below], next_sibling[below] = up, after
+        if up == -1:
+            root = below
+        elif first_child[up] == node:
+            first_child[up] = below
+        else:
+            sibling = first_child[up]
+            while next_sibling[sibling] != node:
+                sibling = next_sibling[sibling]
+            next_sibling[sibling] = below
+
+    # Same convention as _add_missing_branch_length
+    lengths = np.nan_to_num(np.array(lengths, dtype=np.float64), nan=0.0)
+    return _ArrayTree(parent, first_child, next_sibling, lengths, names, root)
@@ -6,17 +6,25 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import gzip
 import json
+import shutil
+
+import pandas as pd
 
 from .plugin_setup import plugin
-from ._format import PlacementsFormat
+from ._format import (PlacementsFormat, PlacementsBinaryDirFmt,
+                      PlacementsGzFormat)
+from ._jplace import _write_jplace, _dump_placements
+from ._placements import (PlacementsIterator, _read_placements,
+                          _placements_frame, _iter_pqueries, _write_binary,
+                          _read_binary, _binary_frame)
 
 
 @plugin.register_transformer
 def _1(data: dict) -> PlacementsFormat:
     ff = PlacementsFormat()
-    with open(str(ff), 'w') as fp:
-        fp.write(json.dumps(data))
+    _dump_placements(data, str(ff))
     return ff
 
 
@@ -24,3 +32,87 @@ def _1(data: dict) -> PlacementsFormat:
 def _2(ff: PlacementsFormat) -> dict:
     with ff.open() as fh:
         return json.load(fh)
+
+
+@plugin.register_transformer
+def _3(ff: PlacementsFormat) -> PlacementsIterator:
+    return PlacementsIterator(_read_placements(str(ff)))
+
+
+@plugin.register_transformer
+def _4(ff: PlacementsFormat) -> pd.DataFrame:
+    return _placements_frame(_read_placements(str(ff)))
+
+
+@plugin.register_transformer
+def _5(ff: PlacementsFormat) -> PlacementsBinaryDirFmt:
+    header, pqueries = _iter_pqueries(str(ff))
+    result = PlacementsBinaryDirFmt()
+    _write_binary(header, pqueries, result)
+    return result
+
+
+@plugin.register_transformer
+def _6(df: PlacementsBinaryDirFmt) -> PlacementsFormat:
+    header, pqueries = _read_binary(df)
+    ff = PlacementsFormat()
+    with open(str(ff), 'w') as fp:
+        _write_jplace(fp, header, pqueries)
+    return ff
+
+
+@plugin.register_transformer
+def _7(data: dict) -> PlacementsBinaryDirFmt:
+    result = PlacementsBinaryDirFmt()
+    _write_binary(data, data['placements'], result)
+    return result
+
+
+@plugin.register_transformer
+def _8(df: PlacementsBinaryDirFmt) -> dict:
+    header, pqueries = _read_binary(df)
+    return dict(header, placements=list(pqueries))
+
+
+@plugin.register_transformer
+def _9(df: PlacementsBinaryDirFmt) -> pd.DataFrame:
+    return _binary_frame(df)
+
+
+@plugin.register_transformer
+def _10(ff: PlacementsFormat) -> PlacementsGzFormat:
+    result = PlacementsGzFormat()
+    with ff.path.open('rb') as src, gzip.open(str(result), 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    return result
+
+
+@plugin.register_transformer
+def _11(ff: PlacementsGzFormat) -> PlacementsFormat:
+    result = PlacementsFormat()
+    with gzip.open(str(ff), 'rb') as src, result.path.open('wb') as dst:
+        shutil.copyfileobj(src, dst)
+    return result
+
+
+@plugin.register_transformer
+def _12(data: dict) -> PlacementsGzFormat:
+    ff = PlacementsGzFormat()
+    _dump_placements(data, str(ff), compress=True)
+    return ff
+
+
+@plugin.register_transformer
+def _13(ff: PlacementsGzFormat) -> dict:
+    with gzip.open(str(ff), 'rt') as fh:
+        return json.load(fh)
+
+
+@plugin.register_transformer
+def _14(ff: PlacementsGzFormat) -> PlacementsIterator:
+    return PlacementsIterator(_read_placements(str(ff), opener=gzip.open))
+
+
+@plugin.register_transformer
+def _15(ff: PlacementsGzFormat) -> pd.DataFrame:
+    return _placements_frame(_read_placements(str(ff), opener=gzip.open))
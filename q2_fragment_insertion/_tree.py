@@ -0,0 +1,407 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import array
+import io
+import math
+import re
+import sys
+
+import numpy as np
+
+from q2_fragment_insertion._newick import _tokenize, _label, _strip_comments
+
+
+# jplace reference trees annotate every edge with its number, either in
+# square (jplace version 1 & 2) or curly brackets (version 3).
+_EDGE_NUM = re.compile(r'[\[{](\d+)[\]}]')
+_BRACES = re.compile(r'\{[^}]*\}')
+# A structure character or the description of a node, as long as it does not
+# contain nested comments
+_NODE_TOKEN = re.compile(
+    r"[(),;]|(?:[^(),;'\[\]]+|'(?:[^']|'')*'|\[[^\[\]']*\])+")
+_NODE_END = frozenset('(),;')
+# Descriptions without quotes, comments or braces need no further decoding
+_SIMPLE_DESCRIPTION = re.compile(r"['\[{]")
+# Labels containing any of these are quoted when writing, like scikit-bio
+_QUOTED = re.compile(r'[,:_;()\[\]]')
+# Number of nodes formatted before writing them out
+_WRITE_BATCH = 10000
+
+
+class _ArrayTree:
+    """A rooted tree stored as arrays indexed by node.
+
+    Nodes are integers. ``parent`` holds the parent of every node (-1 for
+    the root), ``first_child`` and ``next_sibling`` link the children of a
+    node in order (-1 if there is none), ``length`` holds branch lengths
+    (NaN if missing) and ``names`` the node labels (None if missing). Trees
+    read from Newick are numbered in preorder, grafting appends new nodes at
+    the end.
+
+    Compared to scikit-bio's TreeNode, no Python object is created per node,
+    which makes a difference for trees with hundreds of thousands of tips.
+    """
+
+    def __init__(self, parent, first_child, next_sibling, length, names,
+                 root=0):
+        self.parent = np.asarray(parent, dtype=np.int64)
+        self.first_child = np.asarray(first_child, dtype=np.int64)
+        self.next_sibling = np.asarray(next_sibling, dtype=np.int64)
+        self.length = np.asarray(length, dtype=np.float64)
+        self.names = list(names)
+        self.root = root
+        self._preorder = None
+        self._positions = None
+        self._sizes = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def children(self, node):
+        child = int(self.first_child[node])
+        while child != -1:
+            yield child
+            child = int(self.next_sibling[child])
+
+    def preorder(self):
+        """Return all nodes in preorder, parents before their children.
+
+        The result is cached, the tree must not be changed afterwards.
+        """
+        if self._preorder is None:
+            first_child = self.first_child.tolist()
+            next_sibling = self.next_sibling.tolist()
+            order, stack = [], [self.root]
+            while stack:
+                node = stack.pop()
+                order.append(node)
+                child, children = first_child[node], []
+                while child != -1:
+                    children.append(child)
+                    child = next_sibling[child]
+                stack.extend(reversed(children))
+            self._preorder = np.array(order, dtype=np.int64)
+        return self._preorder
+
+    def postorder(self):
+        """Return all nodes in postorder, children before their parents.
+
+        Unlike the reversed preorder, children are visited in order.
+        """
+        first_child = self.first_child.tolist()
+        next_sibling = self.next_sibling.tolist()
+        order, stack = [], [self.root]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            child = first_child[node]
+            while child != -1:
+                stack.append(child)
+                child = next_sibling[child]
+        return np.array(order[::-1], dtype=np.int64)
+
+    def subtree_sizes(self):
+        """Return the number of nodes in the subtree of every node."""
+        if self._sizes is None:
+            parent = self.parent.tolist()
+            sizes = [1] * len(self)
+            # Any order with children before their parents will do
+            for node in self.preorder()[::-1].tolist():
+                if node != self.root:
+                    sizes[parent[node]] += sizes[node]
+            self._sizes = np.array(sizes, dtype=np.int64)
+        return self._sizes
+
+    def subtree(self, node):
+        """Return the nodes of the subtree of a node, in preorder.
+
+        Subtrees are contiguous in the preorder, so this is a slice.
+        """
+        preorder = self.preorder()
+        if self._positions is None:
+            self._positions = np.empty(len(self), dtype=np.int64)
+            self._positions[preorder] = np.arange(len(self))
+        start = self._positions[node]
+        return preorder[start:start + self.subtree_sizes()[node]]
+
+    def tips(self):
+        return np.flatnonzero(self.first_child == -1)
+
+    def lowest_common_ancestor(self, nodes):
+        parent = self.parent
+        lineage, node = [], nodes[0]
+        while node != -1:
+            lineage.append(node)
+            node = int(parent[node])
+        height = {node: i for i, node in enumerate(lineage)}
+
+        lowest = 0
+        for node in nodes[1:]:
+            while node not in height:
+                node = int(parent[node])
+            lowest = max(lowest, height[node])
+        return lineage[lowest]
+
+    @property
+    def nbytes(self):
+        """Approximate memory used by the tree, including its names."""
+        arrays = (self.parent, self.first_child, self.next_sibling,
+                  self.length)
+        names = {id(name): name for name in self.names if name is not None}
+        return (sum(array.nbytes for array in arrays) +
+                sys.getsizeof(self.names) +
+                sum(sys.getsizeof(name) for name in names.values()))
+
+    def write(self, fp):
+        with open(fp, 'w') as fh:
+            _write_newick(self, fh)
+
+
+def _node_tokens(text):
+    """Split Newick text into the structure characters ( ) , ; and the
+    descriptions of nodes in between, i.e. their labels, branch lengths and
+    comments.
+    """
+    end = boundary = 0
+    description = None
+    for match in _NODE_TOKEN.finditer(text):
+        if match.start() != end:
+            break
+        end = match.end()
+        token = match.group()
+        if token in _NODE_END:
+            if description is not None:
+                yield description
+                description = None
+            yield token
+            boundary = end
+        else:
+            description = token
+    else:
+        if end == len(text):
+            if description is not None:
+                yield description
+            return
+
+    # Nested comments are beyond the regular expression, fall back to the
+    # general tokenizer after the last structure character.
+    description = []
+    for token in _tokenize(io.StringIO(text[boundary:])):
+        if token in _NODE_END:
+            if description:
+                yield ''.join(description)
+                description = []
+            yield token
+        else:
+            description.append(token)
+    if description:
+        yield ''.join(description)
+
+
+def _description(text, convert_underscores):
+    """Decode the label and branch length of a node description."""
+    if _SIMPLE_DESCRIPTION.search(text) is None:
+        label, _, length = text.partition(':')
+        label = label.strip() or None
+        if label is not None and convert_underscores:
+            label = label.replace('_', ' ')
+    else:
+        label, length = [], None
+        for token in _tokenize(io.StringIO(text)):
+            if length is not None:
+                length.append(token)
+            elif token == ':':
+                length = []
+            else:
+                label.append(token)
+        label = _label(_BRACES.sub('', ''.join(label)), convert_underscores)
+        length = _BRACES.sub('', _strip_comments(''.join(length or [])))
+    length = length.strip()
+    return label, float(length) if length else math.nan
+
+
+def _read_newick(fh, convert_underscores=True, edge_nums=False):
+    """Parse a Newick tree into an _ArrayTree.
+
+    Labels are decoded like scikit-bio does, and nodes with the same label
+    share one string. If ``edge_nums`` is true, the tree is read as the
+    reference tree of a jplace document and an array holding the edge
+    number of every node (-1 if it has none) is returned along with the
+    tree.
+    """
+    parent, first_child, next_sibling, last_child, edges = (
+        array.array('q') for _ in range(5))
+    length, names, interned = array.array('d'), [], {}
+
+    def _node():
+        node = len(names)
+        up = stack[-1] if stack else -1
+        parent.append(up)
+        first_child.append(-1)
+        next_sibling.append(-1)
+        last_child.append(-1)
+        length.append(math.nan)
+        names.append(None)
+        edges.append(-1)
+        if up != -1:
+            if last_child[up] == -1:
+                first_child[up] = node
+            else:
+                next_sibling[last_child[up]] = node
+            last_child[up] = node
+        return node
+
+    stack = []
+    current, node_start = None, True
+    for token in _node_tokens(fh.read()):
+        if token == '(':
+            current = _node()
+            stack.append(current)
+            node_start = True
+        elif token == ',' or token == ')':
+            if node_start:
+                # A tip without a label
+                _node()
+            node_start = token == ','
+            if token == ')':
+                if not stack:
+                    raise ValueError('Unbalanced parentheses in Newick tree.')
+                current = stack.pop()
+        elif token == ';':
+            break
+        else:
+            if node_start:
+                if not token.strip():
+                    continue
+                current = _node()
+                node_start = False
+            if current is None:
+                continue
+            if edge_nums:
+                match = _EDGE_NUM.search(token)
+                if match is not None:
+                    edges[current] = int(match.group(1))
+                    token = token[:match.start()] + token[match.end():]
+            name, length[current] = _description(token, convert_underscores)
+            if name is not None:
+                names[current] = interned.setdefault(name, name)
+
+    if stack:
+        raise ValueError('Unbalanced parentheses in Newick tree.')
+    if not names:
+        raise ValueError('The Newick tree is empty.')
+
+    tree = _ArrayTree(parent, first_child, next_sibling, length, names)
+    # Nodes are numbered in the order they appear
+    tree._preorder = np.arange(len(tree))
+    if edge_nums:
+        return tree, np.array(edges, dtype=np.int64)
+    return tree
+
+
+def _read_jplace_tree(tree_str):
+    """Parse the reference tree of a jplace document.
+
+    Returns the tree and a dict mapping each edge number to the node at the
+    distal end of that edge.
+    """
+    tree, edges = _read_newick(io.StringIO(tree_str),
+                               convert_underscores=False, edge_nums=True)
+    nodes = np.flatnonzero(edges != -1)
+    # The root does not need to carry an edge number
+    if len(nodes) not in (len(tree), len(tree) - 1):
+        raise ValueError('The jplace reference tree contains %i nodes but %i '
+                         'edge numbers.' % (len(tree), len(nodes)))
+    return tree, dict(zip(edges[nodes].tolist(), nodes.tolist()))
+
+
+def _format_label(name):
+    # Same rules as scikit-bio's Newick writer
+    escaped = name.replace("'", "''")
+    if _QUOTED.search(name):
+        return "'%s'" % escaped
+    return escaped.replace(' ', '_')
+
+
+def _write_newick(tree, fh):
+    """Write an _ArrayTree as Newick, formatted like scikit-bio does."""
+    first_child = tree.first_child.tolist()
+    next_sibling = tree.next_sibling.tolist()
+    parent = tree.parent.tolist()
+    length = tree.length.tolist()
+    names = tree.names
+
+    parts = []
+    node, done = tree.root, False
+    while not done:
+        child = first_child[node]
+        if child != -1:
+            parts.append('(')
+            node = child
+            continue
+
+        # Write the node and all ancestors it is the last descendant of
+        while True:
+            if names[node]:
+                parts.append(_format_label(names[node]))
+            if length[node] == length[node]:
+                parts.append(':%s' % length[node])
+            if node == tree.root:
+                done = True
+                break
+            if next_sibling[node] != -1:
+                parts.append(',')
+                node = next_sibling[node]
+                break
+            parts.append(')')
+            node = parent[node]
+
+        if len(parts) > _WRITE_BATCH:
+            fh.write(''.join(parts))
+            parts = []
+
+    parts.append(';\n')
+    fh.write(''.join(parts))
+
+
+def _save_tree(tree, fh):
+    """Store an _ArrayTree as .npz, which _load_saved_tree reads back
+    without any parsing.
+
+    Names are stored as UTF-8 in one buffer with their offsets.
+    """
+    encoded = [b'' if name is None else name.encode('utf-8')
+               for name in tree.names]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in encoded], out=offsets[1:])
+    np.savez(fh, parent=tree.parent, first_child=tree.first_child,
+             next_sibling=tree.next_sibling, length=tree.length,
+             root=np.array(tree.root), preorder=tree.preorder(),
+             names=np.frombuffer(b''.join(encoded), dtype=np.uint8),
+             name_offsets=offsets,
+             unnamed=np.array([name is None for name in tree.names]))
+
+
+def _load_saved_tree(fh):
+    with np.load(fh) as data:
+        buffer = data['names'].tobytes()
+        offsets = data['name_offsets'].tolist()
+        unnamed = data['unnamed'].tolist()
+        names, interned = [], {}
+        for i, missing in enumerate(unnamed):
+            if missing:
+                names.append(None)
+            else:
+                name = buffer[offsets[i]:offsets[i + 1]].decode('utf-8')
+                names.append(interned.setdefault(name, name))
+        tree = _ArrayTree(data['parent'], data['first_child'],
+                          data['next_sibling'], data['length'], names,
+                          int(data['root']))
+        tree._preorder = data['preorder']
+    return tree
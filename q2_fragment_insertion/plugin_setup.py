@@ -8,7 +8,7 @@
 import importlib
 
 import qiime2.plugin
-from qiime2.plugin import Citations
+from qiime2.plugin import Citations, List
 from q2_types.feature_data import FeatureData, Sequence, Taxonomy
 from q2_types.feature_table import FeatureTable, Frequency
 from q2_types.tree import Phylogeny, Rooted
@@ -16,7 +16,10 @@ from q2_types.tree import Phylogeny, Rooted
 import q2_fragment_insertion
 from q2_fragment_insertion._type import Placements, SeppReferenceDatabase
 from q2_fragment_insertion._format import (
-    PlacementsFormat, PlacementsDirFmt, SeppReferenceDirFmt, RAxMLinfoFormat)
+    PlacementsFormat, PlacementsDirFmt, SeppReferenceDirFmt, RAxMLinfoFormat,
+    SeppReferenceIndexFormat, PlacementsHeaderFormat, PlacementNamesFormat,
+    NumPyArrayFormat, PlacementsBinaryDirFmt, PlacementsGzFormat,
+    PlacementsGzDirFmt)
 
 
 citations = Citations.load('citations.bib', package='q2_fragment_insertion')
@@ -43,6 +46,9 @@ plugin.methods.register_function(
         'alignment_subset_size': qiime2.plugin.Int,
         'placement_subset_size': qiime2.plugin.Int,
         'debug': qiime2.plugin.Bool,
+        'placement_cache': qiime2.plugin.Str,
+        'shards': qiime2.plugin.Int % qiime2.plugin.Range(1, None),
+        'exact_match': qiime2.plugin.Bool,
     },
     outputs=[
         ('tree', Phylogeny[Rooted]),
@@ -70,7 +76,29 @@ plugin.methods.register_function(
                                  'blob/master/tutorial/sepp-tutorial.md#sample'
                                  '-datasets-default-parameters.',
         'debug': 'Collect additional run information to STDOUT for debugging. '
-                 'Temporary directories will not be removed if run fails.'
+                 'Temporary directories will not be removed if run fails.',
+        'placement_cache': 'Directory in which placements are kept across '
+                           'runs. Sequences that have been placed before '
+                           'with the same reference database and subset '
+                           'sizes are taken from this cache and only the '
+                           'remaining sequences are inserted by SEPP. The '
+                           'directory is created if it does not exist.',
+        'shards': 'Split the representative sequences into this many chunks '
+                  'and insert them with independent SEPP runs in parallel. '
+                  'The available threads are divided evenly between the '
+                  'runs. The resulting placements are merged, and the '
+                  'insertion tree is built from the merged placements.',
+        'exact_match': 'Place sequences that are identical to a stretch of '
+                       'one or more reference sequences directly as sisters '
+                       'of the corresponding reference tip (or of the most '
+                       'recent common ancestor of several such tips), and '
+                       'only insert the remaining sequences with SEPP. The '
+                       'placements metadata lists which sequences were '
+                       'placed this way. As there is no likelihood of such '
+                       'placements, they always report a likelihood of 0.0 '
+                       'and a like weight ratio of 1.0. Sequences shorter '
+                       'than 47 nucleotides or containing ambiguous '
+                       'nucleotides are always inserted by SEPP.',
     },
     output_descriptions={
         'tree': 'The tree with inserted feature data.',
@@ -83,6 +111,100 @@ plugin.methods.register_function(
 )
 
 
+plugin.methods.register_function(
+    function=q2_fragment_insertion.prepare_reference_database,
+    inputs={
+        'reference_database': SeppReferenceDatabase,
+    },
+    parameters={},
+    outputs=[
+        ('prepared_reference_database', SeppReferenceDatabase),
+    ],
+    input_descriptions={
+        'reference_database': 'The reference database to prepare.',
+    },
+    parameter_descriptions={},
+    output_descriptions={
+        'prepared_reference_database': 'The reference database together '
+                                       'with an index of precomputed '
+                                       'reference information.',
+    },
+    name='Prepare a reference database for repeated use with \'sepp\'.',
+    description='Precompute information that \'sepp\' otherwise derives '
+                'from the reference database on every run, i.e. a content '
+                'digest used by the placement cache, the internal node '
+                'labels of the reference phylogeny that are restored when '
+                'building insertion trees from merged placements and the '
+                'ungapped reference sequences searched for exact matches. The '
+                'prepared database can be used wherever the original '
+                'database is accepted.',
+)
+
+
+plugin.methods.register_function(
+    function=q2_fragment_insertion.merge_placements,
+    inputs={
+        'placements': List[Placements],
+        'reference_database': SeppReferenceDatabase,
+    },
+    parameters={},
+    outputs=[
+        ('tree', Phylogeny[Rooted]),
+        ('merged_placements', Placements),
+    ],
+    input_descriptions={
+        'placements': 'The placements to merge. They need to be the result '
+                      'of \'sepp\' runs with the same reference database.',
+        'reference_database': 'The reference database used for the '
+                              '\'sepp\' runs. If provided, the internal '
+                              'node labels of its phylogeny are restored in '
+                              'the insertion tree.',
+    },
+    parameter_descriptions={},
+    output_descriptions={
+        'tree': 'The reference tree with all merged fragments inserted.',
+        'merged_placements': 'The placements of all fragments of the '
+                             'inputs.',
+    },
+    name='Merge placements of several \'sepp\' runs.',
+    description='Combine the placements of fragments that were inserted '
+                'into the same reference phylogeny by separate \'sepp\' '
+                'runs, without rerunning SEPP, and build the insertion tree '
+                'of all of them. Fragments placed by several runs are kept '
+                'from the first input they occur in.',
+)
+
+
+plugin.methods.register_function(
+    function=q2_fragment_insertion.graft_placements,
+    inputs={
+        'placements': Placements,
+        'reference_database': SeppReferenceDatabase,
+    },
+    parameters={},
+    outputs=[
+        ('tree', Phylogeny[Rooted]),
+    ],
+    input_descriptions={
+        'placements': 'The placements to insert into their reference tree.',
+        'reference_database': 'The reference database used for the '
+                              '\'sepp\' run. If provided, the internal '
+                              'node labels of its phylogeny are restored in '
+                              'the insertion tree.',
+    },
+    parameter_descriptions={},
+    output_descriptions={
+        'tree': 'The reference tree with all fragments inserted.',
+    },
+    name='Build an insertion tree from placements.',
+    description='Insert every fragment into the reference tree of the '
+                'placements, on the edge of its placement with the highest '
+                'like weight ratio. Like \'sepp\', the fragment is attached '
+                'at the distal length of the placement and its branch has '
+                'the pendant length of the placement.',
+)
+
+
 plugin.methods.register_function(
     function=q2_fragment_insertion.classify_otus_experimental,
     inputs={
@@ -98,8 +220,23 @@ plugin.methods.register_function(
         'reference_taxonomy': 'Reference taxonomic table that maps every '
                               'OTU-ID into a taxonomic lineage string.',
     },
-    parameters={},
-    parameter_descriptions={},
+    parameters={
+        'method': qiime2.plugin.Str % qiime2.plugin.Choices(
+            ['subtree', 'distance']),
+        'max_distance': qiime2.plugin.Float % qiime2.plugin.Range(0, None),
+    },
+    parameter_descriptions={
+        'method': 'How to find the closest OTUs of a fragment. \'subtree\' '
+                  'takes all OTUs in the smallest sub-tree containing both '
+                  'the fragment and at least one OTU, ignoring branch '
+                  'lengths. \'distance\' takes the OTUs with the shortest '
+                  'path length to the fragment. In both cases, the lineage '
+                  'is the longest common prefix of the lineages of all OTUs '
+                  'found.',
+        'max_distance': 'Only with method \'distance\': fragments without '
+                        'any OTU within this path length are left '
+                        'unclassified.',
+    },
     outputs=[
         ('classification', FeatureData[Taxonomy]),
     ],
@@ -114,6 +251,87 @@ plugin.methods.register_function(
 )
 
 
+_CONFIDENCE_DESCRIPTION = (
+    'If given, combine all placements of a fragment, weighted by their like '
+    'weight ratio, instead of only using the placement with the highest '
+    'like weight ratio. Lineages are then truncated at the first rank whose '
+    'taxon is supported by less than this combined like weight ratio, which '
+    'is reported as the confidence of the classification.')
+
+
+plugin.methods.register_function(
+    function=q2_fragment_insertion.classify_paths_from_placements,
+    inputs={
+        'placements': Placements,
+        'reference_database': SeppReferenceDatabase,
+    },
+    input_descriptions={
+        'placements': 'The placements of the fragments to classify, i.e. the '
+                      'output of function \'sepp\'.',
+        'reference_database': 'The reference database used for the '
+                              '\'sepp\' run, whose phylogeny holds '
+                              'taxonomic labels on its internal nodes.',
+    },
+    parameters={
+        'confidence': qiime2.plugin.Float % qiime2.plugin.Range(
+            0, 1, inclusive_end=True),
+    },
+    parameter_descriptions={
+        'confidence': _CONFIDENCE_DESCRIPTION,
+    },
+    outputs=[
+        ('classification', FeatureData[Taxonomy]),
+    ],
+    output_descriptions={
+        'classification': 'Taxonomic lineages for the placed fragments.',
+    },
+    name='Obtain taxonomic lineages from placements, by collecting the '
+         'taxonomic labels of the ancestors in the reference phylogeny.',
+    description='Assign every fragment the taxonomic labels (those '
+                'containing \'__\') of its ancestors in the insertion tree '
+                'of the placements, without building or reading that tree. '
+                'Lineages are looked up per edge of the reference phylogeny, '
+                'and the table of lineages is reused for further placements '
+                'against the same reference.',
+)
+
+
+plugin.methods.register_function(
+    function=q2_fragment_insertion.classify_otus_from_placements,
+    inputs={
+        'placements': Placements,
+        'reference_taxonomy': FeatureData[Taxonomy],
+    },
+    input_descriptions={
+        'placements': 'The placements of the fragments to classify, i.e. the '
+                      'output of function \'sepp\'.',
+        'reference_taxonomy': 'Reference taxonomic table that maps every '
+                              'OTU-ID into a taxonomic lineage string.',
+    },
+    parameters={
+        'confidence': qiime2.plugin.Float % qiime2.plugin.Range(
+            0, 1, inclusive_end=True),
+    },
+    parameter_descriptions={
+        'confidence': _CONFIDENCE_DESCRIPTION,
+    },
+    outputs=[
+        ('classification', FeatureData[Taxonomy]),
+    ],
+    output_descriptions={
+        'classification': 'Taxonomic lineages for the placed fragments.',
+    },
+    name='Experimental: Obtain taxonomic lineages from placements, by '
+         'finding closest OTU in reference phylogeny.',
+    description='Experimental: Classify fragments like '
+                '\'classify-otus-experimental\' would for the insertion tree '
+                'of the placements, without building or reading that tree. '
+                'Lineages are looked up per edge of the reference phylogeny, '
+                'and the table of lineages is reused for further placements '
+                'against the same reference and taxonomy.',
+)
+
+
 plugin.methods.register_function(
     function=q2_fragment_insertion.filter_features,
     inputs={
@@ -167,8 +385,14 @@ plugin.methods.register_function(
 importlib.import_module('q2_fragment_insertion._transformer')
 
 
+# Placements are stored as PlacementsDirFmt. The compressed and binary
+# formats are alternatives to import and view them as, converted by
+# transformers.
 plugin.register_formats(PlacementsFormat, PlacementsDirFmt, RAxMLinfoFormat,
-                        SeppReferenceDirFmt)
+                        SeppReferenceDirFmt, SeppReferenceIndexFormat,
+                        PlacementsHeaderFormat, PlacementNamesFormat,
+                        NumPyArrayFormat, PlacementsBinaryDirFmt,
+                        PlacementsGzFormat, PlacementsGzDirFmt)
 plugin.register_semantic_types(Placements, SeppReferenceDatabase)
 plugin.register_semantic_type_to_format(Placements,
                                         artifact_format=PlacementsDirFmt)
@@ -5,3 +5,17 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
+
+import os
+from unittest import mock
+
+
+class CacheDirMixin:
+    # Keep validation markers out of the user's cache directory
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(
+            os.environ,
+            {'XDG_CACHE_HOME': os.path.join(self.temp_dir.name, 'cache')})
+        patcher.start()
+        self.addCleanup(patcher.stop)
@@ -0,0 +1,72 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_fragment_insertion._exact import ExactMatchIndex, _read_ungapped
+
+
+class TestExactMatchIndex(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.references = dict(
+            _read_ungapped(self.get_data_path('ref-seqs-aligned.fasta')))
+        self.index = ExactMatchIndex(self.references.items())
+
+    def test_read_ungapped(self):
+        self.assertEqual(set(self.references),
+                         {'426848', '42684', '342684', '295053', '879972'})
+        for seq in self.references.values():
+            self.assertNotIn('-', seq)
+            self.assertNotIn('.', seq)
+            self.assertEqual(seq, seq.upper())
+        self.assertTrue(self.references['426848'].startswith(
+            'AGAGTTTGATCCTGGCTCAGGATGAACGCTAGCGG'))
+
+    def test_find(self):
+        for id_, seq in self.references.items():
+            for start, length in [(0, 47), (3, 150), (500, 253),
+                                  (len(seq) - 120, 120)]:
+                fragment = seq[start:start + length]
+                exp = sorted(r for r, s in self.references.items()
+                             if fragment in s)
+                self.assertIn(id_, exp)
+                self.assertEqual(sorted(self.index.find(fragment)), exp)
+
+    def test_find_shared_fragment(self):
+        # A conserved stretch found in several references
+        fragment = self.references['426848'][749:799]
+        exp = sorted(r for r, s in self.references.items() if fragment in s)
+
+        self.assertGreater(len(exp), 1)
+        self.assertEqual(sorted(self.index.find(fragment)), exp)
+
+    def test_find_no_match(self):
+        fragment = self.references['42684'][200:350]
+        fragment = fragment[:70] + ('A' if fragment[70] != 'A' else 'C') + \
+            fragment[71:]
+
+        self.assertEqual(self.index.find(fragment), [])
+
+    def test_find_too_short(self):
+        self.assertEqual(self.index.find(self.references['42684'][200:246]),
+                         [])
+
+    def test_find_ambiguous(self):
+        fragment = self.references['42684'][200:350]
+
+        self.assertEqual(self.index.find(fragment[:-1] + 'N'), [])
+
+    def test_find_across_references(self):
+        # Concatenation of two references must not be reported as a match
+        fragment = self.references['426848'][-60:] + \
+            self.references['42684'][:60]
+
+        self.assertEqual(self.index.find(fragment), [])
@@ -6,11 +6,20 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import gzip
+import json
 import os
 import shutil
+from unittest import mock
+
+import numpy as np
 
 from q2_fragment_insertion._format import (
-    PlacementsFormat, SeppReferenceDirFmt, RAxMLinfoFormat)
+    PlacementsFormat, SeppReferenceDirFmt, RAxMLinfoFormat,
+    SeppReferenceIndexFormat, PlacementsBinaryDirFmt, PlacementsGzFormat)
+
+from q2_fragment_insertion._cache import ValidationCache, _reference_digest
+from q2_fragment_insertion.tests import CacheDirMixin
 
 from qiime2.plugin.testing import TestPluginBase
 from qiime2.plugin import ValidationError
@@ -41,8 +50,108 @@ class TestPlacementFormat(TestPluginBase):
                                     'found.*placements.*tree'):
             fmt.validate()
 
+    def test_validate_negative_malformed(self):
+        filepath = os.path.join(self.temp_dir.name, 'placements.json')
+        with open(self.get_data_path('placements.json')) as fh:
+            data = fh.read()
+        with open(filepath, 'w') as fh:
+            fh.write(data.replace('"version":', '"version"'))
+        fmt = PlacementsFormat(filepath, mode='r')
+
+        with self.assertRaisesRegex(ValidationError, 'Expected'):
+            fmt.validate()
+
+
+class TestPlacementsGzFormat(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    def _gzip(self, name):
+        filepath = os.path.join(self.temp_dir.name, name + '.gz')
+        with open(self.get_data_path(name), 'rb') as src, \
+                gzip.open(filepath, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        return filepath
+
+    def test_validate_positive(self):
+        fmt = PlacementsGzFormat(self._gzip('placements.json'), mode='r')
+
+        fmt.validate()
+
+    def test_validate_negative_not_compressed(self):
+        fmt = PlacementsGzFormat(self.get_data_path('placements.json'),
+                                 mode='r')
+
+        with self.assertRaisesRegex(ValidationError, 'gzip'):
+            fmt.validate()
+
+    def test_validate_negative_array(self):
+        fmt = PlacementsGzFormat(self._gzip('root-array.json'), mode='r')
+
+        with self.assertRaisesRegex(ValidationError, 'JSON object'):
+            fmt.validate()
+
+    def test_validate_negative_missing_keys(self):
+        fmt = PlacementsGzFormat(self._gzip('placements-missing.json'),
+                                 mode='r')
+
+        with self.assertRaisesRegex(ValidationError,
+                                    'found.*placements.*tree'):
+            fmt.validate()
+
+    def test_validate_negative_truncated(self):
+        filepath = self._gzip('placements.json')
+        with open(filepath, 'rb') as fh:
+            data = fh.read()
+        with open(filepath, 'wb') as fh:
+            fh.write(data[:len(data) // 2])
+        fmt = PlacementsGzFormat(filepath, mode='r')
 
-class TestSeppReferenceDirFmt(TestPluginBase):
+        with self.assertRaises(ValidationError):
+            fmt.validate()
+
+
+class TestPlacementsBinaryDirFmt(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    def setUp(self):
+        super().setUp()
+        transformer = self.get_transformer(PlacementsFormat,
+                                           PlacementsBinaryDirFmt)
+        binary = transformer(PlacementsFormat(
+            self.get_data_path('placements.json'), mode='r'))
+        self.path = os.path.join(self.temp_dir.name, 'binary')
+        shutil.copytree(str(binary), self.path)
+
+    def test_validate_positive(self):
+        fmt = PlacementsBinaryDirFmt(self.path, mode='r')
+
+        fmt.validate()
+
+    def test_validate_negative_shape(self):
+        np.save(os.path.join(self.path, 'values.npy'), np.zeros((3, 4)))
+        fmt = PlacementsBinaryDirFmt(self.path, mode='r')
+
+        with self.assertRaisesRegex(ValidationError, 'values of shape'):
+            fmt.validate()
+
+    def test_validate_negative_offsets(self):
+        np.save(os.path.join(self.path, 'name-offsets.npy'),
+                np.array([0, 2, 1], dtype=np.int64))
+        fmt = PlacementsBinaryDirFmt(self.path, mode='r')
+
+        with self.assertRaisesRegex(ValidationError, 'Offsets'):
+            fmt.validate()
+
+    def test_validate_negative_not_numpy(self):
+        shutil.copy(self.get_data_path('placements.json'),
+                    os.path.join(self.path, 'edge-nums.npy'))
+        fmt = PlacementsBinaryDirFmt(self.path, mode='r')
+
+        with self.assertRaisesRegex(ValidationError, 'NumPy'):
+            fmt.validate()
+
+
+class TestSeppReferenceDirFmt(CacheDirMixin, TestPluginBase):
     package = 'q2_fragment_insertion.tests'
 
     def _cp_fp(self, frm, to):
@@ -81,8 +190,68 @@ class TestSeppReferenceDirFmt(TestPluginBase):
                                     'missing in the alignment.*b.*c'):
             fmt.validate()
 
+    def _write_index(self, digest):
+        with open(os.path.join(self.temp_dir.name, 'reference-index.json'),
+                  'w') as fh:
+            json.dump({'digest': digest, 'tips': 0, 'labels': {}}, fh)
+
+    def test_validate_index(self):
+        self._cp_fp('ref-tree.nwk', 'tree.nwk')
+        self._cp_fp('ref-seqs-aligned.fasta', 'aligned-dna-sequences.fasta')
+        self._cp_fp('ref-raxml-info.txt', 'raxml-info.txt')
+        fmt = SeppReferenceDirFmt(self.temp_dir.name, mode='r')
+        self._write_index(_reference_digest(fmt))
+
+        fmt._validate_('min')
+
+    def test_validate_negative_stale_index(self):
+        self._cp_fp('ref-tree.nwk', 'tree.nwk')
+        self._cp_fp('ref-seqs-aligned.fasta', 'aligned-dna-sequences.fasta')
+        self._cp_fp('ref-raxml-info.txt', 'raxml-info.txt')
+        fmt = SeppReferenceDirFmt(self.temp_dir.name, mode='r')
+        self._write_index(_reference_digest(fmt))
+        fmt._validate_('min')
+
+        # The tree changes after the index was written
+        with open(os.path.join(self.temp_dir.name, 'tree.nwk'), 'a') as fh:
+            fh.write('\n')
+
+        for level in ('min', 'max'):
+            with self.assertRaisesRegex(ValidationError, 'index does not'):
+                fmt._validate_(level)
+
+    def _write_alignment(self, replace):
+        with open(self.get_data_path('ref-seqs-aligned.fasta')) as fh:
+            lines = fh.readlines()
+        lines[3] = replace(lines[3])
+        with open(os.path.join(self.temp_dir.name,
+                               'aligned-dna-sequences.fasta'), 'w') as fh:
+            fh.writelines(lines)
+
+    def test_validate_negative_unaligned(self):
+        self._cp_fp('ref-tree.nwk', 'tree.nwk')
+        self._write_alignment(lambda line: line[10:])
+        self._cp_fp('ref-raxml-info.txt', 'raxml-info.txt')
+
+        fmt = SeppReferenceDirFmt(self.temp_dir.name, mode='r')
+
+        with self.assertRaisesRegex(ValidationError,
+                                    "'42684' has length 7672.*7682"):
+            fmt._validate_('max')
+
+    def test_validate_negative_alphabet(self):
+        self._cp_fp('ref-tree.nwk', 'tree.nwk')
+        self._write_alignment(lambda line: 'X' + line[1:])
+        self._cp_fp('ref-raxml-info.txt', 'raxml-info.txt')
+
+        fmt = SeppReferenceDirFmt(self.temp_dir.name, mode='r')
 
-class TestRAxMLinfoFormat(TestPluginBase):
+        with self.assertRaisesRegex(ValidationError, "'42684'.*'X'"):
+            fmt._validate_('max')
+        fmt._validate_('min')
+
+
+class TestRAxMLinfoFormat(CacheDirMixin, TestPluginBase):
     package = 'q2_fragment_insertion.tests'
 
     def test_validate_positive(self):
@@ -98,3 +267,109 @@ class TestRAxMLinfoFormat(TestPluginBase):
 
         with self.assertRaisesRegex(ValidationError, 'Missing.*RAxML'):
             fmt.validate()
+
+
+class TestValidationCache(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = os.path.join(self.temp_dir.name, 'cache')
+        self.fp = os.path.join(self.temp_dir.name, 'raxml-info.txt')
+        shutil.copy(self.get_data_path('ref-raxml-info.txt'), self.fp)
+
+    def test_validation_cache(self):
+        cache = ValidationCache('kind', [self.fp], self.cache_dir)
+        self.assertFalse(cache.is_valid('min'))
+
+        cache.add('min')
+
+        cache = ValidationCache('kind', [self.fp], self.cache_dir)
+        self.assertTrue(cache.is_valid('min'))
+        self.assertFalse(cache.is_valid('max'))
+        self.assertFalse(ValidationCache('other', [self.fp],
+                                         self.cache_dir).is_valid('min'))
+
+    def test_validation_cache_max_implies_min(self):
+        ValidationCache('kind', [self.fp], self.cache_dir).add('max')
+
+        cache = ValidationCache('kind', [self.fp], self.cache_dir)
+        self.assertTrue(cache.is_valid('min'))
+
+    def test_validation_cache_content(self):
+        ValidationCache('kind', [self.fp], self.cache_dir).add('max')
+
+        # Same content elsewhere
+        moved = os.path.join(self.temp_dir.name, 'moved')
+        os.mkdir(moved)
+        shutil.copy(self.fp, moved)
+        cache = ValidationCache('kind', [os.path.join(moved,
+                                                      'raxml-info.txt')],
+                                self.cache_dir)
+        self.assertTrue(cache.is_valid('max'))
+
+        # Different content
+        with open(self.fp, 'a') as fh:
+            fh.write('changed')
+        cache = ValidationCache('kind', [self.fp], self.cache_dir)
+        self.assertFalse(cache.is_valid('max'))
+
+    def test_validation_cache_read_only(self):
+        blocker = os.path.join(self.temp_dir.name, 'blocker')
+        with open(blocker, 'w'):
+            pass
+
+        cache = ValidationCache('kind', [self.fp], blocker)
+        cache.add('max')
+
+        self.assertFalse(cache.is_valid('max'))
+
+    def test_format_uses_cache(self):
+        with mock.patch.dict(os.environ, {'XDG_CACHE_HOME': self.cache_dir}):
+            fmt = RAxMLinfoFormat(self.fp, mode='r')
+            fmt.validate()
+
+            with mock.patch.object(RAxMLinfoFormat,
+                                   '_validate_content') as validate:
+                RAxMLinfoFormat(self.fp, mode='r').validate()
+            validate.assert_not_called()
+
+    def test_format_cache_disabled(self):
+        with mock.patch.dict(os.environ, {
+                'XDG_CACHE_HOME': self.cache_dir,
+                'Q2_FRAGMENT_INSERTION_NO_VALIDATION_CACHE': '1'}):
+            RAxMLinfoFormat(self.fp, mode='r').validate()
+
+            with mock.patch.object(RAxMLinfoFormat,
+                                   '_validate_content') as validate:
+                RAxMLinfoFormat(self.fp, mode='r').validate()
+            validate.assert_called_once_with('max')
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+
+class TestSeppReferenceIndexFormat(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    def _write(self, content):
+        fp = os.path.join(self.temp_dir.name, 'reference-index.json')
+        with open(fp, 'w') as fh:
+            fh.write(content)
+        return SeppReferenceIndexFormat(fp, mode='r')
+
+    def test_validate_positive(self):
+        fmt = self._write('{"digest": "abc", "tips": 42, "labels": {}}')
+
+        fmt.validate()
+        self.assertTrue(True)
+
+    def test_validate_negative_missing_keys(self):
+        fmt = self._write('{"digest": "abc"}')
+
+        with self.assertRaisesRegex(ValidationError, 'Expected.*labels'):
+            fmt.validate()
+
+    def test_validate_negative_invalid_json(self):
+        fmt = self._write('{"digest": ')
+
+        with self.assertRaisesRegex(ValidationError, 'not a valid JSON'):
+            fmt.validate()
@@ -6,9 +6,13 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import io
+import json
 import os.path
+import random
 import shutil
 import unittest
+from unittest import mock
 
 import biom
 import skbio
@@ -20,8 +24,30 @@ from qiime2.plugin.testing import TestPluginBase
 
 from q2_types.feature_data import DNAIterator
 
-
-class TestSepp(TestPluginBase):
+from q2_fragment_insertion._format import (PlacementsFormat,
+                                           SeppReferenceDirFmt)
+from q2_fragment_insertion._insertion import (merge_placements,
+                                              graft_placements,
+                                              classify_paths_from_placements,
+                                              classify_otus_from_placements,
+                                              _weighted_lineage,
+                                              _unique_pqueries,
+                                              _split_fasta,
+                                              _load_reference_index,
+                                              _exact_placements,
+                                              _node_index,
+                                              _ancestral_lineages,
+                                              _NearestOTUs,
+                                              _PatristicOTUs,
+                                              _RankMatrix,
+                                              _subset_observations)
+from q2_fragment_insertion._exact import _read_ungapped
+from q2_fragment_insertion._tree import _read_newick
+from q2_fragment_insertion._cache import _reference_digest
+from q2_fragment_insertion.tests import CacheDirMixin
+
+
+class TestSepp(CacheDirMixin, TestPluginBase):
     package = 'q2_fragment_insertion.tests'
 
     def _cp_fp(self, frm, to):
@@ -59,6 +85,299 @@ class TestSepp(TestPluginBase):
                          {'tree', 'placements', 'metadata', 'version',
                           'fields'})
 
+    def test_sepp_placement_cache(self):
+        cache_dir = os.path.join(self.temp_dir.name, 'cache')
+
+        exp_tree_artifact, exp_placements_artifact = self.action(
+            self.input_sequences, self.reference_db,
+            placement_cache=cache_dir)
+
+        with mock.patch('q2_fragment_insertion._insertion._run') as run:
+            obs_tree_artifact, obs_placements_artifact = self.action(
+                self.input_sequences, self.reference_db,
+                placement_cache=cache_dir)
+            run.assert_not_called()
+
+        exp_placements = {
+            pquery['nm'][0][0]: pquery['p'] for pquery
+            in exp_placements_artifact.view(dict)['placements']}
+        obs_placements = {
+            pquery['nm'][0][0]: pquery['p'] for pquery
+            in obs_placements_artifact.view(dict)['placements']}
+        self.assertEqual(obs_placements, exp_placements)
+        # Nothing but SEPP's placements, as without shards
+        obs_metadata = obs_placements_artifact.view(dict)['metadata']
+        exp_metadata = exp_placements_artifact.view(dict)['metadata']
+        self.assertNotIn('placement_paths', obs_metadata)
+        self.assertEqual(set(obs_metadata), set(exp_metadata))
+
+        exp_tree = exp_tree_artifact.view(skbio.TreeNode)
+        obs_tree = obs_tree_artifact.view(skbio.TreeNode)
+        self.assertEqual({n.name for n in obs_tree.tips()},
+                         {n.name for n in exp_tree.tips()})
+
+    def test_sepp_exact_match(self):
+        references = dict(_read_ungapped(
+            self.get_data_path('ref-seqs-aligned.fasta')))
+        fp = os.path.join(self.temp_dir.name, 'seqs.fasta')
+        shutil.copy(self.get_data_path('seqs-to-query.fasta'), fp)
+        with open(fp, 'a') as fh:
+            fh.write('>exact\n%s\n' % references['42684'][500:650])
+        input_sequences = Artifact.import_data('FeatureData[Sequence]', fp)
+
+        obs_tree_artifact, obs_placements_artifact = self.action(
+            input_sequences, self.reference_db, exact_match=True)
+
+        obs_placements = obs_placements_artifact.view(dict)
+        paths = obs_placements['metadata']['placement_paths']
+        self.assertEqual(paths['exact-match'], ['exact'])
+        self.assertNotIn('exact', paths['sepp'])
+
+        tree = obs_tree_artifact.view(skbio.TreeNode)
+        self.assertEqual({c.name for c in tree.find('exact').parent.children},
+                         {'exact', '42684'})
+        self.assertEqual(tree.find('exact').length, 0)
+
+    def test_sepp_sharded(self):
+        exp_tree_artifact, exp_placements_artifact = self.action(
+            self.input_sequences, self.reference_db)
+        obs_tree_artifact, obs_placements_artifact = self.action(
+            self.input_sequences, self.reference_db, shards=3, threads=3)
+
+        exp_placements = {
+            pquery['nm'][0][0]: pquery['p'] for pquery
+            in exp_placements_artifact.view(dict)['placements']}
+        obs_placements = {
+            pquery['nm'][0][0]: pquery['p'] for pquery
+            in obs_placements_artifact.view(dict)['placements']}
+        self.assertEqual(obs_placements, exp_placements)
+        # Nothing but SEPP's placements, as without shards
+        obs_metadata = obs_placements_artifact.view(dict)['metadata']
+        exp_metadata = exp_placements_artifact.view(dict)['metadata']
+        self.assertNotIn('placement_paths', obs_metadata)
+        self.assertEqual(set(obs_metadata), set(exp_metadata))
+
+        exp_tree = exp_tree_artifact.view(skbio.TreeNode)
+        obs_tree = obs_tree_artifact.view(skbio.TreeNode)
+        self.assertEqual({n.name for n in obs_tree.tips()},
+                         {n.name for n in exp_tree.tips()})
+
+
+class TestPrepareReferenceDatabase(CacheDirMixin, TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    def _cp_fp(self, frm, to):
+        shutil.copy(self.get_data_path(frm),
+                    os.path.join(self.temp_dir.name, to))
+
+    def setUp(self):
+        super().setUp()
+        self.action = self.plugin.actions['prepare_reference_database']
+
+        self._cp_fp('ref-tree.nwk', 'tree.nwk')
+        self._cp_fp('ref-seqs-aligned.fasta', 'aligned-dna-sequences.fasta')
+        self._cp_fp('ref-raxml-info.txt', 'raxml-info.txt')
+
+        self.reference_db = Artifact.import_data('SeppReferenceDatabase',
+                                                 self.temp_dir.name)
+
+    def test_prepare_reference_database(self):
+        obs_artifact, = self.action(self.reference_db)
+        obs_artifact.validate(level='max')
+
+        obs = obs_artifact.view(SeppReferenceDirFmt)
+        self.assertEqual(
+            dict(_read_ungapped(str(obs.ungapped.path_maker()))),
+            dict(_read_ungapped(str(obs.alignment.path_maker()))))
+        index = _load_reference_index(obs)
+        self.assertEqual(index['digest'], _reference_digest(obs))
+        self.assertEqual(sorted(index['labels'].values()),
+                         ['0.995', '1.000'])
+
+        for name in ('tree.nwk', 'aligned-dna-sequences.fasta',
+                     'raxml-info.txt'):
+            with open(os.path.join(str(obs), name)) as fh:
+                obs_content = fh.read()
+            with open(os.path.join(self.temp_dir.name, name)) as fh:
+                self.assertEqual(obs_content, fh.read())
+
+    def test_unprepared_reference_database(self):
+        self.assertIsNone(
+            _load_reference_index(self.reference_db.view(SeppReferenceDirFmt)))
+
+
+class TestMergePlacements(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    def setUp(self):
+        super().setUp()
+        with open(self.get_data_path('placements.json')) as fh:
+            self.placements = json.load(fh)
+
+        shutil.copy(self.get_data_path('ref-tree.nwk'),
+                    os.path.join(self.temp_dir.name, 'tree.nwk'))
+        self.reference_db = SeppReferenceDirFmt(self.temp_dir.name, mode='r')
+
+    def _write(self, name, pqueries, **changes):
+        data = dict(self.placements, placements=pqueries, **changes)
+        fp = os.path.join(self.temp_dir.name, name)
+        with open(fp, 'w') as fh:
+            json.dump(data, fh)
+        return PlacementsFormat(fp, mode='r')
+
+    def test_merge_placements(self):
+        pqueries = self.placements['placements']
+        duplicate = dict(pqueries[4], p=pqueries[0]['p'])
+        first = self._write('first.json', pqueries[:5])
+        second = self._write('second.json', [duplicate] + pqueries[5:])
+
+        tree, merged = merge_placements([first, second], self.reference_db)
+
+        with open(str(merged)) as fh:
+            obs = json.load(fh)
+        self.assertEqual(obs, self.placements)
+
+        tree = skbio.TreeNode.read(str(tree))
+        self.assertEqual({tip.name for tip in tree.tips()},
+                         {tip.name for tip in skbio.TreeNode.read(
+                             self.get_data_path('ref-tree.nwk')).tips()} |
+                         {name for pquery in pqueries
+                          for name, _ in pquery['nm']})
+        # Internal node labels are restored from the reference
+        self.assertEqual(sorted(n.name for n in tree.non_tips()
+                                if n.name is not None),
+                         ['0.995', '1.000'])
+
+    def test_merge_placements_paths(self):
+        pqueries = self.placements['placements']
+        first = self._write('first.json', pqueries[:2])
+        second = self._write('second.json', pqueries[2:4], metadata={
+            'placement_paths': {'sepp': [pqueries[2]['nm'][0][0]],
+                                'exact-match': [pqueries[3]['nm'][0][0]]}})
+
+        _, merged = merge_placements([first, second])
+
+        with open(str(merged)) as fh:
+            obs = json.load(fh)
+        self.assertEqual(obs['metadata']['placement_paths'], {
+            'sepp': [pquery['nm'][0][0] for pquery in pqueries[:3]],
+            'exact-match': [pqueries[3]['nm'][0][0]]})
+
+    def test_merge_placements_different_trees(self):
+        first = self._write('first.json', self.placements['placements'])
+        second = self._write('second.json', [], tree=self.placements[
+            'tree'].replace('0.11110068', '0.1'))
+
+        with self.assertRaisesRegex(ValueError, 'same reference tree'):
+            merge_placements([first, second])
+
+    def test_unique_pqueries(self):
+        seen = {'a'}
+        pqueries = [{'p': [[0]], 'nm': [['a', 1], ['b', 2]]},
+                    {'p': [[1]], 'n': ['b']},
+                    {'p': [[2]], 'n': ['c', 'd', 'c']}]
+
+        obs = list(_unique_pqueries(pqueries, seen))
+
+        self.assertEqual(obs, [{'p': [[0]], 'nm': [['b', 2]]},
+                               {'p': [[2]], 'n': ['c', 'd']}])
+        self.assertEqual(seen, {'a', 'b', 'c', 'd'})
+        self.assertEqual(pqueries[0]['nm'], [['a', 1], ['b', 2]])
+
+
+class TestGraftPlacements(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    def test_graft_placements(self):
+        placements = PlacementsFormat(self.get_data_path('placements.json'),
+                                      mode='r')
+
+        obs = skbio.TreeNode.read(str(graft_placements(placements)),
+                                  convert_underscores=False)
+
+        with open(self.get_data_path('placements.json')) as fh:
+            pqueries = json.load(fh)['placements']
+        self.assertEqual({tip.name for tip in obs.tips()},
+                         {tip.name for tip in skbio.TreeNode.read(
+                             self.get_data_path('ref-tree.nwk')).tips()} |
+                         {name for pquery in pqueries
+                          for name, _ in pquery['nm']})
+        self.assertEqual(
+            sorted(n.name for n in obs.non_tips() if n.name is not None),
+            ['UQrYOlnDN0000011_000', 'UQrYOlnDN0000020_995'])
+
+
+class TestExactPlacements(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    def setUp(self):
+        super().setUp()
+        with open(self.get_data_path('placements.json')) as fh:
+            self.placements = json.load(fh)
+
+    def test_exact_placements(self):
+        obs = _exact_placements({'a': ['42684'],
+                                 'b': ['426848', '342684'],
+                                 'c': ['not-a-tip']}, self.placements)
+
+        self.assertEqual(obs, [{'p': [[0, 0.0, 1.0, 0.0, 0.0]],
+                                'nm': [['a', 1]]},
+                               {'p': [[6, 0.0, 1.0, 0.0, 0.0]],
+                                'nm': [['b', 1]]}])
+
+    def test_exact_placements_independent(self):
+        # Other fragments of the run do not change the values
+        obs = _exact_placements({'a': ['42684']}, self.placements)
+        alone = _exact_placements({'a': ['42684']},
+                                  dict(self.placements, placements=[]))
+
+        self.assertEqual(obs, [{'p': [[0, 0.0, 1.0, 0.0, 0.0]],
+                                'nm': [['a', 1]]}])
+        self.assertEqual(obs, alone)
+
+    def test_exact_placements_root(self):
+        # The most recent common ancestor is the root, which has no edge
+        obs = _exact_placements({'a': ['42684', '879972']}, self.placements)
+
+        self.assertEqual(obs, [{'p': [[2, 0.0, 1.0, 0.05229867, 0.0]],
+                                'nm': [['a', 1]]}])
+
+
+class TestSplitFasta(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    def test_split_fasta(self):
+        obs = _split_fasta(self.get_data_path('seqs-to-query.fasta'), 4,
+                           self.temp_dir.name)
+
+        self.assertEqual(len(obs), 3)
+        ids = []
+        for chunk in obs:
+            with open(chunk) as fh:
+                ids.append([line[1:].strip() for line in fh
+                            if line.startswith('>')])
+        self.assertEqual(ids, [['testseqa', 'testseqb', 'testseqc'],
+                               ['testseqd', 'testseqe', 'testseqf'],
+                               ['testseqg', 'testseqh', 'testseqi']])
+
+    def test_split_fasta_more_shards_than_sequences(self):
+        obs = _split_fasta(self.get_data_path('seqs-to-query.fasta'), 20,
+                           self.temp_dir.name)
+
+        self.assertEqual(len(obs), 9)
+
+    def test_split_fasta_leading_lines(self):
+        fp = os.path.join(self.temp_dir.name, 'seqs.fasta')
+        with open(fp, 'w') as fh:
+            fh.write('\n\n>a\nACGT\n>b\nACGT\n')
+
+        obs = _split_fasta(fp, 2, self.temp_dir.name)
+
+        with open(obs[0]) as fh:
+            self.assertEqual(fh.read(), '>a\nACGT\n')
+        with open(obs[1]) as fh:
+            self.assertEqual(fh.read(), '>b\nACGT\n')
+
 
 class TestClassify(TestPluginBase):
     package = 'q2_fragment_insertion.tests'
@@ -103,6 +422,357 @@ class TestClassify(TestPluginBase):
                                     'Not all OTUs.*1 feature.*\n.*879972'):
             self.action(self.input_sequences, self.tree, wrong_taxa)
 
+    def test_classify_otus_experimental_distance(self):
+        exp = self.action(self.input_sequences, self.tree,
+                          self.taxonomy)[0].view(pd.DataFrame)
+
+        obs_artifact, = self.action(self.input_sequences, self.tree,
+                                    self.taxonomy, method='distance')
+        obs = obs_artifact.view(pd.DataFrame)
+
+        # testseqd and testseqg are closer to OTU 426848 than to the OTUs
+        # of their smallest sub-tree
+        for feature in ('testseqd', 'testseqg'):
+            self.assertEqual(obs.loc[feature, 'Taxon'],
+                             'k__Bacteria; p__Bacteroidetes; c__VC2_1_Bac22; '
+                             'o__; f__; g__; s__')
+        assert_frame_equal(obs.drop(['testseqd', 'testseqg']),
+                           exp.drop(['testseqd', 'testseqg']))
+
+    def test_classify_otus_experimental_max_distance(self):
+        obs_artifact, = self.action(self.input_sequences, self.tree,
+                                    self.taxonomy, method='distance',
+                                    max_distance=0.3)
+        obs = obs_artifact.view(pd.DataFrame)
+
+        self.assertEqual(
+            sorted(obs['Taxon'].dropna().index),
+            ['testseqe', 'testseqf', 'testseqg', 'testseqi'])
+
+    def test_max_distance_with_subtree(self):
+        with self.assertRaisesRegex(ValueError, 'maximum distance'):
+            self.action(self.input_sequences, self.tree, self.taxonomy,
+                        max_distance=0.3)
+
+
+class TestClassifyFromPlacements(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.placements = PlacementsFormat(
+            self.get_data_path('placements.json'), mode='r')
+        self.taxonomy = pd.read_csv(self.get_data_path('ref-taxa.tsv'),
+                                    sep='\t', index_col=0)
+
+        with open(self.get_data_path('ref-tree.nwk')) as fh:
+            tree = fh.read()
+        with open(os.path.join(self.temp_dir.name, 'tree.nwk'), 'w') as fh:
+            fh.write(tree.replace('1.000:', "'p__A':").replace(
+                '0.995:', "'p__B; c__C':"))
+        self.reference_db = SeppReferenceDirFmt(self.temp_dir.name, mode='r')
+
+    def test_classify_otus_from_placements(self):
+        obs = classify_otus_from_placements(self.placements, self.taxonomy)
+
+        streptococcus = ('k__Bacteria; p__Firmicutes; c__Bacilli; '
+                         'o__Lactobacillales; f__Streptococcaceae; '
+                         'g__Streptococcus; s__')
+        self.assertEqual(obs['Taxon'].to_dict(), {
+            'testseqa': 'k__Bacteria; p__Bacteroidetes',
+            'testseqb': streptococcus,
+            'testseqc': 'k__Bacteria; p__Proteobacteria',
+            'testseqd': streptococcus,
+            'testseqe': streptococcus,
+            'testseqf': 'k__Bacteria; p__Proteobacteria; '
+                        'c__Betaproteobacteria; o__Neisseriales; '
+                        'f__Neisseriaceae; g__; s__',
+            'testseqg': 'k__Bacteria; p__Bacteroidetes; c__Bacteroidia; '
+                        'o__Bacteroidales; f__; g__; s__',
+            'testseqh': 'k__Bacteria; p__Bacteroidetes',
+            'testseqi': 'k__Bacteria; p__Proteobacteria; '
+                        'c__Gammaproteobacteria; o__Enterobacteriales; '
+                        'f__Enterobacteriaceae; g__; s__'})
+        self.assertEqual(list(obs.columns), ['Taxon'])
+
+    def test_classify_otus_from_placements_confidence(self):
+        obs = classify_otus_from_placements(self.placements, self.taxonomy,
+                                            confidence=0.9)
+
+        self.assertEqual(list(obs.columns), ['Taxon', 'Confidence'])
+        # The best placement of testseqe is not supported by the others
+        self.assertEqual(obs.loc['testseqe', 'Taxon'], 'k__Bacteria')
+        self.assertAlmostEqual(obs.loc['testseqe', 'Confidence'], 1.0)
+        self.assertEqual(obs.loc['testseqg', 'Taxon'],
+                         'k__Bacteria; p__Bacteroidetes')
+        self.assertAlmostEqual(obs.loc['testseqi', 'Confidence'], 0.95160925)
+
+    def test_classify_otus_from_placements_null_lwr(self):
+        with open(self.get_data_path('placements.json')) as fh:
+            placements = json.load(fh)
+        # testseqa's best placement, on edge 6, loses its like weight ratio
+        placements['placements'][1]['p'][0][2] = None
+        fp = os.path.join(self.temp_dir.name, 'placements.json')
+        with open(fp, 'w') as fh:
+            json.dump(placements, fh)
+
+        obs = classify_otus_from_placements(PlacementsFormat(fp, mode='r'),
+                                            self.taxonomy)
+
+        # The placement on edge 3 is the best one left
+        self.assertEqual(obs.loc['testseqa', 'Taxon'],
+                         obs.loc['testseqb', 'Taxon'])
+
+    def test_classify_otus_from_placements_mismatched_taxonomy(self):
+        wrong_taxonomy = pd.read_csv(
+            self.get_data_path('another-ref-taxa.tsv'), sep='\t', index_col=0)
+
+        with self.assertRaisesRegex(ValueError,
+                                    'Not all OTUs.*1 feature.*\n.*879972'):
+            classify_otus_from_placements(self.placements, wrong_taxonomy)
+
+    def test_classify_paths_from_placements(self):
+        obs = classify_paths_from_placements(self.placements,
+                                             self.reference_db)
+
+        self.assertEqual(obs['Taxon'].to_dict(), {
+            'testseqa': '', 'testseqb': '', 'testseqc': '', 'testseqd': '',
+            'testseqe': '', 'testseqf': 'p__B; c__C', 'testseqg': 'p__A',
+            'testseqh': '', 'testseqi': 'p__B; c__C'})
+
+    def test_classify_paths_from_placements_mismatched_reference(self):
+        directory = os.path.join(self.temp_dir.name, 'another')
+        os.mkdir(directory)
+        shutil.copy(self.get_data_path('another-ref-tree.nwk'),
+                    os.path.join(directory, 'tree.nwk'))
+        wrong_db = SeppReferenceDirFmt(directory, mode='r')
+
+        with self.assertRaisesRegex(ValueError, 'reference phylogeny'):
+            classify_paths_from_placements(self.placements, wrong_db)
+
+    def test_classify_paths_from_placements_confidence(self):
+        obs = classify_paths_from_placements(self.placements,
+                                             self.reference_db,
+                                             confidence=0.9)
+
+        self.assertEqual(obs.loc['testseqf', 'Taxon'], 'p__B; c__C')
+        self.assertEqual(obs.loc['testseqg', 'Taxon'], '')
+        self.assertAlmostEqual(obs.loc['testseqi', 'Confidence'], 0.95160925)
+
+    def test_weighted_lineage(self):
+        lineages = ['k__A; p__B; c__C', 'k__A; p__B; c__D', 'k__A; p__E',
+                    None]
+
+        self.assertEqual(
+            _weighted_lineage(lineages, [0.5, 0.2, 0.2, 0.1], 0.6),
+            ('k__A; p__B', 0.7))
+        self.assertEqual(
+            _weighted_lineage(lineages, [0.5, 0.2, 0.2, 0.1], 0.5),
+            ('k__A; p__B; c__C', 0.5))
+        self.assertEqual(
+            _weighted_lineage(lineages, [0.1, 0.1, 0.1, 0.7], 0.5),
+            ('', 1.0))
+
+
+class TestNodeIndex(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    def test_node_index(self):
+        tree = _read_newick(io.StringIO('((a,b)x,(c,x)x,a2)r;'))
+
+        obs = _node_index(tree)
+
+        self.assertEqual({name: tree.names[node]
+                          for name, node in obs.items()},
+                         {'a': 'a', 'b': 'b', 'c': 'c', 'x': 'x', 'a2': 'a2',
+                          'r': 'r'})
+        # The tip named x, not one of the internal nodes
+        self.assertEqual(tree.first_child[obs['x']], -1)
+        self.assertEqual(obs['r'], tree.root)
+
+
+class TestAncestralLineages(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    def test_ancestral_lineages(self):
+        tree = _read_newick(io.StringIO(
+            "(((a,b)'g__x',c)'k__y',(d,'e__')f)'r';"),
+            convert_underscores=False)
+
+        obs = _ancestral_lineages(tree)
+
+        self.assertEqual(obs['a'], 'k__y; g__x')
+        self.assertEqual(obs['c'], 'k__y')
+        self.assertEqual(obs['g__x'], 'k__y')
+        self.assertEqual(obs['d'], '')
+        self.assertEqual(obs['e__'], '')
+        self.assertEqual(obs['r'], '')
+
+    def test_ancestral_lineages_matches_ancestors(self):
+        tree = skbio.TreeNode.read(self.get_data_path('sepp-results.nwk'))
+        for i, node in enumerate(tree.non_tips(include_self=True)):
+            if i % 2 == 0:
+                node.name = 'n__%i' % i
+        fh = io.StringIO()
+        tree.write(fh)
+        fh.seek(0)
+
+        obs = _ancestral_lineages(_read_newick(fh))
+
+        for tip in tree.tips():
+            exp = [a.name for a in tip.ancestors()
+                   if a.name is not None and '__' in a.name]
+            self.assertEqual(obs[tip.name], '; '.join(reversed(exp)))
+
+
+class TestNearestOTUs(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.tree = _read_newick(
+            io.StringIO('((((f1,f2)i,a),(b,c)),(f3,(d,e)));'))
+
+    def test_nearest_otus(self):
+        obs = _NearestOTUs(self.tree, {'a', 'b', 'd', 'e'})
+
+        self.assertEqual(obs['f1'], ['a'])
+        self.assertEqual(obs['f2'], ['a'])
+        self.assertEqual(sorted(obs['f3']), ['d', 'e'])
+        self.assertEqual(obs['a'], ['a'])
+        self.assertEqual(obs['i'], ['a'])
+        self.assertNotIn('x', obs)
+
+    def test_nearest_otus_distant(self):
+        obs = _NearestOTUs(self.tree, {'b'})
+
+        self.assertEqual(obs['f1'], ['b'])
+        self.assertEqual(obs['f3'], ['b'])
+        self.assertEqual(obs['c'], ['b'])
+
+    def test_nearest_otus_none(self):
+        obs = _NearestOTUs(self.tree, set())
+
+        self.assertEqual(obs['f1'], [])
+
+    def test_nearest_otus_random_trees(self):
+        # compare with walking up the skbio tree from the node, and
+        # traversing the whole sub-tree at every level until an OTU is found
+        def brute_force(node, otus):
+            for ancestor in [node] + node.ancestors():
+                found = [n.name for n in ancestor.postorder()
+                         if n.name in otus]
+                if found:
+                    return found
+            return []
+
+        rng = random.Random(42)
+        for _ in range(25):
+            nodes = [skbio.TreeNode(name='t%i' % i)
+                     for i in range(rng.randint(1, 40))]
+            while len(nodes) > 1:
+                size = rng.randint(2, min(3, len(nodes)))
+                children = rng.sample(nodes, size)
+                nodes = [n for n in nodes if n not in children]
+                nodes.append(skbio.TreeNode(children=children))
+            skbio_tree = nodes[0]
+            for i, node in enumerate(skbio_tree.non_tips(include_self=True)):
+                node.name = 'i%i' % i
+            names = [n.name for n in skbio_tree.traverse(include_self=True)]
+            otus = set(rng.sample(names, rng.randint(0, len(names))))
+
+            obs = _NearestOTUs(_read_newick(io.StringIO(str(skbio_tree))),
+                               otus)
+
+            for node in skbio_tree.traverse(include_self=True):
+                self.assertEqual(sorted(obs[node.name]),
+                                 sorted(brute_force(node, otus)))
+
+
+class TestPatristicOTUs(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.tree = _read_newick(io.StringIO(
+            '(((f1:5,a:1):0.1,b:0.1):1,(f2:1,(c:1,d:1):1):1);'))
+        self.lineages = pd.Series({'a': 'k__A; p__B', 'b': 'k__A; p__C',
+                                   'c': 'k__A; p__D; c__E',
+                                   'd': 'k__A; p__D; c__F'})
+
+    def test_patristic_otus(self):
+        obs = _PatristicOTUs(self.tree, self.lineages)
+
+        # b is closer to f1 than its sister a
+        self.assertEqual(obs['f1'], 'k__A; p__C')
+        # c and d are at the same distance of f2
+        self.assertEqual(obs['f2'], 'k__A; p__D')
+        self.assertEqual(obs['a'], 'k__A; p__B')
+        self.assertNotIn('x', obs)
+
+    def test_patristic_otus_max_distance(self):
+        obs = _PatristicOTUs(self.tree, self.lineages, max_distance=4)
+
+        self.assertTrue(pd.isna(obs['f1']))
+        self.assertEqual(obs['f2'], 'k__A; p__D')
+
+    def test_patristic_otus_none(self):
+        obs = _PatristicOTUs(self.tree, pd.Series(dtype=object))
+
+        self.assertTrue(pd.isna(obs['f1']))
+
+
+class TestRankMatrix(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.ranks = _RankMatrix(pd.Series(
+            ['k__A; p__B; c__C', 'k__A; p__B', 'k__A;p__X; c__C',
+             'k__A; p__B; c__D', ''],
+            index=['a', 'b', 'c', 'd', 'e']))
+
+    def test_consensus_single(self):
+        self.assertEqual(self.ranks.consensus(['a']), 'k__A; p__B; c__C')
+        self.assertEqual(self.ranks.consensus(['e']), '')
+
+    def test_consensus(self):
+        self.assertEqual(self.ranks.consensus(['a', 'd']), 'k__A; p__B')
+        self.assertEqual(self.ranks.consensus(['a', 'c']), 'k__A')
+        self.assertEqual(self.ranks.consensus(['a', 'b', 'd']), 'k__A; p__B')
+        self.assertEqual(self.ranks.consensus(['a', 'e']), '')
+
+    def test_common_prefix(self):
+        ranks = self.ranks
+        prefix = ranks.common_prefix(ranks.lineage('a'), ranks.lineage('d'))
+
+        self.assertEqual(ranks.join(prefix), 'k__A; p__B')
+        self.assertEqual(ranks.join(ranks.common_prefix(
+            prefix, ranks.lineage('c'))), 'k__A')
+        self.assertEqual(ranks.join(ranks.common_prefix(
+            ranks.lineage('a'), ranks.lineage('b'))), 'k__A; p__B')
+        self.assertEqual(ranks.common_prefix(None, prefix), prefix)
+        self.assertIsNone(ranks.common_prefix(None, None))
+
+
+class TestSubsetObservations(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    def test_subset_observations(self):
+        table = biom.load_table(self.get_data_path('table.json'))
+        table.add_metadata({id_: {'taxonomy': ['k__%s' % id_]}
+                            for id_ in table.ids(axis='observation')},
+                           axis='observation')
+        ids = table.ids(axis='observation')
+        mask = ids != 'testseqb'
+
+        obs = _subset_observations(table, table.matrix_data.tocsr(), mask)
+
+        exp = table.filter(ids[mask], axis='observation', inplace=False)
+        self.assertEqual(obs, exp)
+        self.assertEqual(obs.metadata('testseqc', axis='observation'),
+                         {'taxonomy': ['k__testseqc']})
+
 
 class TestFilter(TestPluginBase):
     package = 'q2_fragment_insertion.tests'
@@ -0,0 +1,153 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import gzip
+import io
+import json
+import os
+from unittest import mock
+
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_fragment_insertion._jplace import (_read_header, _write_jplace,
+                                           _dump_placements)
+
+
+class TestReadHeader(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    document = {
+        'tree': '((a:1{0},b:2{1}):0{2});',
+        'placements': [{'p': [[0, -1.5, 1.0, 0.1, 0.2]],
+                        'nm': [['x "[quoted]" \\', 1], ['}]', 2]]},
+                       {'p': [[1, None, 0.5, 0.1, 0.2]], 'n': ['{y']}],
+        'metadata': {'invocation': 'run-sepp.sh "a b" {c}'},
+        'version': 3,
+        'fields': ['edge_num', 'likelihood', 'like_weight_ratio',
+                   'distal_length', 'pendant_length'],
+    }
+
+    def _read(self, data, **kwargs):
+        return _read_header(io.BytesIO(data), **kwargs)
+
+    def test_keys(self):
+        keys, header = self._read(json.dumps(self.document).encode())
+
+        self.assertEqual(keys, list(self.document))
+        self.assertEqual(header, {})
+
+    def test_decode(self):
+        data = json.dumps(self.document, indent=2).encode()
+
+        keys, header = self._read(data, decode=('fields', 'version',
+                                                'metadata'))
+
+        self.assertEqual(header, {'fields': self.document['fields'],
+                                  'version': 3,
+                                  'metadata': self.document['metadata']})
+
+    def test_small_chunks(self):
+        data = json.dumps(self.document).encode()
+        for size in (1, 2, 3, 7):
+            with mock.patch('q2_fragment_insertion._jplace._CHUNK_SIZE',
+                            size):
+                keys, header = self._read(data, decode=('fields', 'tree'))
+
+            self.assertEqual(keys, list(self.document))
+            self.assertEqual(header['tree'], self.document['tree'])
+            self.assertEqual(header['fields'], self.document['fields'])
+
+    def test_data_file(self):
+        with open(self.get_data_path('placements.json'), 'rb') as fh:
+            keys, header = _read_header(fh, decode=('version',))
+
+        self.assertEqual(set(keys), {'tree', 'placements', 'metadata',
+                                     'version', 'fields'})
+        self.assertEqual(header, {'version': 1})
+
+    def test_empty_object(self):
+        self.assertEqual(self._read(b' { } \n'), ([], {}))
+
+    def test_not_an_object(self):
+        for data in (b'[0, 1, 2]', b'', b'"tree"'):
+            with self.assertRaisesRegex(ValueError, 'JSON object'):
+                self._read(data)
+
+    def test_malformed(self):
+        for data in (b'{"tree" "x"}', b'{"tree": [1, 2}', b'{"a": 1,}',
+                     b'{"a": 1} x', b'{"a": "b', b'{"a": 1'):
+            with self.assertRaises(ValueError):
+                self._read(data)
+
+
+class TestWriteJplace(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    def setUp(self):
+        super().setUp()
+        with open(self.get_data_path('placements.json')) as fh:
+            self.placements = json.load(fh)
+
+    def test_write_jplace(self):
+        header = {k: v for k, v in self.placements.items()
+                  if k != 'placements'}
+        fh = io.StringIO()
+
+        _write_jplace(fh, header, iter(self.placements['placements']))
+
+        self.assertEqual(json.loads(fh.getvalue()), self.placements)
+
+    def test_write_jplace_no_placements(self):
+        for header in ({}, {'foo': 1}, {'foo': 1, 'bar': [2]}):
+            fh = io.StringIO()
+            _write_jplace(fh, header)
+            self.assertEqual(json.loads(fh.getvalue()), header)
+
+        fh = io.StringIO()
+        _write_jplace(fh, {}, [])
+        self.assertEqual(json.loads(fh.getvalue()), {'placements': []})
+
+    def test_write_jplace_trailer(self):
+        header = {k: v for k, v in self.placements.items()
+                  if k not in ('placements', 'metadata')}
+        seen = []
+
+        def pqueries():
+            for pquery in self.placements['placements']:
+                seen.append(pquery['nm'][0][0])
+                yield pquery
+
+        fh = io.StringIO()
+        _write_jplace(fh, header, pqueries(),
+                      lambda: {'metadata': {'names': list(seen)}})
+
+        obs = json.loads(fh.getvalue())
+        self.assertEqual(obs['metadata']['names'],
+                         [pquery['nm'][0][0]
+                          for pquery in self.placements['placements']])
+        self.assertEqual(obs['placements'], self.placements['placements'])
+
+        fh = io.StringIO()
+        _write_jplace(fh, {}, trailer=lambda: {'foo': 1})
+        self.assertEqual(json.loads(fh.getvalue()), {'foo': 1})
+
+    def test_dump_placements(self):
+        fp = os.path.join(self.temp_dir.name, 'placements.json')
+
+        _dump_placements(self.placements, fp)
+
+        with open(fp) as fh:
+            self.assertEqual(json.load(fh), self.placements)
+
+    def test_dump_placements_compressed(self):
+        fp = os.path.join(self.temp_dir.name, 'placements.json.gz')
+
+        _dump_placements(self.placements, fp, compress=True)
+
+        with gzip.open(fp, 'rt') as fh:
+            self.assertEqual(json.load(fh), self.placements)
@@ -0,0 +1,127 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+import os
+import shutil
+from unittest import mock
+
+import skbio
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_fragment_insertion._newick import (_tokenize, _fill_missing_lengths,
+                                           _label, _tip_names)
+from q2_fragment_insertion._insertion import _add_missing_branch_length
+
+
+def _skbio_add_missing_branch_length(tree_str):
+    # The original implementation, kept as a reference
+    tree = skbio.TreeNode.read(io.StringIO(tree_str), format='newick')
+    for node in tree.preorder():
+        if node.length is None:
+            node.length = 0
+    fh = io.StringIO()
+    tree.write(fh)
+    return fh.getvalue()
+
+
+def _structure(tree_str):
+    def _node(node):
+        return (node.name, node.length,
+                tuple(_node(child) for child in node.children))
+    return _node(skbio.TreeNode.read(io.StringIO(tree_str)))
+
+
+class TestNewick(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    trees = [
+        '((a,b)c,d);',
+        '((a:1,b)c,(d:2.5,e:3)f:1)root:0.5;\n',
+        '(a,b,(c,d):1);',
+        "('a,b':1,'it''s (x)',c_d)'r;o:o[t]';",
+        '(a[&comment, with (structure)]:1,b[nested [comment]])[root];',
+        '(a , \n b\n)\n;',
+        '(,(,));',
+        '(a:1e-05,b:-2)x;',
+    ]
+
+    def assertSameTree(self, obs, exp):
+        self.assertEqual(_structure(obs), _structure(exp))
+
+    def test_tokenize_round_trip(self):
+        for tree_str in self.trees:
+            self.assertEqual(''.join(_tokenize(io.StringIO(tree_str))),
+                             tree_str)
+
+    def test_tokenize_keeps_quoted_labels_and_comments(self):
+        obs = list(_tokenize(io.StringIO(
+            "('a,b':1,c[x,y])'it''s;';")))
+        self.assertEqual(obs, ['(', "'a,b'", ':', '1', ',', 'c[x,y]', ')',
+                               "'it''s;'", ';'])
+
+    def test_tokenize_across_chunks(self):
+        tree_str = "('a,(b)':1,c[x,y(z)]:2,'''':3)'r;''o''t';\n"
+        with mock.patch('q2_fragment_insertion._newick._CHUNK_SIZE', 3):
+            obs = list(_tokenize(io.StringIO(tree_str)))
+        self.assertEqual(obs, list(_tokenize(io.StringIO(tree_str))))
+        self.assertEqual(''.join(obs), tree_str)
+
+    def test_fill_missing_lengths(self):
+        obs = io.StringIO()
+        _fill_missing_lengths(io.StringIO('((a,b:1)c,d)e;\n'), obs)
+        self.assertEqual(obs.getvalue(), '((a:0,b:1)c:0,d:0)e:0;\n')
+
+    def test_fill_missing_lengths_matches_skbio(self):
+        for tree_str in self.trees:
+            obs = io.StringIO()
+            _fill_missing_lengths(io.StringIO(tree_str), obs)
+            self.assertSameTree(obs.getvalue(),
+                                _skbio_add_missing_branch_length(tree_str))
+
+    def test_add_missing_branch_length(self):
+        for name in ('sepp-results.nwk', 'ref-tree.nwk',
+                     'another-ref-tree.nwk'):
+            tree_fp = os.path.join(self.temp_dir.name, name)
+            shutil.copy(self.get_data_path(name), tree_fp)
+            with open(tree_fp) as fh:
+                exp = _skbio_add_missing_branch_length(fh.read())
+
+            _add_missing_branch_length(tree_fp)
+
+            with open(tree_fp) as fh:
+                obs = fh.read()
+            self.assertSameTree(obs, exp)
+            self.assertEqual(os.listdir(self.temp_dir.name).count(name), 1)
+
+    def test_label(self):
+        self.assertEqual(_label(' a_b '), 'a b')
+        self.assertEqual(_label('a_b', convert_underscores=False), 'a_b')
+        self.assertEqual(_label("'a_b'"), 'a_b')
+        self.assertEqual(_label("'it''s'"), "it's")
+        self.assertEqual(_label("a[x]"), 'a')
+        self.assertEqual(_label("[x [y]] 'a[b]'"), 'a[b]')
+        self.assertIsNone(_label(' [x] '))
+        self.assertIsNone(_label(''))
+
+    def test_tip_names_matches_skbio(self):
+        for tree_str in self.trees:
+            tree = skbio.TreeNode.read(io.StringIO(tree_str))
+            exp = [tip.name for tip in tree.tips() if tip.name is not None]
+
+            self.assertEqual(sorted(_tip_names(io.StringIO(tree_str))),
+                             sorted(exp))
+
+    def test_tip_names_data(self):
+        for name in ('sepp-results.nwk', 'ref-tree.nwk',
+                     'another-ref-tree.nwk'):
+            tree = skbio.TreeNode.read(self.get_data_path(name))
+            exp = [tip.name for tip in tree.tips()]
+
+            with open(self.get_data_path(name)) as fh:
+                self.assertEqual(sorted(_tip_names(fh)), sorted(exp))
@@ -0,0 +1,137 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+import json
+
+import skbio
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_fragment_insertion._placements import (
+    _best_placement, _graft, _reference_labels, _relabel, _tree_signature)
+from q2_fragment_insertion._tree import (_read_jplace_tree, _read_newick,
+                                         _write_newick)
+
+
+def _graft_skbio(*args):
+    # Compare grafted trees as scikit-bio trees
+    fh = io.StringIO()
+    _write_newick(_graft(*args), fh)
+    fh.seek(0)
+    return skbio.TreeNode.read(fh, convert_underscores=False)
+
+
+class TestGraft(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    def setUp(self):
+        super().setUp()
+        with open(self.get_data_path('placements.json')) as fh:
+            self.placements = json.load(fh)
+        with open(self.get_data_path('ref-tree.nwk')) as fh:
+            self.reference_labels = _reference_labels(
+                _read_newick(fh, convert_underscores=False))
+
+    def test_read_jplace_tree(self):
+        tree, edges = _read_jplace_tree(self.placements['tree'])
+
+        self.assertEqual(sorted(edges), list(range(8)))
+        self.assertEqual(tree.names[edges[0]], '42684')
+        self.assertEqual(tree.names[edges[5]], '342684')
+        self.assertEqual(tree.names[edges[6]], 'UQrYOlnDN0000011_000')
+        self.assertEqual(tree.parent[edges[7]], tree.root)
+
+    def test_read_jplace_tree_missing_edge_nums(self):
+        with self.assertRaisesRegex(ValueError, '9 nodes but 7 edge'):
+            _read_jplace_tree(self.placements['tree'].replace('[6]', ''))
+
+    def test_tree_signature_ignores_internal_labels(self):
+        relabelled = self.placements['tree'].replace('UQrYOlnDN', 'XYZ')
+
+        self.assertEqual(_tree_signature(relabelled),
+                         _tree_signature(self.placements['tree']))
+        self.assertNotEqual(
+            _tree_signature(relabelled.replace('0.11110068', '0.1')),
+            _tree_signature(self.placements['tree']))
+
+    def test_graft(self):
+        obs = _graft_skbio(self.placements, self.reference_labels)
+
+        self.assertEqual({t.name for t in obs.tips()},
+                         {'testseq%s' % c for c in 'abcdefghi'} |
+                         {'42684', '295053', '879972', '426848', '342684'})
+        self.assertTrue(all(n.length is not None for n in obs.traverse()))
+
+        # testseqf has a single placement on the edge leading to 42684
+        joint = obs.find('testseqf').parent
+        self.assertEqual({c.name for c in joint.children},
+                         {'testseqf', '42684'})
+        self.assertAlmostEqual(obs.find('42684').length, 0.014451204)
+        self.assertAlmostEqual(obs.find('testseqf').length, 0.24120772)
+        self.assertAlmostEqual(joint.length + obs.find('42684').length,
+                               0.11110068)
+
+        # SEPP's placeholder labels are replaced by the reference labels
+        self.assertEqual(
+            sorted(n.name for n in obs.non_tips() if n.name is not None),
+            ['0.995', '1.000'])
+
+    def test_graft_null_lwr(self):
+        pqueries = self.placements['placements']
+        # testseqa is grafted as if its best placement was missing
+        exp = _graft_skbio(dict(self.placements, placements=[
+            dict(pquery, p=pquery['p'][1:]) if i == 1 else pquery
+            for i, pquery in enumerate(pqueries)]))
+        # testseqf has a single placement
+        pqueries[5]['p'][0][2] = None
+        pqueries[1]['p'][0][2] = None
+
+        obs = _graft_skbio(self.placements)
+
+        self.assertEqual(str(obs), str(exp))
+
+    def test_best_placement(self):
+        self.assertEqual(_best_placement([[0, None], [1, 0.4], [2, 0.6]], 1),
+                         [2, 0.6])
+        self.assertEqual(_best_placement([[0, None], [1, 0.0]], 1), [1, 0.0])
+        self.assertEqual(_best_placement([[0, None], [1, None]], 1),
+                         [0, None])
+
+    def test_relabel_mismatched_tips(self):
+        tree, _ = _read_jplace_tree(
+            self.placements['tree'].replace('879972', '879973'))
+        _relabel(tree, self.reference_labels)
+
+        self.assertEqual(
+            sorted(tree.names[n] for n in range(len(tree))
+                   if tree.first_child[n] != -1 and tree.names[n] is not None),
+            ['UQrYOlnDN0000011_000', 'UQrYOlnDN0000020_995'])
+
+    def test_relabel_mismatched_tips_strict(self):
+        tree, _ = _read_jplace_tree(
+            self.placements['tree'].replace('879972', '879973'))
+
+        with self.assertRaisesRegex(ValueError, 'different tips'):
+            _relabel(tree, self.reference_labels, strict=True)
+
+    def test_graft_without_reference(self):
+        obs = _graft_skbio(self.placements)
+
+        self.assertEqual(
+            sorted(n.name for n in obs.non_tips() if n.name is not None),
+            ['UQrYOlnDN0000011_000', 'UQrYOlnDN0000020_995'])
+
+    def test_graft_several_fragments_on_one_edge(self):
+        # testseqd and testseqb are both placed on edge 3
+        obs = _graft_skbio(self.placements, self.reference_labels)
+
+        lower = obs.find('testseqd').parent
+        upper = obs.find('testseqb').parent
+        self.assertIs(lower.parent, upper)
+        self.assertAlmostEqual(obs.find('879972').length, 0.06962858)
+        self.assertAlmostEqual(lower.length, 0.09065814 - 0.06962858)
@@ -6,12 +6,23 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import gzip
+import json
 import pathlib
+import shutil
 
-from q2_fragment_insertion._format import PlacementsFormat
+import numpy as np
+import pandas as pd
+
+from q2_fragment_insertion import PlacementsIterator
+from q2_fragment_insertion._format import (PlacementsFormat,
+                                           PlacementsBinaryDirFmt,
+                                           PlacementsGzFormat,
+                                           PlacementsGzDirFmt)
 
 from qiime2.plugin.testing import TestPluginBase
 from qiime2.plugin import ValidationError
+from qiime2.sdk import Artifact
 
 
 class TestTransformers(TestPluginBase):
@@ -41,3 +52,200 @@ class TestTransformers(TestPluginBase):
 
         obs = transformer(input_)
         self.assertEqual(obs, {'foo': 1})
+
+    def test_placements_format_to_placements_iterator(self):
+        transformer = self.get_transformer(PlacementsFormat,
+                                           PlacementsIterator)
+        input_ = PlacementsFormat(self.get_data_path('placements.json'),
+                                  mode='r')
+
+        obs = transformer(input_)
+
+        self.assertIsInstance(obs, PlacementsIterator)
+        records = list(obs)
+        self.assertEqual(len(records), 9)
+        self.assertEqual(records[0]['names'], ['testseqh'])
+        self.assertEqual(records[0]['edge_num'], [6, 3, 2, 5, 4])
+        self.assertEqual(records[0]['like_weight_ratio'],
+                         [0.73473126, 0.08716849, 0.08422179, 0.06601361,
+                          0.027864864])
+        self.assertEqual(records[0]['pendant_length'],
+                         [0.21201627, 0.25082782, 0.2535723, 0.24396463,
+                          0.26620647])
+        self.assertEqual(set(records[0]),
+                         {'names', 'edge_num', 'likelihood',
+                          'like_weight_ratio', 'distal_length',
+                          'pendant_length'})
+
+    def test_placements_format_to_dataframe(self):
+        transformer = self.get_transformer(PlacementsFormat, pd.DataFrame)
+        with open(self.get_data_path('placements.json')) as fh:
+            placements = json.load(fh)
+        placements['placements'] = [
+            {'p': [[1, -10.5, 0.25, 0.1, 0.2], [0, None, 0.75, 0.3, 0.4]],
+             'nm': [['a', 1], ['b', 2]]},
+            {'p': [], 'n': ['c']},
+            {'p': [[5, -3.0, 1.0, 0.5, 0.6]], 'n': ['d']}]
+        fp = pathlib.Path(self.temp_dir.name) / 'placements.json'
+        fp.write_text(json.dumps(placements))
+
+        obs = transformer(PlacementsFormat(str(fp), mode='r'))
+
+        exp = pd.DataFrame({
+            'fragment': ['a', 'a', 'b', 'b', 'd'],
+            'edge_num': np.array([1, 0, 1, 0, 5], dtype=np.int64),
+            'likelihood': [-10.5, np.nan, -10.5, np.nan, -3.0],
+            'like_weight_ratio': [0.25, 0.75, 0.25, 0.75, 1.0],
+            'distal_length': [0.1, 0.3, 0.1, 0.3, 0.5],
+            'pendant_length': [0.2, 0.4, 0.2, 0.4, 0.6],
+            'rank': np.array([2, 1, 2, 1, 1], dtype=np.int64)})
+        pd.testing.assert_frame_equal(obs, exp)
+
+    def test_placements_format_to_dataframe_null_lwr(self):
+        transformer = self.get_transformer(PlacementsFormat, pd.DataFrame)
+        to_binary = self.get_transformer(PlacementsFormat,
+                                         PlacementsBinaryDirFmt)
+        from_binary = self.get_transformer(PlacementsBinaryDirFmt,
+                                           pd.DataFrame)
+        with open(self.get_data_path('placements.json')) as fh:
+            placements = json.load(fh)
+        placements['placements'] = [
+            {'p': [[1, -10.5, None, 0.1, 0.2], [0, -9.5, 0.75, 0.3, 0.4],
+                   [2, -9.0, 0.25, 0.5, 0.6]],
+             'n': ['a']}]
+        fp = pathlib.Path(self.temp_dir.name) / 'placements.json'
+        fp.write_text(json.dumps(placements))
+        input_ = PlacementsFormat(str(fp), mode='r')
+
+        obs = transformer(input_)
+
+        np.testing.assert_array_equal(obs['like_weight_ratio'],
+                                      [np.nan, 0.75, 0.25])
+        np.testing.assert_array_equal(obs['rank'], [3, 1, 2])
+        pd.testing.assert_frame_equal(from_binary(to_binary(input_)), obs)
+
+    def test_placements_format_to_binary_round_trip(self):
+        to_binary = self.get_transformer(PlacementsFormat,
+                                         PlacementsBinaryDirFmt)
+        from_binary = self.get_transformer(PlacementsBinaryDirFmt,
+                                           PlacementsFormat)
+        input_ = PlacementsFormat(self.get_data_path('placements.json'),
+                                  mode='r')
+
+        binary = to_binary(input_)
+        binary.validate()
+        obs = from_binary(binary)
+
+        with obs.open() as fh:
+            obs = json.load(fh)
+        with input_.open() as fh:
+            exp = json.load(fh)
+        self.assertEqual(obs, exp)
+
+    def test_dict_to_binary_round_trip(self):
+        to_binary = self.get_transformer(dict, PlacementsBinaryDirFmt)
+        from_binary = self.get_transformer(PlacementsBinaryDirFmt, dict)
+        with open(self.get_data_path('placements.json')) as fh:
+            exp = json.load(fh)
+        exp['placements'][0]['p'][1][1] = None
+        exp['placements'][1] = {'p': [], 'n': ['x', 'y']}
+
+        obs = from_binary(to_binary(exp))
+
+        self.assertEqual(obs, exp)
+
+    def test_binary_to_dataframe(self):
+        to_binary = self.get_transformer(PlacementsFormat,
+                                         PlacementsBinaryDirFmt)
+        transformer = self.get_transformer(PlacementsBinaryDirFmt,
+                                           pd.DataFrame)
+        input_ = PlacementsFormat(self.get_data_path('placements.json'),
+                                  mode='r')
+
+        obs = transformer(to_binary(input_))
+
+        exp = self.get_transformer(PlacementsFormat, pd.DataFrame)(input_)
+        pd.testing.assert_frame_equal(obs, exp)
+
+    def test_placements_format_to_gz_round_trip(self):
+        to_gz = self.get_transformer(PlacementsFormat, PlacementsGzFormat)
+        from_gz = self.get_transformer(PlacementsGzFormat, PlacementsFormat)
+        input_ = PlacementsFormat(self.get_data_path('placements.json'),
+                                  mode='r')
+
+        compressed = to_gz(input_)
+        compressed.validate()
+        obs = from_gz(compressed)
+
+        self.assertEqual(obs.path.read_bytes(), input_.path.read_bytes())
+
+    def test_dict_to_gz_round_trip(self):
+        to_gz = self.get_transformer(dict, PlacementsGzFormat)
+        from_gz = self.get_transformer(PlacementsGzFormat, dict)
+        with open(self.get_data_path('placements.json')) as fh:
+            exp = json.load(fh)
+
+        compressed = to_gz(exp)
+        compressed.validate()
+
+        self.assertEqual(from_gz(compressed), exp)
+
+    def test_gz_to_placements_iterator(self):
+        to_gz = self.get_transformer(PlacementsFormat, PlacementsGzFormat)
+        transformer = self.get_transformer(PlacementsGzFormat,
+                                           PlacementsIterator)
+        input_ = PlacementsFormat(self.get_data_path('placements.json'),
+                                  mode='r')
+
+        obs = list(transformer(to_gz(input_)))
+
+        exp = list(self.get_transformer(PlacementsFormat,
+                                        PlacementsIterator)(input_))
+        self.assertEqual(obs, exp)
+
+    def test_gz_to_dataframe(self):
+        to_gz = self.get_transformer(PlacementsFormat, PlacementsGzFormat)
+        transformer = self.get_transformer(PlacementsGzFormat, pd.DataFrame)
+        input_ = PlacementsFormat(self.get_data_path('placements.json'),
+                                  mode='r')
+
+        obs = transformer(to_gz(input_))
+
+        exp = self.get_transformer(PlacementsFormat, pd.DataFrame)(input_)
+        pd.testing.assert_frame_equal(obs, exp)
+
+    def test_import_gz_as_placements(self):
+        directory = pathlib.Path(self.temp_dir.name) / 'gz'
+        directory.mkdir()
+        with open(self.get_data_path('placements.json'), 'rb') as src, \
+                gzip.open(directory / 'placements.json.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        with open(self.get_data_path('placements.json')) as fh:
+            exp = json.load(fh)
+
+        artifact = Artifact.import_data('Placements', str(directory),
+                                        view_type=PlacementsGzDirFmt)
+
+        self.assertEqual(str(artifact.type), 'Placements')
+        self.assertEqual(artifact.view(dict), exp)
+        compressed = artifact.view(PlacementsGzDirFmt)
+        with gzip.open(str(compressed.file.path_maker()), 'rt') as fh:
+            self.assertEqual(json.load(fh), exp)
+
+    def test_import_binary_as_placements(self):
+        to_binary = self.get_transformer(PlacementsFormat,
+                                         PlacementsBinaryDirFmt)
+        input_ = PlacementsFormat(self.get_data_path('placements.json'),
+                                  mode='r')
+        with input_.open() as fh:
+            exp = json.load(fh)
+
+        artifact = Artifact.import_data('Placements', str(to_binary(input_)),
+                                        view_type=PlacementsBinaryDirFmt)
+
+        self.assertEqual(str(artifact.type), 'Placements')
+        self.assertEqual(artifact.view(dict), exp)
+        pd.testing.assert_frame_equal(
+            artifact.view(pd.DataFrame),
+            self.get_transformer(PlacementsFormat, pd.DataFrame)(input_))
+        artifact.view(PlacementsBinaryDirFmt).validate()
@@ -0,0 +1,280 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+import os
+import shutil
+from unittest import mock
+
+import numpy as np
+import skbio
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_fragment_insertion._cache import TreeCache, EdgeTableCache
+from q2_fragment_insertion._tree import (_read_newick, _write_newick,
+                                         _save_tree, _load_saved_tree)
+
+
+class TestArrayTree(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    trees = [
+        '((a,b)c,d);',
+        '((a:1,b)c,(d:2.5,e:3)f:1)root:0.5;\n',
+        '(a,b,(c,d):1);',
+        "('a,b':1,'it''s (x)',c_d)'r;o:o[t]';",
+        '(a[&comment, with (structure)]:1,b[nested [comment]])[root];',
+        '(a , \n b\n)\n;',
+        '(,(,));',
+        '(a:1e-05,b:-2)x;',
+        'a:1;',
+    ]
+
+    def _write(self, tree):
+        fh = io.StringIO()
+        _write_newick(tree, fh)
+        return fh.getvalue()
+
+    def test_round_trip_matches_skbio(self):
+        for tree_str in self.trees:
+            for convert_underscores in (True, False):
+                tree = _read_newick(io.StringIO(tree_str),
+                                    convert_underscores=convert_underscores)
+                exp = io.StringIO()
+                skbio.TreeNode.read(
+                    io.StringIO(tree_str),
+                    convert_underscores=convert_underscores).write(exp)
+
+                self.assertEqual(self._write(tree), exp.getvalue())
+
+    def test_data(self):
+        for name in ('sepp-results.nwk', 'ref-tree.nwk'):
+            with open(self.get_data_path(name)) as fh:
+                tree = _read_newick(fh)
+            exp = skbio.TreeNode.read(self.get_data_path(name))
+
+            self.assertEqual(len(tree), exp.count())
+            self.assertEqual(sorted(tree.names[t] for t in tree.tips()),
+                             sorted(t.name for t in exp.tips()))
+
+    def test_arrays(self):
+        tree = _read_newick(io.StringIO('((a:1,b)c:2,d)e;'))
+
+        self.assertEqual(tree.names, ['e', 'c', 'a', 'b', 'd'])
+        np.testing.assert_array_equal(tree.parent, [-1, 0, 1, 1, 0])
+        np.testing.assert_array_equal(tree.first_child, [1, 2, -1, -1, -1])
+        np.testing.assert_array_equal(tree.next_sibling, [-1, 4, 3, -1, -1])
+        np.testing.assert_array_equal(tree.length,
+                                      [np.nan, 2, 1, np.nan, np.nan])
+        np.testing.assert_array_equal(tree.tips(), [2, 3, 4])
+        self.assertEqual(list(tree.children(1)), [2, 3])
+
+    def test_traversals(self):
+        tree = _read_newick(io.StringIO('((a,b)c,(d,(e,f)g)h)i;'))
+        exp = skbio.TreeNode.read(io.StringIO('((a,b)c,(d,(e,f)g)h)i;'))
+
+        self.assertEqual([tree.names[n] for n in tree.preorder()],
+                         [n.name for n in exp.preorder()])
+        self.assertEqual([tree.names[n] for n in tree.postorder()],
+                         [n.name for n in exp.postorder()])
+
+    def test_subtree(self):
+        tree = _read_newick(io.StringIO('((a,b)c,(d,(e,f)g)h)i;'))
+        index = {name: node for node, name in enumerate(tree.names)}
+
+        np.testing.assert_array_equal(tree.subtree_sizes(),
+                                      [9, 3, 1, 1, 5, 1, 3, 1, 1])
+        for name, exp in (('i', 'icabhdgef'), ('c', 'cab'), ('h', 'hdgef'),
+                          ('e', 'e')):
+            self.assertEqual(
+                ''.join(tree.names[n] for n in tree.subtree(index[name])),
+                exp)
+
+    def test_lowest_common_ancestor(self):
+        tree = _read_newick(io.StringIO('((a,b)c,(d,(e,f)g)h)i;'))
+        index = {name: node for node, name in enumerate(tree.names)}
+
+        def lca(*names):
+            return tree.names[tree.lowest_common_ancestor(
+                [index[name] for name in names])]
+
+        self.assertEqual(lca('a'), 'a')
+        self.assertEqual(lca('a', 'b'), 'c')
+        self.assertEqual(lca('e', 'd'), 'h')
+        self.assertEqual(lca('f', 'g', 'e'), 'g')
+        self.assertEqual(lca('b', 'f'), 'i')
+
+    def test_save_tree(self):
+        for tree_str in self.trees:
+            tree = _read_newick(io.StringIO(tree_str))
+            fh = io.BytesIO()
+            _save_tree(tree, fh)
+            fh.seek(0)
+
+            obs = _load_saved_tree(fh)
+
+            self.assertEqual(self._write(obs), self._write(tree))
+            self.assertEqual(obs.names, tree.names)
+            np.testing.assert_array_equal(obs.preorder(), tree.preorder())
+
+    def test_malformed(self):
+        for tree_str in ('((a,b);', '(a,b));', ''):
+            with self.assertRaises(ValueError):
+                _read_newick(io.StringIO(tree_str))
+
+
+class TestTreeCache(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.tree_fp = os.path.join(self.temp_dir.name, 'tree.nwk')
+        shutil.copy(self.get_data_path('sepp-results.nwk'), self.tree_fp)
+        self.store = os.path.join(self.temp_dir.name, 'cache')
+
+    def test_load(self):
+        cache = TreeCache()
+
+        obs = cache.load(self.tree_fp)
+
+        with open(self.tree_fp) as fh:
+            exp = _read_newick(fh)
+        self.assertEqual(obs.names, exp.names)
+        np.testing.assert_array_equal(obs.parent, exp.parent)
+
+    def test_load_same_content(self):
+        cache = TreeCache()
+        other_fp = os.path.join(self.temp_dir.name, 'other.nwk')
+        shutil.copy(self.tree_fp, other_fp)
+
+        tree = cache.load(self.tree_fp)
+
+        with mock.patch('q2_fragment_insertion._cache._read_newick') as read:
+            self.assertIs(cache.load(self.tree_fp), tree)
+            self.assertIs(cache.load(other_fp), tree)
+            read.assert_not_called()
+
+    def test_load_changed_content(self):
+        cache = TreeCache()
+        tree = cache.load(self.tree_fp)
+
+        with open(self.tree_fp, 'w') as fh:
+            fh.write('(a,b);')
+
+        self.assertIsNot(cache.load(self.tree_fp), tree)
+        self.assertEqual(cache.load(self.tree_fp).names, [None, 'a', 'b'])
+
+    def test_max_bytes(self):
+        other_fp = os.path.join(self.temp_dir.name, 'other.nwk')
+        with open(other_fp, 'w') as fh:
+            fh.write('(a,b);')
+        cache = TreeCache(max_bytes=1)
+
+        tree = cache.load(self.tree_fp)
+        other = cache.load(other_fp)
+
+        # The most recent tree is kept even if it exceeds the bound
+        self.assertIs(cache.load(other_fp), other)
+        self.assertIsNot(cache.load(self.tree_fp), tree)
+
+    def test_max_bytes_forgets_files(self):
+        other_fp = os.path.join(self.temp_dir.name, 'other.nwk')
+        with open(other_fp, 'w') as fh:
+            fh.write('(a,b);')
+        cache = TreeCache(max_bytes=1)
+
+        cache.load(self.tree_fp)
+        cache.load(other_fp)
+
+        self.assertEqual([key[0] for key in cache._digests],
+                         [os.path.realpath(other_fp)])
+
+    def test_max_digests(self):
+        cache = TreeCache(max_digests=2)
+        tree = cache.load(self.tree_fp)
+        for i in range(3):
+            fp = os.path.join(self.temp_dir.name, '%i.nwk' % i)
+            shutil.copy(self.tree_fp, fp)
+            self.assertIs(cache.load(fp), tree)
+
+        self.assertEqual(len(cache._digests), 2)
+
+    def test_directory(self):
+        exp = TreeCache(directory=self.store).load(self.tree_fp)
+
+        with mock.patch('q2_fragment_insertion._cache._read_newick') as read:
+            obs = TreeCache(directory=self.store).load(self.tree_fp)
+            read.assert_not_called()
+        self.assertEqual(obs.names, exp.names)
+        np.testing.assert_array_equal(obs.length, exp.length)
+
+    def test_directory_from_environment(self):
+        with mock.patch.dict(os.environ, {
+                'Q2_FRAGMENT_INSERTION_TREE_CACHE': self.store}):
+            TreeCache().load(self.tree_fp)
+
+        self.assertEqual(os.listdir(self.store), ['trees'])
+
+    def test_directory_damaged(self):
+        TreeCache(directory=self.store).load(self.tree_fp)
+        for dirpath, _, filenames in os.walk(self.store):
+            for filename in filenames:
+                with open(os.path.join(dirpath, filename), 'w') as fh:
+                    fh.write('garbage')
+
+        obs = TreeCache(directory=self.store).load(self.tree_fp)
+
+        with open(self.tree_fp) as fh:
+            self.assertEqual(obs.names, _read_newick(fh).names)
+
+
+class TestEdgeTableCache(TestPluginBase):
+    package = 'q2_fragment_insertion.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.store = os.path.join(self.temp_dir.name, 'cache')
+        self.compute = mock.Mock(return_value={0: 'k__A', 1: None})
+
+    def test_get(self):
+        cache = EdgeTableCache()
+
+        obs = cache.get('a', self.compute)
+
+        self.assertEqual(obs, {0: 'k__A', 1: None})
+        self.assertIs(cache.get('a', self.compute), obs)
+        self.compute.assert_called_once_with()
+
+    def test_max_entries(self):
+        cache = EdgeTableCache(max_entries=1)
+
+        cache.get('a', self.compute)
+        cache.get('b', self.compute)
+        cache.get('a', self.compute)
+
+        self.assertEqual(self.compute.call_count, 3)
+
+    def test_directory(self):
+        EdgeTableCache(directory=self.store).get('a', self.compute)
+
+        obs = EdgeTableCache(directory=self.store).get('a', self.compute)
+
+        self.assertEqual(obs, {0: 'k__A', 1: None})
+        self.compute.assert_called_once_with()
+
+    def test_directory_damaged(self):
+        EdgeTableCache(directory=self.store).get('a', self.compute)
+        for dirpath, _, filenames in os.walk(self.store):
+            for filename in filenames:
+                with open(os.path.join(dirpath, filename), 'w') as fh:
+                    fh.write('[')
+
+        obs = EdgeTableCache(directory=self.store).get('a', self.compute)
+
+        self.assertEqual(obs, {0: 'k__A', 1: None})
+        self.assertEqual(self.compute.call_count, 2)